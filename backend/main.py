@@ -1,18 +1,55 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from routers import chat, auth
-from database import create_tables
+from contextlib import asynccontextmanager
+from routers import chat, auth, data, analytics
+from database import create_tables, async_engine, DB_AUTO_MIGRATE
+from services.user_cache import user_cache
+from services.conversation_service import conversation_write_queue
+from services.password_hasher import password_hasher
+from services import metrics
+from services.retention import RETENTION_ENABLED
+from services.shared_state import shared_state, SHARED_STATE_BACKEND
+from services.compression import CompressionMiddleware, COMPRESSION_ENABLED
+from services.static_assets import StaticAssets, STATIC_PRECOMPRESS
+import time
 import os
 
-# Tạo bảng database
-create_tables()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Tạo bảng database khi khởi động thay vì lúc import, để import app nhanh và không có tác dụng phụ
+    if DB_AUTO_MIGRATE:
+        create_tables()
+    # Mở connection pool tới Ollama và hàng đợi ghi khi khởi động, đóng khi tắt server
+    await chat.ollama_service.startup()
+    if conversation_write_queue is not None:
+        await conversation_write_queue.start()
+    if chat.memory_index is not None:
+        await chat.memory_index.start()
+    if RETENTION_ENABLED:
+        await chat.retention.start()
+    yield
+    await chat.retention.stop()
+    await chat.single_flight.shutdown()
+    if chat.summarizer is not None:
+        await chat.summarizer.stop()
+    # Nhúng nốt các lượt đang chờ trước khi đóng HTTP client tới Ollama
+    if chat.memory_index is not None:
+        await chat.memory_index.stop()
+    await chat.ollama_service.shutdown()
+    if conversation_write_queue is not None:
+        await conversation_write_queue.stop()
+    password_hasher.shutdown()
+    await shared_state.close()
+    await async_engine.dispose()
+    metrics.mark_process_dead()
 
 app = FastAPI(
     title="Vietnamese AI Chatbot",
     description="Chatbot AI sử dụng Ollama models với giao diện tiếng Việt",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Cấu hình CORS
@@ -24,30 +61,76 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Nén JSON của API (vd. /api/history) theo Accept-Encoding
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    Đo thời gian xử lý và số request đang chạy theo route
+    """
+    in_progress = metrics.HTTP_REQUESTS_IN_PROGRESS.labels(method=request.method)
+    in_progress.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        in_progress.dec()
+        # Dùng path template của route (vd. /api/history/{session_id}) để tránh bùng nổ label
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        metrics.HTTP_REQUEST_DURATION.labels(
+            method=request.method, route=route_path, status=str(status)
+        ).observe(time.perf_counter() - start)
+
+metrics.register_scheduler(chat.scheduler)
+
 # Include routers
 app.include_router(auth.router, tags=["authentication"])
 app.include_router(chat.router, prefix="/api", tags=["chat"])
+app.include_router(data.router, prefix="/api", tags=["data"])
+app.include_router(analytics.router, prefix="/api", tags=["analytics"])
 
 # Serve static files
 frontend_path = os.path.join(os.path.dirname(__file__), "..", "frontend")
+static_assets = None
 if os.path.exists(frontend_path):
-    app.mount("/static", StaticFiles(directory=frontend_path), name="static")
+    if STATIC_PRECOMPRESS:
+        # Nén sẵn và gắn hash vào tên asset một lần khi khởi động
+        static_assets = StaticAssets(frontend_path).build()
+
+        @app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+        async def static_file(path: str, request: Request):
+            response = static_assets.response(request, path)
+            if response is None:
+                raise HTTPException(status_code=404, detail="Not Found")
+            return response
+    else:
+        app.mount("/static", StaticFiles(directory=frontend_path), name="static")
 
 @app.get("/")
-async def read_root():
+async def read_root(request: Request):
     """
     Serve trang chủ
     """
+    if static_assets is not None and static_assets.get("index.html"):
+        return static_assets.response(request, "index.html")
     frontend_file = os.path.join(frontend_path, "index.html")
     if os.path.exists(frontend_file):
         return FileResponse(frontend_file)
     return {"message": "Vietnamese AI Chatbot API", "docs": "/docs"}
 
 @app.get("/auth")
-async def auth_page():
+async def auth_page(request: Request):
     """
     Serve trang đăng nhập
     """
+    if static_assets is not None and static_assets.get("auth.html"):
+        return static_assets.response(request, "auth.html")
     auth_file = os.path.join(frontend_path, "auth.html")
     if os.path.exists(auth_file):
         return FileResponse(auth_file)
@@ -55,7 +138,27 @@ async def auth_page():
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "message": "Vietnamese AI Chatbot is running"}
+    return {
+        "status": "healthy",
+        "message": "Vietnamese AI Chatbot is running",
+        "worker_pid": os.getpid(),
+        "shared_state": SHARED_STATE_BACKEND,
+        "user_cache": user_cache.stats(),
+        "response_cache": chat.ollama_service.response_cache.stats() if chat.ollama_service.response_cache else None,
+        "memory": chat.memory_index.stats() if chat.memory_index else None,
+        "summarizer": chat.summarizer.stats() if chat.summarizer else None,
+        "single_flight": chat.single_flight.stats(),
+        "static_assets": static_assets.stats() if static_assets else None,
+        "retention": chat.retention.stats() if RETENTION_ENABLED else None
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Metrics theo định dạng Prometheus
+    """
+    content, content_type = metrics.render_metrics()
+    return Response(content=content, media_type=content_type)
 
 if __name__ == "__main__":
     import uvicorn
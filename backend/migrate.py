@@ -0,0 +1,32 @@
+"""
+Tạo/cập nhật schema database (bảng, cột, index, chỉ mục tìm kiếm, dữ liệu backfill).
+Chạy một lần trước khi khởi động các worker: python migrate.py
+"""
+from sqlalchemy import text
+from database import create_tables, engine
+
+def enable_incremental_vacuum(bind=engine):
+    """
+    Chuyển database SQLite tạo trước khi bật auto_vacuum sang chế độ INCREMENTAL để retention
+    trả được dung lượng. Cần một lần VACUUM đầy đủ: ghi lại toàn bộ file, khóa mọi thao tác ghi
+    trong lúc chạy và tạm cần thêm dung lượng đĩa bằng database, nên chỉ chạy ở bước migrate
+    """
+    if bind.dialect.name != "sqlite":
+        return
+    with bind.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+            return
+        print("Converting database to incremental auto_vacuum (one-time VACUUM)")
+        conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+
+def migrate():
+    create_tables()
+    enable_incremental_vacuum()
+    # Đóng các kết nối đồng bộ trước khi process khởi động worker
+    engine.dispose()
+
+if __name__ == "__main__":
+    migrate()
+    print("Database schema is up to date")
@@ -33,11 +33,13 @@ class Token(BaseModel):
 class ChatMessage(BaseModel):
     message: str
     session_id: str
+    model: Optional[str] = None  # Để trống thì dùng model của session hoặc model mặc định
 
 class ChatResponse(BaseModel):
     response: str
     session_id: str
     conversation_id: Optional[int] = None
+    model: Optional[str] = None
 
 class ConversationHistory(BaseModel):
     id: int
@@ -47,6 +49,7 @@ class ConversationHistory(BaseModel):
     timestamp: datetime
     rating: Optional[float] = None
     feedback: Optional[str] = None
+    model: Optional[str] = None
 
 class RatingRequest(BaseModel):
     conversation_id: int
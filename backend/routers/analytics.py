@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from models.schemas import UserResponse
+from services import rating_rollups
+from routers.auth import get_current_user, get_admin_user
+from typing import Optional
+
+router = APIRouter()
+
+DAY_PATTERN = r"^\d{4}-\d{2}-\d{2}$"
+
+@router.get("/analytics/ratings")
+async def rating_analytics(
+    group_by: str = Query("day", pattern="^(day|model|user)$"),
+    since: Optional[str] = Query(None, pattern=DAY_PATTERN),
+    until: Optional[str] = Query(None, pattern=DAY_PATTERN),
+    model: Optional[str] = None,
+    user_id: Optional[int] = None,
+    admin: UserResponse = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Điểm trung bình, phân bố điểm, số lượt được đánh giá và số phản hồi theo ngày,
+    model hoặc user (ngày theo UTC, dạng YYYY-MM-DD), đọc từ bảng rollup
+    """
+    return await rating_rollups.query(db, group_by, since, until, model, user_id)
+
+@router.get("/analytics/ratings/me")
+async def my_rating_analytics(
+    group_by: str = Query("day", pattern="^(day|model)$"),
+    since: Optional[str] = Query(None, pattern=DAY_PATTERN),
+    until: Optional[str] = Query(None, pattern=DAY_PATTERN),
+    model: Optional[str] = None,
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Thống kê đánh giá của user hiện tại
+    """
+    return await rating_rollups.query(db, group_by, since, until, model, current_user.id)
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from database import get_db, User
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db, User
 from models.schemas import UserCreate, UserLogin, UserResponse, Token
+from services.user_cache import user_cache
+from services.password_hasher import password_hasher
 import jwt
 from datetime import datetime, timedelta
 import os
@@ -14,6 +17,9 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Các username có quyền quản trị (export/import dữ liệu của mọi user), phân cách bằng dấu phẩy
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
 security = HTTPBearer()
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -26,7 +32,7 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_async_db)) -> UserResponse:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -40,29 +46,50 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except jwt.PyJWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
+    # Tránh truy vấn bảng users ở mỗi request nếu user đã có trong cache
+    await user_cache.sync()
+    principal = user_cache.get(username)
+    if principal is not None:
+        return principal
+    
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalars().first()
     if user is None:
         raise credentials_exception
-    return user
+    
+    principal = UserResponse.model_validate(user)
+    user_cache.set(username, principal)
+    return principal
+
+async def get_admin_user(current_user: UserResponse = Depends(get_current_user)) -> UserResponse:
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Chỉ quản trị viên mới được thực hiện thao tác này"
+        )
+    return current_user
 
 @router.post("/register", response_model=UserResponse)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
     # Kiểm tra username đã tồn tại
-    if db.query(User).filter(User.username == user_data.username).first():
+    result = await db.execute(select(User).where(User.username == user_data.username))
+    if result.scalars().first():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username đã tồn tại"
         )
     
     # Kiểm tra email đã tồn tại
-    if db.query(User).filter(User.email == user_data.email).first():
+    result = await db.execute(select(User).where(User.email == user_data.email))
+    if result.scalars().first():
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email đã tồn tại"
         )
     
     # Tạo user mới
-    hashed_password = User.hash_password(user_data.password)
+    # Hash trong thread pool để không block event loop
+    hashed_password = await password_hasher.hash(user_data.password)
     db_user = User(
         username=user_data.username,
         email=user_data.email,
@@ -71,16 +98,21 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     )
     
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return db_user
 
 @router.post("/login", response_model=Token)
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == user_data.username).first()
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).where(User.username == user_data.username))
+    user = result.scalars().first()
     
-    if not user or not user.verify_password(user_data.password):
+    valid, new_hash = (False, None)
+    if user:
+        valid, new_hash = await password_hasher.verify_and_update(user_data.password, user.password_hash)
+    
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Tên đăng nhập hoặc mật khẩu không đúng",
@@ -93,6 +125,11 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
             detail="Tài khoản đã bị vô hiệu hóa"
         )
     
+    # Hash lại mật khẩu khi cấu hình BCRYPT_ROUNDS đã thay đổi
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
+    
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
@@ -105,7 +142,7 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
     }
 
 @router.get("/me", response_model=UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: UserResponse = Depends(get_current_user)):
     return current_user
 
 @router.post("/logout")
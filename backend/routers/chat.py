@@ -1,76 +1,298 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database import get_db, User
-from models.schemas import ChatMessage, ChatResponse, RatingRequest, ConversationListResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db, AsyncSessionLocal, async_engine
+from models.schemas import ChatMessage, ChatResponse, RatingRequest, ConversationListResponse, UserResponse
 from services.conversation_service import ConversationService
-from services.ollama_service import OllamaService
+from services.ollama_service import OllamaService, OllamaError, OllamaUnavailable
+from services.inference_scheduler import InferenceScheduler, SchedulerFull
+from services.memory_index import MemoryIndex, MEMORY_ENABLED
+from services.session_summarizer import SessionSummarizer, SUMMARY_ENABLED
+from services.single_flight import Flight, SingleFlight
+from services.retention import RetentionManager
+from services.shared_state import shared_state
+from services.metrics import track_phase
 from routers.auth import get_current_user
-from typing import List
+from typing import List, Optional, Tuple
+import json
 
 router = APIRouter()
-ollama_service = OllamaService()
+ollama_service = OllamaService(shared=shared_state)
+scheduler = InferenceScheduler(shared=shared_state)
+# Trí nhớ dài hạn (tùy chọn): tìm các lượt cũ liên quan ngoài cửa sổ lịch sử gần đây
+memory_index = MemoryIndex(ollama_service, AsyncSessionLocal) if MEMORY_ENABLED else None
+# Tóm tắt cuộn (tùy chọn): các lượt cũ được gộp ở nền, prompt dùng tóm tắt + các lượt gần đây
+summarizer = SessionSummarizer(ollama_service, scheduler, AsyncSessionLocal) if SUMMARY_ENABLED else None
+# Gộp các request chat trùng nhau đang chạy vào một lượt sinh
+single_flight = SingleFlight(shared=shared_state, shared_errors=(OllamaError, OllamaUnavailable))
+# Đọc lại session đã lưu trữ; vòng lưu trữ định kỳ chỉ chạy khi RETENTION_ENABLED=1
+retention = RetentionManager(AsyncSessionLocal, async_engine)
 
-@router.post("/chat", response_model=ChatResponse)
-async def chat(message: ChatMessage, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def resolve_model(message: ChatMessage, user_id: int, conv_service: ConversationService) -> str:
+    """
+    Chọn model cho lượt chat: model trong request, rồi model của session, cuối cùng là model mặc định
+    """
+    model = message.model or await conv_service.get_session_model(message.session_id, user_id) or ollama_service.model
+    if not ollama_service.model_manager.is_allowed(model):
+        raise HTTPException(status_code=400, detail=f"Model '{model}' không khả dụng")
+    return model
+
+async def load_context(conv_service: ConversationService, user_id: int, session_id: str) -> Tuple[List[dict], Optional[str]]:
+    """
+    Lấy (các lượt gần nhất, bản tóm tắt) để dựng prompt; khi có tóm tắt chỉ lấy các lượt chưa được gộp
+    """
+    summary, summary_until_id = (None, None)
+    if summarizer is not None:
+        summary, summary_until_id = await conv_service.get_session_summary(session_id, user_id)
+    history = await conv_service.get_recent_history(
+        session_id, user_id, limit=ollama_service.context_turns, after_id=summary_until_id
+    )
+    return history, summary
+
+def after_persist(conversation):
+    """
+    Các việc chạy ở nền sau khi lượt chat đã được lưu
     """
-    Endpoint chính để chat với AI
+    if memory_index is not None:
+        memory_index.submit(conversation)
+    if summarizer is not None:
+        summarizer.schedule(conversation.user_id, conversation.session_id)
+
+async def recall_memories(db: AsyncSession, user_id: int, message: ChatMessage, history: List[dict]) -> Optional[List[dict]]:
+    if memory_index is None:
+        return None
+    with track_phase("memory_recall"):
+        return await memory_index.recall(db, user_id, message.session_id, message.message, [conv["id"] for conv in history])
+
+def generation_http_error(e: OllamaError) -> HTTPException:
+    return HTTPException(status_code=503 if isinstance(e, OllamaUnavailable) else 502, detail=str(e))
+
+def scheduler_http_error(e: SchedulerFull) -> HTTPException:
+    return HTTPException(
+        status_code=e.status_code,
+        detail=e.detail,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+async def start_turn(flight: Flight, message: ChatMessage, user_id: int, db: AsyncSession, stream: bool):
+    """
+    Chuẩn bị context, giữ lượt trong scheduler rồi khởi chạy lượt sinh ở nền cho flight.
+    Lỗi ở bước này (model không hợp lệ, scheduler đầy) cũng được báo cho các request trùng
     """
     try:
-        # Tạo service
         conv_service = ConversationService(db)
-        
-        # Lấy lịch sử cuộc hội thoại của user hiện tại
-        history = conv_service.get_conversation_history(message.session_id, current_user.id)
-        
-        # Tạo phản hồi từ Ollama
-        bot_response = await ollama_service.generate_response(
-            message.message, 
-            history
-        )
-        
-        # Lưu cuộc hội thoại với user_id
-        conversation = conv_service.create_conversation(
-            session_id=message.session_id,
-            user_id=current_user.id,
-            user_message=message.message,
-            bot_response=bot_response
-        )
-        
-        return ChatResponse(
-            response=bot_response, 
-            session_id=message.session_id,
-            conversation_id=conversation.id
-        )
-        
+        # Chỉ lấy các lượt gần nhất cần cho prompt thay vì toàn bộ session
+        with track_phase("history_load"):
+            model = await resolve_model(message, user_id, conv_service)
+            history, summary = await load_context(conv_service, user_id, message.session_id)
+        memories = await recall_memories(db, user_id, message, history)
+        # Trả kết nối về pool trước khi chờ scheduler và sinh câu trả lời: request đang chờ
+        # không được giữ kết nối mà lượt sinh ở nền cần để lưu kết quả
+        await db.close()
+
+        # Chờ tới lượt trong scheduler trước khi trả response để có thể báo 429/503 bằng HTTP status
+        with track_phase("queue_wait"):
+            ticket = await scheduler.acquire(model, user_id)
+    except BaseException as e:
+        await single_flight.abandon(flight, e)
+        raise
+    
+    single_flight.run(flight, generate_turn(flight, ticket, message, user_id, model, history, memories, summary, stream))
+
+async def generate_turn(flight: Flight, ticket, message: ChatMessage, user_id: int, model: str, history: List[dict], memories: Optional[List[dict]], summary: Optional[str], stream: bool):
+    """
+    Sinh câu trả lời, phát token cho mọi request đang gắn vào flight và lưu lượt chat đúng một lần.
+    Lượt sinh lỗi (OllamaError) làm flight thất bại và không được lưu
+    """
+    try:
+        if stream:
+            async for token in ollama_service.generate_response_stream(
+                message.message, history, session_id=message.session_id, model=model, memories=memories, summary=summary
+            ):
+                flight.publish(token)
+            bot_response = "".join(flight.parts)
+        else:
+            bot_response = await ollama_service.generate_response(
+                message.message,
+                history,
+                session_id=message.session_id,
+                model=model,
+                memories=memories,
+                summary=summary
+            )
+            flight.publish(bot_response)
+    finally:
+        scheduler.release(ticket)
+    
+    # Lượt sinh chạy ngoài vòng đời request nên mở session riêng để lưu
+    with track_phase("persist"):
+        async with AsyncSessionLocal() as db:
+            conversation = await ConversationService(db).create_conversation(
+                session_id=message.session_id,
+                user_id=user_id,
+                user_message=message.message,
+                bot_response=bot_response,
+                model=model
+            )
+    after_persist(conversation)
+    flight.finish({
+        "response": bot_response,
+        "session_id": message.session_id,
+        "conversation_id": conversation.id,
+        "model": model
+    })
+
+@router.post("/chat", response_model=ChatResponse)
+async def chat(
+    message: ChatMessage,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Endpoint chính để chat với AI. Request trùng với một lượt đang chạy (cùng header
+    Idempotency-Key, hoặc cùng session và nội dung) nhận chung kết quả thay vì sinh lại
+    """
+    key = single_flight.make_key(current_user.id, message.session_id, message.message, message.model, idempotency_key)
+    flight, leader = await single_flight.join(key)
+    try:
+        if leader:
+            await start_turn(flight, message, current_user.id, db, stream=False)
+        result = await flight.wait()
+        return ChatResponse(**result)
+    except HTTPException:
+        raise
+    except SchedulerFull as e:
+        raise scheduler_http_error(e)
+    except OllamaError as e:
+        raise generation_http_error(e)
     except Exception as e:
         print(f"Error in chat endpoint: {e}")
         raise HTTPException(status_code=500, detail="Có lỗi xảy ra khi xử lý tin nhắn")
 
+@router.post("/chat/stream")
+async def chat_stream(
+    message: ChatMessage,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Chat với AI, trả về từng token dạng NDJSON ngay khi model sinh ra. Request trùng
+    gắn vào stream đang chạy và nhận lại các token đã sinh từ đầu
+    """
+    key = single_flight.make_key(current_user.id, message.session_id, message.message, message.model, idempotency_key)
+    flight, leader = await single_flight.join(key)
+    if leader:
+        try:
+            await start_turn(flight, message, current_user.id, db, stream=True)
+        except SchedulerFull as e:
+            raise scheduler_http_error(e)
+    
+    async def event_stream():
+        # Ngắt kết nối chỉ dừng việc gửi; lượt sinh vẫn chạy tiếp và được lưu
+        async for token in flight.stream():
+            yield json.dumps({"type": "token", "content": token}, ensure_ascii=False) + "\n"
+        
+        if flight.error is not None:
+            print(f"Error in streamed chat: {flight.error}")
+            detail = str(flight.error) if isinstance(flight.error, OllamaError) else "Có lỗi xảy ra khi xử lý tin nhắn"
+            yield json.dumps({"type": "error", "detail": detail}, ensure_ascii=False) + "\n"
+        else:
+            yield json.dumps({"type": "done", **flight.result}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/history/{session_id}")
-async def get_history(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_history(
+    session_id: str,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[int] = None,
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
     """
-    Lấy lịch sử cuộc hội thoại của user hiện tại
+    Lấy lịch sử cuộc hội thoại của user hiện tại, phân trang bằng cursor.
+    Phần đã lưu trữ của session (cũ hơn các lượt còn trong database) được đọc lại
+    từ file lưu trữ và nối trước các lượt trong database
     """
     conv_service = ConversationService(db)
-    history = conv_service.get_conversation_history(session_id, current_user.id)
-    return {"history": history}
+    archived = await retention.read_session(db, current_user.id, session_id)
+    archived_ids = {conv["id"] for conv in archived or ()}
+    if not archived or (cursor is not None and cursor not in archived_ids):
+        history, next_cursor = await conv_service.get_history_page(session_id, current_user.id, limit, cursor)
+        if archived:
+            return {"history": history, "next_cursor": next_cursor, "archived": True}
+        return {"history": history, "next_cursor": next_cursor}
+    
+    start = 0
+    if cursor is not None:
+        start = next(i for i, conv in enumerate(archived) if conv["id"] == cursor) + 1
+    page = archived[start:start + limit]
+    if start + limit < len(archived):
+        return {"history": page, "next_cursor": page[-1]["id"], "archived": True}
+    # Trang chạm tới cuối phần lưu trữ: lấy tiếp từ database, thêm một lượt để biết còn trang sau không
+    remaining = limit - len(page)
+    live, _ = await conv_service.get_history_page(session_id, current_user.id, remaining + 1)
+    page.extend(live[:remaining])
+    next_cursor = page[-1]["id"] if len(live) > remaining else None
+    return {"history": page, "next_cursor": next_cursor, "archived": True}
 
 @router.get("/sessions")
-async def get_sessions(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_sessions(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[int] = None,
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
     """
-    Lấy danh sách tất cả sessions của user hiện tại
+    Lấy danh sách sessions của user hiện tại, mới hoạt động nhất trước, phân trang bằng cursor
     """
     conv_service = ConversationService(db)
-    sessions = conv_service.get_all_sessions(current_user.id)
-    return {"sessions": sessions}
+    sessions, next_cursor = await conv_service.get_all_sessions(current_user.id, limit, cursor)
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+@router.get("/sessions/archived")
+async def get_archived_sessions(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[int] = None,
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Lấy danh sách sessions đã được lưu trữ của user hiện tại (đọc lịch sử qua /history/{session_id})
+    """
+    sessions, next_cursor = await retention.list_sessions(db, current_user.id, limit, cursor)
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+@router.get("/search")
+async def search_conversations(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    session_id: Optional[str] = None,
+    min_rating: Optional[float] = Query(None, ge=1, le=5),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Tìm kiếm toàn văn trong lịch sử hội thoại của user hiện tại (không phân biệt dấu)
+    """
+    conv_service = ConversationService(db)
+    results = await conv_service.search_conversations(current_user.id, q, limit, offset, session_id, min_rating)
+    return {"query": q, "results": results}
 
 @router.post("/rate")
-async def rate_conversation(rating_request: RatingRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def rate_conversation(rating_request: RatingRequest, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Đánh giá cuộc hội thoại
     """
     conv_service = ConversationService(db)
-    success = conv_service.rate_conversation(
+    success = await conv_service.rate_conversation(
         rating_request.conversation_id,
         rating_request.rating,
         rating_request.feedback,
@@ -83,7 +305,7 @@ async def rate_conversation(rating_request: RatingRequest, current_user: User =
         raise HTTPException(status_code=404, detail="Không tìm thấy cuộc hội thoại")
 
 @router.get("/new-session")
-async def new_session(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def new_session(current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Tạo session mới cho user hiện tại
     """
@@ -92,12 +314,14 @@ async def new_session(current_user: User = Depends(get_current_user), db: Sessio
     return {"session_id": session_id}
 
 @router.delete("/session/{session_id}")
-async def delete_session(session_id: str, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def delete_session(session_id: str, current_user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Xóa session của user hiện tại
     """
     conv_service = ConversationService(db)
-    success = conv_service.delete_session(session_id, current_user.id)
+    success = await conv_service.delete_session(session_id, current_user.id, archive=retention)
+    if memory_index is not None:
+        memory_index.invalidate(current_user.id, session_id)
     
     if success:
         return {"message": "Session đã được xóa thành công"}
@@ -110,7 +334,27 @@ async def get_available_models():
     Lấy danh sách models có sẵn từ Ollama
     """
     models = await ollama_service.list_models()
-    return {"models": models}
+    if ollama_service.model_manager.allowed:
+        models = [model for model in models if model in ollama_service.model_manager.allowed]
+    return {
+        "models": models,
+        "default": ollama_service.model,
+        "loaded": sorted(set(m for backend in ollama_service.pool.backends for m in backend.loaded_models))
+    }
+
+@router.get("/models/status")
+async def get_model_status():
+    """
+    Model đang nạp trên từng node, model được ghim và số lần phải nạp model từ đầu
+    """
+    return ollama_service.model_manager.stats()
+
+@router.get("/scheduler")
+async def scheduler_stats():
+    """
+    Độ sâu hàng đợi và thời gian chờ của scheduler theo model
+    """
+    return {"models": scheduler.stats()}
 
 @router.get("/health")
 async def health_check():
@@ -120,5 +364,6 @@ async def health_check():
     is_connected = await ollama_service.check_connection()
     return {
         "status": "healthy" if is_connected else "unhealthy",
-        "ollama_connected": is_connected
+        "ollama_connected": is_connected,
+        "backends": ollama_service.pool.status()
     }
\ No newline at end of file
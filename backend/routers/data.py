@@ -0,0 +1,135 @@
+from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db, AsyncSessionLocal, User
+from models.schemas import UserResponse
+from services.conversation_service import ConversationService
+from services.data_export import EXPORT_FORMATS, IMPORT_MAX_ERRORS, batched, format_csv, format_ndjson, read_records, to_conversation_row
+from routers.auth import get_current_user, get_admin_user
+from datetime import datetime
+from typing import Optional
+import io
+
+router = APIRouter()
+
+FORMAT_PATTERN = "^(ndjson|csv)$"
+
+def export_response(fmt: str, filename: str, user_id: int = None, session_id: str = None, min_rating: float = None) -> StreamingResponse:
+    async def stream():
+        # Body được gửi sau khi dependency đã đóng session, nên mở session riêng cho cursor
+        async with AsyncSessionLocal() as db:
+            batches = ConversationService(db).stream_conversations(user_id, session_id, min_rating)
+            formatter = format_csv if fmt == "csv" else format_ndjson
+            async for chunk in formatter(batches):
+                yield chunk
+
+    return StreamingResponse(
+        stream(),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
+
+async def import_file(file: UploadFile, fmt: Optional[str], default_user_id: int, db: AsyncSession, keep_user_ids: bool = False) -> dict:
+    """
+    Đọc file theo từng batch (file upload đã được spool xuống đĩa) và insert mỗi batch
+    bằng một lệnh, bộ nhớ không phụ thuộc kích thước file
+    """
+    fmt = fmt or ("csv" if (file.filename or "").lower().endswith(".csv") else "ndjson")
+    stream = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="")
+    batches = batched(read_records(stream, fmt))
+    conv_service = ConversationService(db)
+    imported, skipped, errors = 0, 0, []
+
+    while True:
+        # Đọc và parse file trong thread pool để không block event loop
+        batch = await run_in_threadpool(next, batches, None)
+        if batch is None:
+            break
+
+        known_users = None
+        if keep_user_ids:
+            user_ids = {
+                int(record["user_id"]) for _, record, _ in batch
+                if record and str(record.get("user_id") or "").isdigit()
+            }
+            result = await db.execute(select(User.id).where(User.id.in_(user_ids)))
+            known_users = set(result.scalars().all())
+
+        rows = []
+        for line_number, record, error in batch:
+            if error is None:
+                try:
+                    user_id = default_user_id
+                    if keep_user_ids and record.get("user_id") not in (None, ""):
+                        user_id = int(record["user_id"])
+                        if user_id not in known_users:
+                            raise ValueError(f"Không tồn tại user_id {user_id}")
+                    rows.append(to_conversation_row(record, user_id))
+                    continue
+                except (ValueError, TypeError) as e:
+                    error = str(e)
+            skipped += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_number, "error": error})
+        imported += await conv_service.import_conversations(rows)
+
+    return {"imported": imported, "skipped": skipped, "errors": errors}
+
+@router.get("/export")
+async def export_conversations(
+    format: str = Query("ndjson", pattern=FORMAT_PATTERN),
+    session_id: Optional[str] = None,
+    min_rating: Optional[float] = Query(None, ge=1, le=5),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """
+    Export hội thoại và đánh giá của user hiện tại dạng NDJSON hoặc CSV (stream)
+    """
+    filename = f"conversations-{current_user.username}-{datetime.utcnow():%Y%m%d}"
+    return export_response(format, filename, current_user.id, session_id, min_rating)
+
+@router.post("/import")
+async def import_conversations(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern=FORMAT_PATTERN),
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Import hội thoại (NDJSON hoặc CSV cùng định dạng với export) vào tài khoản hiện tại
+    """
+    try:
+        return await import_file(file, format, current_user.id, db)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File phải được mã hóa UTF-8")
+
+@router.get("/admin/export")
+async def admin_export_conversations(
+    format: str = Query("ndjson", pattern=FORMAT_PATTERN),
+    user_id: Optional[int] = None,
+    session_id: Optional[str] = None,
+    min_rating: Optional[float] = Query(None, ge=1, le=5),
+    admin: UserResponse = Depends(get_admin_user)
+):
+    """
+    Export hội thoại của mọi user (hoặc một user) cho quản trị viên
+    """
+    filename = f"conversations-{user_id or 'all'}-{datetime.utcnow():%Y%m%d}"
+    return export_response(format, filename, user_id, session_id, min_rating)
+
+@router.post("/admin/import")
+async def admin_import_conversations(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern=FORMAT_PATTERN),
+    admin: UserResponse = Depends(get_admin_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Import hội thoại giữ nguyên user_id trong file (dòng không có user_id được gán cho quản trị viên)
+    """
+    try:
+        return await import_file(file, format, admin.id, db, keep_user_ids=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File phải được mã hóa UTF-8")
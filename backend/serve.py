@@ -0,0 +1,59 @@
+"""
+Chạy server ở chế độ production: migrate database một lần rồi khởi động nhiều worker uvicorn.
+
+    python serve.py --workers 4 --port 12000
+
+Các worker dùng chung trạng thái (giới hạn của scheduler, thời điểm dùng model) qua
+SHARED_STATE_BACKEND; khi chạy nhiều worker mà chưa cấu hình thì dùng file SQLite cục bộ.
+Cache câu trả lời (RESPONSE_CACHE_BACKEND) cũng mặc định dùng file SQLite chung như vậy.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+
+def default_workers() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Chạy Vietnamese AI Chatbot với nhiều worker")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "12000")))
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--skip-migrate", action="store_true", help="Bỏ qua bước migrate (đã chạy migrate.py riêng)")
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_migrate:
+        from migrate import migrate
+        migrate()
+    # Worker không chạy DDL lúc khởi động, schema đã được cập nhật ở trên
+    os.environ["DB_AUTO_MIGRATE"] = "0"
+
+    if args.workers > 1:
+        if os.getenv("SHARED_STATE_BACKEND", "local") == "local":
+            os.environ["SHARED_STATE_BACKEND"] = "sqlite"
+            print(f"SHARED_STATE_BACKEND=sqlite ({os.getenv('SHARED_STATE_PATH', './shared_state.db')})")
+        if not os.getenv("RESPONSE_CACHE_BACKEND"):
+            # Cache trong bộ nhớ chỉ thuộc một worker: dùng file chung để mọi worker cùng hưởng cache
+            os.environ["RESPONSE_CACHE_BACKEND"] = "sqlite"
+            print(f"RESPONSE_CACHE_BACKEND=sqlite ({os.getenv('RESPONSE_CACHE_PATH', './response_cache.db')})")
+        if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="chatbot-metrics-")
+        else:
+            # Xóa file metrics của lần chạy trước
+            shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+            os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        access_log=args.access_log,
+        proxy_headers=True
+    )
+
+if __name__ == "__main__":
+    main()
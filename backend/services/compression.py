@@ -0,0 +1,116 @@
+from typing import Dict, List, Optional
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:  # brotli là tùy chọn, không có thì chỉ nén gzip
+    brotli = None
+
+# Nén response JSON của API khi client hỗ trợ (gzip/brotli)
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+# Response nhỏ hơn ngưỡng này gửi nguyên, nén không đáng công
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Mức nén cho response động: ưu tiên tốc độ, asset tĩnh được nén sẵn ở mức cao nhất
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+# Chỉ nén các loại nội dung văn bản; NDJSON stream không nằm trong danh sách để token không bị giữ lại
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/css", "text/plain", "application/javascript", "text/javascript")
+
+def supported_encodings() -> List[str]:
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+def negotiate(accept_encoding: str, available=None) -> Optional[str]:
+    """
+    Chọn encoding tốt nhất mà client chấp nhận (br > gzip), None nếu phải gửi nguyên
+    """
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name] = quality
+    for encoding in available if available is not None else supported_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def compress(body: bytes, encoding: str, best: bool = False) -> bytes:
+    """
+    Nén body; best=True dùng mức nén cao nhất (cho asset nén sẵn một lần)
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else BROTLI_QUALITY)
+    if encoding == "gzip":
+        # mtime=0 để cùng nội dung cho ra cùng byte (ETag ổn định giữa các worker)
+        return gzip.compress(body, compresslevel=9 if best else GZIP_LEVEL, mtime=0)
+    return body
+
+class CompressionMiddleware:
+    """
+    ASGI middleware nén response văn bản (chủ yếu JSON của API) theo Accept-Encoding.
+    Response stream nhiều phần, response đã có Content-Encoding hoặc quá nhỏ được gửi nguyên.
+    """
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        encoding = negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Dict = {}
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            response_headers = dict(start_message.get("headers") or [])
+            content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+            if (
+                message.get("more_body", False)
+                or b"content-encoding" in response_headers
+                or len(body) < self.minimum_size
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                # Gửi nguyên phần này và mọi phần sau
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = compress(body, encoding)
+            new_headers = [
+                (name, value) for name, value in start_message.get("headers") or []
+                if name not in (b"content-length", b"vary")
+            ]
+            vary = response_headers.get(b"vary")
+            new_headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+            new_headers.append((b"content-encoding", encoding.encode("latin-1")))
+            new_headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+            await send({**start_message, "headers": new_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,151 @@
+from typing import List, Dict, Optional, Tuple
+import math
+import os
+
+# Ngân sách token mặc định cho phần prompt (system prompt + lịch sử + tin nhắn mới)
+DEFAULT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1536"))
+
+# Ngân sách riêng cho từng model, model không có trong danh sách dùng giá trị mặc định
+MODEL_CONTEXT_BUDGETS: Dict[str, int] = {
+    "llama3.2:1b": 1536,
+    "llama3.2:3b": 2048,
+    "qwen2.5:3b": 2048,
+}
+
+# Số ký tự trung bình trên mỗi token theo họ model. Tiếng Việt có dấu
+# thường bị tách thành nhiều token hơn tiếng Anh nên tỉ lệ thấp hơn ~4.
+CHARS_PER_TOKEN: Dict[str, float] = {
+    "llama": 2.5,
+    "qwen": 2.8,
+    "gemma": 3.0,
+    "mistral": 2.5,
+}
+DEFAULT_CHARS_PER_TOKEN = 2.5
+
+# Lượt hội thoại cũ dài hơn ngưỡng này sẽ bị cắt bớt
+MAX_TURN_TOKENS = int(os.getenv("CONTEXT_MAX_TURN_TOKENS", "384"))
+# Không đưa vào prompt phần lượt bị cắt còn ít hơn ngưỡng này
+MIN_TURN_TOKENS = 32
+
+TRUNCATION_MARKER = " [...]"
+
+def estimate_tokens(text: str, model: str = "") -> int:
+    """
+    Ước lượng nhanh số token của một đoạn văn bản theo họ model
+    """
+    if not text:
+        return 0
+    family = model.split(":")[0].lower()
+    ratio = DEFAULT_CHARS_PER_TOKEN
+    for prefix, chars_per_token in CHARS_PER_TOKEN.items():
+        if family.startswith(prefix):
+            ratio = chars_per_token
+            break
+    return math.ceil(len(text) / ratio)
+
+class BuiltContext:
+    """
+    Kết quả dựng context: đoạn lịch sử, số lượt đã dùng và số token ước lượng
+    """
+    def __init__(self, context: str, turns: int, context_tokens: int):
+        self.context = context
+        self.turns = turns
+        self.context_tokens = context_tokens
+
+class ContextBuilder:
+    def __init__(self, budgets: Dict[str, int] = None, default_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET, max_turn_tokens: int = MAX_TURN_TOKENS):
+        self.budgets = budgets if budgets is not None else MODEL_CONTEXT_BUDGETS
+        self.default_budget = default_budget
+        self.max_turn_tokens = max_turn_tokens
+
+    def budget_for(self, model: str) -> int:
+        return self.budgets.get(model, self.default_budget)
+
+    def build(self, model: str, conversation_history: List[Dict], reserved_tokens: int = 0) -> BuiltContext:
+        """
+        Xếp các lượt hội thoại gần nhất vào ngân sách token của model.
+        `reserved_tokens` là phần đã dùng cho system prompt và tin nhắn hiện tại.
+        """
+        remaining = self.budget_for(model) - reserved_tokens
+        if not conversation_history or remaining <= 0:
+            return BuiltContext("", 0, 0)
+
+        selected = []
+        used = 0
+        # Duyệt từ lượt mới nhất về cũ nhất
+        for conv in reversed(conversation_history):
+            turn = self._format_turn(conv)
+            tokens = estimate_tokens(turn, model)
+
+            limit = min(self.max_turn_tokens, remaining - used)
+            if tokens > limit:
+                if limit < MIN_TURN_TOKENS:
+                    break
+                turn = self._truncate(turn, model, limit)
+                tokens = estimate_tokens(turn, model)
+
+            selected.append(turn)
+            used += tokens
+            if remaining - used < MIN_TURN_TOKENS:
+                break
+
+        selected.reverse()
+        return BuiltContext("\n".join(selected), len(selected), used)
+
+    def build_window(self, model: str, conversation_history: List[Dict], reserved_tokens: int = 0, anchor_id: int = None, max_turns: int = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Chọn cửa sổ lịch sử chỉ nối thêm (append-only) cho chế độ /api/chat.
+        Cửa sổ bắt đầu từ lượt `anchor_id` và giữ nguyên điểm đầu giữa các lượt
+        để Ollama tái sử dụng KV-cache của phần prefix; khi vượt ngân sách
+        hoặc `max_turns`, nửa cũ nhất của cửa sổ bị bỏ đi một lần.
+        Trả về (các lượt đã cắt theo max_turn_tokens, anchor_id mới).
+        """
+        if not conversation_history:
+            return [], None
+
+        turns = conversation_history
+        if anchor_id is not None:
+            turns = [conv for conv in conversation_history if conv["id"] >= anchor_id]
+
+        # Mỗi lượt chỉ bị cắt theo ngưỡng cố định để nội dung prefix không đổi giữa các lượt
+        fitted = [self._fit_turn(conv, model) for conv in turns]
+        costs = [
+            estimate_tokens(conv["user_message"], model) + estimate_tokens(conv["bot_response"], model)
+            for conv in fitted
+        ]
+
+        remaining = self.budget_for(model) - reserved_tokens
+        while fitted and (sum(costs) > remaining or (max_turns and len(fitted) >= max_turns)):
+            drop = max(len(fitted) // 2, 1)
+            fitted, costs = fitted[drop:], costs[drop:]
+
+        return fitted, (fitted[0]["id"] if fitted else None)
+
+    def _fit_turn(self, conv: Dict, model: str) -> Dict:
+        """
+        Cắt một lượt theo max_turn_tokens: câu hỏi tối đa một nửa, phần còn lại cho câu trả lời
+        """
+        if estimate_tokens(self._format_turn(conv), model) <= self.max_turn_tokens:
+            return conv
+        fitted = dict(conv)
+        user_limit = self.max_turn_tokens // 2
+        if estimate_tokens(conv["user_message"], model) > user_limit:
+            fitted["user_message"] = self._truncate(conv["user_message"], model, user_limit)
+        bot_limit = self.max_turn_tokens - estimate_tokens(fitted["user_message"], model)
+        if estimate_tokens(conv["bot_response"], model) > bot_limit:
+            fitted["bot_response"] = self._truncate(conv["bot_response"], model, bot_limit)
+        return fitted
+
+    @staticmethod
+    def _format_turn(conv: Dict) -> str:
+        return f"Người dùng: {conv['user_message']}\nAI: {conv['bot_response']}"
+
+    @staticmethod
+    def _truncate(text: str, model: str, max_tokens: int) -> str:
+        """
+        Cắt bớt phần cuối của một lượt quá dài để vừa `max_tokens`
+        """
+        marker_tokens = estimate_tokens(TRUNCATION_MARKER, model)
+        keep_ratio = (max_tokens - marker_tokens) / max(estimate_tokens(text, model), 1)
+        keep_chars = max(int(len(text) * keep_ratio), 0)
+        return text[:keep_chars].rstrip() + TRUNCATION_MARKER
@@ -1,99 +1,417 @@
-from sqlalchemy.orm import Session
-from database import Conversation
-from typing import List, Dict
+from sqlalchemy import select, delete, update, insert, and_, or_, case
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import User, Conversation, ChatSession, ConversationEmbedding, SESSION_TITLE_LENGTH, AsyncSessionLocal
+from services.write_behind import WriteBehindQueue
+from services import search_index, rating_rollups
+from datetime import datetime
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 import uuid
+import os
+
+# Gom các lượt chat mới vào một transaction (group commit) thay vì commit từng lượt
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "50"))
+DB_WRITE_MAX_DELAY_MS = float(os.getenv("DB_WRITE_MAX_DELAY_MS", "20"))
+
+# Số dòng mỗi lần đọc từ cursor khi export (bộ nhớ giữ ở mức một batch bất kể tổng số dòng)
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
 
 class ConversationService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
     
-    def create_conversation(self, session_id: str, user_id: int, user_message: str, bot_response: str) -> Conversation:
+    async def create_conversation(self, session_id: str, user_id: int, user_message: str, bot_response: str, model: str = None) -> Conversation:
         """
         Tạo một cuộc hội thoại mới
         """
+        if conversation_write_queue is not None:
+            return await conversation_write_queue.submit((session_id, user_id, user_message, bot_response, model))
+        
+        conversation = await self._add_conversation(session_id, user_id, user_message, bot_response, model)
+        await self.db.commit()
+        await self.db.refresh(conversation)
+        return conversation
+    
+    async def _add_conversation(self, session_id: str, user_id: int, user_message: str, bot_response: str, model: str = None) -> Conversation:
+        """
+        Thêm cuộc hội thoại và cập nhật chat_sessions, chưa commit
+        """
+        timestamp = datetime.utcnow()
         conversation = Conversation(
             session_id=session_id,
             user_id=user_id,
             user_message=user_message,
-            bot_response=bot_response
+            bot_response=bot_response,
+            timestamp=timestamp,
+            model=model
         )
         self.db.add(conversation)
-        self.db.commit()
-        self.db.refresh(conversation)
+        await self._touch_session(session_id, user_id, user_message, timestamp, model)
+        await rating_rollups.record_turns(self.db, [{"timestamp": timestamp, "model": model, "user_id": user_id}])
+        if search_index.is_enabled(self.db):
+            # Cần id của dòng mới để làm rowid trong chỉ mục tìm kiếm
+            await self.db.flush()
+            await search_index.add(self.db, conversation)
         return conversation
     
-    def get_conversation_history(self, session_id: str, user_id: int = None) -> List[Dict]:
+    async def get_conversation_history(self, session_id: str, user_id: int = None) -> List[Dict]:
         """
         Lấy lịch sử cuộc hội thoại theo session_id và user_id
         """
-        query = self.db.query(Conversation).filter(
+        query = self._history_query(session_id, user_id)
+        result = await self.db.execute(query.order_by(Conversation.timestamp, Conversation.id))
+        return [self._to_dict(conv) for conv in result.scalars().all()]
+    
+    async def get_recent_history(self, session_id: str, user_id: int = None, limit: int = 5, after_id: int = None) -> List[Dict]:
+        """
+        Lấy `limit` lượt hội thoại gần nhất (theo thứ tự thời gian) để dựng prompt,
+        chỉ tính các lượt sau `after_id` (các lượt trước đó đã nằm trong bản tóm tắt)
+        """
+        query = self._history_query(session_id, user_id)
+        if after_id is not None:
+            query = query.where(Conversation.id > after_id)
+        result = await self.db.execute(
+            query.order_by(Conversation.timestamp.desc(), Conversation.id.desc()).limit(limit)
+        )
+        conversations = result.scalars().all()
+        return [self._to_dict(conv) for conv in reversed(conversations)]
+    
+    async def get_history_page(self, session_id: str, user_id: int = None, limit: int = 100, cursor: int = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Lấy một trang lịch sử, `cursor` là id của lượt cuối cùng ở trang trước.
+        Trả về (danh sách, cursor của trang tiếp theo hoặc None)
+        """
+        query = self._history_query(session_id, user_id)
+        
+        if cursor is not None:
+            # Keyset pagination theo (timestamp, id) để dùng được index
+            cursor_timestamp = select(Conversation.timestamp).where(
+                Conversation.id == cursor
+            ).scalar_subquery()
+            query = query.where(or_(
+                Conversation.timestamp > cursor_timestamp,
+                and_(Conversation.timestamp == cursor_timestamp, Conversation.id > cursor)
+            ))
+        
+        result = await self.db.execute(
+            query.order_by(Conversation.timestamp, Conversation.id).limit(limit + 1)
+        )
+        conversations = result.scalars().all()
+        
+        next_cursor = None
+        if len(conversations) > limit:
+            conversations = conversations[:limit]
+            next_cursor = conversations[-1].id
+        
+        return [self._to_dict(conv) for conv in conversations], next_cursor
+    
+    def _history_query(self, session_id: str, user_id: int = None):
+        query = select(Conversation).where(
             Conversation.session_id == session_id
         )
         
         if user_id:
-            query = query.filter(Conversation.user_id == user_id)
-            
-        conversations = query.order_by(Conversation.timestamp).all()
+            query = query.where(Conversation.user_id == user_id)
         
-        return [
-            {
-                "id": conv.id,
-                "user_message": conv.user_message,
-                "bot_response": conv.bot_response,
-                "timestamp": conv.timestamp,
-                "rating": conv.rating,
-                "feedback": conv.feedback
+        return query
+    
+    @staticmethod
+    def _to_dict(conv: Conversation) -> Dict:
+        return {
+            "id": conv.id,
+            "user_message": conv.user_message,
+            "bot_response": conv.bot_response,
+            "timestamp": conv.timestamp,
+            "rating": conv.rating,
+            "feedback": conv.feedback,
+            "model": conv.model
+        }
+    
+    async def _touch_session(self, session_id: str, user_id: int, user_message: str, timestamp: datetime, model: str = None):
+        """
+        Tạo hoặc cập nhật dòng chat_sessions của session trong cùng transaction
+        """
+        insert = postgresql_insert if self.db.bind.dialect.name == "postgresql" else sqlite_insert
+        stmt = insert(ChatSession).values(
+            session_id=session_id,
+            user_id=user_id,
+            title=user_message[:SESSION_TITLE_LENGTH],
+            created_at=timestamp,
+            last_activity=timestamp,
+            turn_count=1,
+            model=model
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "session_id"],
+            set_={
+                "last_activity": stmt.excluded.last_activity,
+                "turn_count": ChatSession.turn_count + 1,
+                "model": stmt.excluded.model
             }
-            for conv in conversations
-        ]
+        )
+        await self.db.execute(stmt)
     
-    def get_all_sessions(self, user_id: int = None) -> List[Dict]:
+    async def get_session_model(self, session_id: str, user_id: int = None) -> Optional[str]:
         """
-        Lấy danh sách tất cả session_id của user
+        Model đã dùng ở lượt gần nhất của session, None nếu session chưa có hoặc chưa chọn model
         """
-        query = self.db.query(Conversation.session_id, Conversation.user_message, Conversation.timestamp).distinct(Conversation.session_id)
+        query = select(ChatSession.model).where(ChatSession.session_id == session_id)
         
         if user_id:
-            query = query.filter(Conversation.user_id == user_id)
-            
-        sessions = query.order_by(Conversation.timestamp.desc()).all()
+            query = query.where(ChatSession.user_id == user_id)
+        
+        result = await self.db.execute(query)
+        return result.scalars().first()
+    
+    async def get_session_summary(self, session_id: str, user_id: int = None) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Trả về (bản tóm tắt, id của lượt cuối đã được tóm tắt) của session
+        """
+        query = select(ChatSession.summary, ChatSession.summary_until_id).where(ChatSession.session_id == session_id)
+        
+        if user_id:
+            query = query.where(ChatSession.user_id == user_id)
+        
+        result = await self.db.execute(query)
+        row = result.first()
+        return (row.summary, row.summary_until_id) if row else (None, None)
+    
+    async def save_session_summary(self, session_id: str, user_id: int, summary: str, until_id: int, expected_until_id: Optional[int]) -> bool:
+        """
+        Lưu bản tóm tắt mới nếu session vẫn ở trạng thái `expected_until_id` (tránh ghi đè lẫn nhau)
+        """
+        condition = (
+            ChatSession.summary_until_id.is_(None) if expected_until_id is None
+            else ChatSession.summary_until_id == expected_until_id
+        )
+        result = await self.db.execute(
+            update(ChatSession)
+            .where(ChatSession.session_id == session_id, ChatSession.user_id == user_id, condition)
+            .values(summary=summary, summary_until_id=until_id)
+        )
+        await self.db.commit()
+        return result.rowcount > 0
+    
+    async def get_all_sessions(self, user_id: int = None, limit: int = 50, cursor: int = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Lấy danh sách session của user, mới hoạt động nhất trước, phân trang bằng cursor
+        (id của session cuối cùng ở trang trước). Trả về (danh sách, cursor tiếp theo hoặc None)
+        """
+        query = select(ChatSession)
+        
+        if user_id:
+            query = query.where(ChatSession.user_id == user_id)
+        
+        if cursor is not None:
+            cursor_activity = select(ChatSession.last_activity).where(
+                ChatSession.id == cursor
+            ).scalar_subquery()
+            query = query.where(or_(
+                ChatSession.last_activity < cursor_activity,
+                and_(ChatSession.last_activity == cursor_activity, ChatSession.id < cursor)
+            ))
+        
+        result = await self.db.execute(
+            query.order_by(ChatSession.last_activity.desc(), ChatSession.id.desc()).limit(limit + 1)
+        )
+        sessions = result.scalars().all()
+        
+        next_cursor = None
+        if len(sessions) > limit:
+            sessions = sessions[:limit]
+            next_cursor = sessions[-1].id
         
         return [
             {
-                "session_id": session[0],
-                "first_message": session[1][:50] + "..." if len(session[1]) > 50 else session[1],
-                "timestamp": session[2]
+                "session_id": session.session_id,
+                "first_message": session.title[:50] + "..." if len(session.title) > 50 else session.title,
+                "timestamp": session.last_activity,
+                "created_at": session.created_at,
+                "last_activity": session.last_activity,
+                "turn_count": session.turn_count,
+                "model": session.model
             }
             for session in sessions
+        ], next_cursor
+    
+    async def search_conversations(self, user_id: int, query: str, limit: int = 20, offset: int = 0, session_id: str = None, min_rating: float = None) -> List[Dict]:
+        """
+        Tìm trong lịch sử của user (không phân biệt dấu), xếp theo độ liên quan,
+        mỗi kết quả kèm đoạn trích và vị trí các từ khớp
+        """
+        if search_index.is_enabled(self.db):
+            hits = await search_index.search(self.db, user_id, query, limit, offset, session_id, min_rating)
+        else:
+            hits = await self._search_like(user_id, query, limit, offset, session_id, min_rating)
+        if not hits:
+            return []
+        
+        result = await self.db.execute(
+            select(Conversation).where(Conversation.id.in_([conversation_id for conversation_id, _ in hits]))
+        )
+        conversations = {conv.id: conv for conv in result.scalars().all()}
+        terms = search_index.query_terms(query)
+        
+        results = []
+        for conversation_id, score in hits:
+            conv = conversations.get(conversation_id)
+            if conv is None:
+                continue
+            # Ưu tiên trích từ câu trả lời, trừ khi chỉ câu hỏi chứa từ khóa
+            field = "bot_response"
+            snippet, highlights = search_index.make_snippet(conv.bot_response, terms)
+            if not highlights:
+                question_snippet, question_highlights = search_index.make_snippet(conv.user_message, terms)
+                if question_highlights:
+                    field, snippet, highlights = "user_message", question_snippet, question_highlights
+            results.append({
+                "conversation_id": conv.id,
+                "session_id": conv.session_id,
+                "timestamp": conv.timestamp,
+                "rating": conv.rating,
+                "score": score,
+                "field": field,
+                "snippet": snippet,
+                "highlights": highlights
+            })
+        return results
+    
+    async def _search_like(self, user_id: int, query: str, limit: int, offset: int, session_id: str = None, min_rating: float = None) -> List[Tuple[int, float]]:
+        """
+        Tìm bằng LIKE khi không có FTS5 (vd. PostgreSQL), không bỏ dấu và không xếp hạng
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        conditions = [
+            or_(Conversation.user_message.ilike(f"%{term}%"), Conversation.bot_response.ilike(f"%{term}%"))
+            for term in terms
         ]
+        stmt = select(Conversation.id).where(Conversation.user_id == user_id, *conditions)
+        if session_id:
+            stmt = stmt.where(Conversation.session_id == session_id)
+        if min_rating is not None:
+            stmt = stmt.where(Conversation.rating >= min_rating)
+        result = await self.db.execute(
+            stmt.order_by(Conversation.timestamp.desc(), Conversation.id.desc()).limit(limit).offset(offset)
+        )
+        return [(conversation_id, 0.0) for conversation_id in result.scalars().all()]
     
-    def rate_conversation(self, conversation_id: int, rating: float, feedback: str = None, user_id: int = None) -> bool:
+    async def rate_conversation(self, conversation_id: int, rating: float, feedback: str = None, user_id: int = None) -> bool:
         """
         Đánh giá một cuộc hội thoại
         """
-        query = self.db.query(Conversation).filter(
+        query = select(Conversation).where(
             Conversation.id == conversation_id
         )
         
         if user_id:
-            query = query.filter(Conversation.user_id == user_id)
+            query = query.where(Conversation.user_id == user_id)
             
-        conversation = query.first()
+        result = await self.db.execute(query)
+        conversation = result.scalars().first()
         
         if conversation:
+            # Số liệu thống kê tính đánh giá vào ngày được đánh giá, không phải ngày của lượt chat
+            rated_at = datetime.utcnow()
+            await rating_rollups.apply(self.db, rating_rollups.rating_change_deltas(conversation, rating, feedback, rated_at))
             conversation.rating = rating
             conversation.feedback = feedback
-            self.db.commit()
+            conversation.rated_at = rated_at
+            if search_index.is_enabled(self.db):
+                await search_index.update_rating(self.db, conversation.id, rating)
+            await self.db.commit()
             return True
         return False
     
-    def get_conversation_by_id(self, conversation_id: int) -> Conversation:
+    async def stream_conversations(self, user_id: int = None, session_id: str = None, min_rating: float = None, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[List[Dict]]:
+        """
+        Đọc các cuộc hội thoại theo id tăng dần qua server-side cursor (yield_per),
+        trả về từng batch dict để export mà không nạp toàn bộ vào bộ nhớ
+        """
+        # Chọn cột thay vì entity để các dòng không bị giữ lại trong identity map
+        query = select(
+            Conversation.id, Conversation.user_id, User.username, Conversation.session_id,
+            Conversation.timestamp, Conversation.model, Conversation.user_message,
+            Conversation.bot_response, Conversation.rating, Conversation.feedback, Conversation.rated_at
+        ).outerjoin(User, User.id == Conversation.user_id)
+        if user_id:
+            query = query.where(Conversation.user_id == user_id)
+        if session_id:
+            query = query.where(Conversation.session_id == session_id)
+        if min_rating is not None:
+            query = query.where(Conversation.rating >= min_rating)
+        
+        result = await self.db.stream(query.order_by(Conversation.id).execution_options(yield_per=batch_size))
+        async for rows in result.partitions():
+            yield [row._asdict() for row in rows]
+    
+    async def import_conversations(self, rows: List[Dict]) -> int:
+        """
+        Thêm một batch cuộc hội thoại (đã kiểm tra hợp lệ) bằng một lệnh insert nhiều dòng,
+        cập nhật chat_sessions và chỉ mục tìm kiếm trong cùng transaction
+        """
+        if not rows:
+            return 0
+        result = await self.db.execute(
+            insert(Conversation).returning(Conversation.id, sort_by_parameter_order=True),
+            rows
+        )
+        ids = result.scalars().all()
+        await self._touch_sessions_bulk(rows)
+        await rating_rollups.record_turns(self.db, rows)
+        if search_index.is_enabled(self.db):
+            await search_index.add_many(self.db, [
+                {**row, "id": conversation_id, "rating": row.get("rating")}
+                for row, conversation_id in zip(rows, ids)
+            ])
+        await self.db.commit()
+        return len(ids)
+    
+    async def _touch_sessions_bulk(self, rows: List[Dict]):
+        """
+        Cộng dồn các lượt được import vào chat_sessions, mỗi session một lệnh upsert
+        """
+        sessions: Dict[Tuple[int, str], Dict] = {}
+        for row in sorted(rows, key=lambda row: row["timestamp"]):
+            key = (row["user_id"], row["session_id"])
+            entry = sessions.get(key)
+            if entry is None:
+                sessions[key] = {
+                    "session_id": row["session_id"],
+                    "user_id": row["user_id"],
+                    "title": row["user_message"][:SESSION_TITLE_LENGTH],
+                    "created_at": row["timestamp"],
+                    "last_activity": row["timestamp"],
+                    "turn_count": 1,
+                    "model": row.get("model")
+                }
+            else:
+                entry["last_activity"] = row["timestamp"]
+                entry["turn_count"] += 1
+                entry["model"] = row.get("model") or entry["model"]
+        
+        insert_stmt = postgresql_insert if self.db.bind.dialect.name == "postgresql" else sqlite_insert
+        for values in sessions.values():
+            stmt = insert_stmt(ChatSession).values(**values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["user_id", "session_id"],
+                set_={
+                    # Dữ liệu import có thể cũ hơn các lượt đã có
+                    "created_at": case((stmt.excluded.created_at < ChatSession.created_at, stmt.excluded.created_at), else_=ChatSession.created_at),
+                    "last_activity": case((stmt.excluded.last_activity > ChatSession.last_activity, stmt.excluded.last_activity), else_=ChatSession.last_activity),
+                    "turn_count": ChatSession.turn_count + stmt.excluded.turn_count
+                }
+            )
+            await self.db.execute(stmt)
+    
+    async def get_conversation_by_id(self, conversation_id: int) -> Conversation:
         """
         Lấy cuộc hội thoại theo ID
         """
-        return self.db.query(Conversation).filter(
-            Conversation.id == conversation_id
-        ).first()
+        return await self.db.get(Conversation, conversation_id)
     
     def generate_session_id(self) -> str:
         """
@@ -101,20 +419,90 @@ class ConversationService:
         """
         return str(uuid.uuid4())
     
-    def delete_session(self, session_id: str, user_id: int = None) -> bool:
+    async def delete_session(self, session_id: str, user_id: int = None, archive=None) -> bool:
         """
-        Xóa toàn bộ cuộc hội thoại của một session
+        Xóa toàn bộ cuộc hội thoại của một session. `archive` (RetentionManager) xóa cả phần
+        đã lưu trữ: trừ khỏi số liệu thống kê và đánh dấu để bỏ khỏi file lưu trữ
         """
         try:
-            query = self.db.query(Conversation).filter(
-                Conversation.session_id == session_id
-            )
-            
+            # Trừ các lượt bị xóa khỏi số liệu thống kê (chỉ đọc các cột nhỏ, không đọc nội dung)
+            rollup_query = select(
+                Conversation.timestamp, Conversation.model, Conversation.user_id, Conversation.rating,
+                Conversation.feedback, Conversation.rated_at
+            ).where(Conversation.session_id == session_id)
             if user_id:
-                query = query.filter(Conversation.user_id == user_id)
-                
-            query.delete()
-            self.db.commit()
+                rollup_query = rollup_query.where(Conversation.user_id == user_id)
+            deleted = (await self.db.execute(rollup_query)).all()
+            await rating_rollups.record_turns(self.db, (row._asdict() for row in deleted if row.user_id is not None), sign=-1)
+            
+            await self.remove_session_rows(session_id, user_id)
+            if archive is not None:
+                await archive.remove_session(self.db, session_id, user_id)
+            await self.db.commit()
             return True
         except:
-            return False
\ No newline at end of file
+            await self.db.rollback()
+            return False
+    
+    async def remove_session_rows(self, session_id: str, user_id: int = None):
+        """
+        Xóa các dòng của session (hội thoại, chat_sessions, vector nhúng, chỉ mục tìm kiếm), chưa commit
+        """
+        query = delete(Conversation).where(
+            Conversation.session_id == session_id
+        )
+        
+        session_query = delete(ChatSession).where(
+            ChatSession.session_id == session_id
+        )
+        
+        embedding_query = delete(ConversationEmbedding).where(
+            ConversationEmbedding.session_id == session_id
+        )
+        
+        if user_id:
+            query = query.where(Conversation.user_id == user_id)
+            session_query = session_query.where(ChatSession.user_id == user_id)
+            embedding_query = embedding_query.where(ConversationEmbedding.user_id == user_id)
+        
+        if search_index.is_enabled(self.db):
+            await search_index.remove_session(self.db, session_id, user_id)
+        await self.db.execute(embedding_query)
+        await self.db.execute(query)
+        await self.db.execute(session_query)
+
+    async def remove_conversation_rows(self, session_id: str, user_id: int, conversation_ids: List[int]):
+        """
+        Xóa đúng các lượt đã cho (kèm vector nhúng, chỉ mục tìm kiếm), chưa commit.
+        Dòng chat_sessions chỉ bị xóa khi session không còn lượt nào, nên các lượt
+        được thêm sau khi chọn danh sách id vẫn giữ nguyên session của chúng
+        """
+        if not conversation_ids:
+            return
+        if search_index.is_enabled(self.db):
+            await search_index.remove_conversations(self.db, conversation_ids)
+        await self.db.execute(delete(ConversationEmbedding).where(
+            ConversationEmbedding.conversation_id.in_(conversation_ids)
+        ))
+        await self.db.execute(delete(Conversation).where(
+            Conversation.id.in_(conversation_ids)
+        ))
+        remaining = select(Conversation.id).where(
+            Conversation.session_id == session_id,
+            Conversation.user_id == user_id
+        ).exists()
+        await self.db.execute(delete(ChatSession).where(
+            ChatSession.session_id == session_id,
+            ChatSession.user_id == user_id,
+            ~remaining
+        ))
+
+async def _apply_conversation(db: AsyncSession, item: Tuple) -> Conversation:
+    return await ConversationService(db)._add_conversation(*item)
+
+conversation_write_queue = WriteBehindQueue(
+    AsyncSessionLocal,
+    _apply_conversation,
+    batch_size=DB_WRITE_BATCH_SIZE,
+    max_delay=DB_WRITE_MAX_DELAY_MS / 1000
+) if DB_WRITE_BEHIND else None
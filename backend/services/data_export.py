@@ -0,0 +1,130 @@
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+import csv
+import io
+import json
+
+# Thứ tự cột khi export; import đọc cùng các tên cột này
+EXPORT_FIELDS = ["id", "user_id", "username", "session_id", "timestamp", "model", "user_message", "bot_response", "rating", "feedback", "rated_at"]
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+# Số dòng mỗi lần insert khi import
+IMPORT_BATCH_SIZE = 500
+# Số lỗi tối đa trả về trong kết quả import (các lỗi sau chỉ được đếm)
+IMPORT_MAX_ERRORS = 50
+
+def _serialize(row: Dict) -> Dict:
+    row = dict(row)
+    for field in ("timestamp", "rated_at"):
+        if isinstance(row.get(field), datetime):
+            row[field] = row[field].isoformat()
+    return row
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        # Database lưu giờ UTC không kèm múi giờ
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    return timestamp
+
+async def format_ndjson(batches: AsyncIterator[List[Dict]]) -> AsyncIterator[str]:
+    """
+    Mỗi batch thành một chunk gồm các dòng JSON
+    """
+    async for batch in batches:
+        yield "".join(json.dumps(_serialize(row), ensure_ascii=False) + "\n" for row in batch)
+
+async def format_csv(batches: AsyncIterator[List[Dict]]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    async for batch in batches:
+        writer.writerows(_serialize(row) for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def read_records(stream: TextIO, fmt: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Đọc từng bản ghi từ file import, trả về (số dòng, dict hoặc None, lỗi hoặc None)
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, None, f"JSON không hợp lệ: {e.msg}"
+            continue
+        if not isinstance(record, dict):
+            yield line_number, None, "Mỗi dòng phải là một object JSON"
+            continue
+        yield line_number, record, None
+
+def _text_field(record: Dict, field: str) -> Optional[str]:
+    """
+    Giá trị chuỗi của một trường (None nếu không có), ValueError nếu sai kiểu (vd. số hoặc object trong NDJSON)
+    """
+    value = record.get(field)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"{field} phải là chuỗi")
+    return value
+
+def to_conversation_row(record: Dict, user_id: int) -> Dict:
+    """
+    Chuyển bản ghi import thành giá trị cột của bảng conversations, ValueError nếu thiếu
+    hoặc sai kiểu dữ liệu. id cũ không được giữ lại để tránh trùng với dữ liệu đang có
+    """
+    session_id = (_text_field(record, "session_id") or "").strip()
+    user_message = _text_field(record, "user_message")
+    bot_response = _text_field(record, "bot_response")
+    if not session_id or not user_message or bot_response is None:
+        raise ValueError("Thiếu session_id, user_message hoặc bot_response")
+
+    timestamp = _parse_timestamp(_text_field(record, "timestamp")) or datetime.utcnow()
+
+    rating = record.get("rating")
+    if isinstance(rating, bool) or not isinstance(rating, (int, float, str, type(None))):
+        raise ValueError("rating phải là số")
+    rating = float(rating) if rating not in (None, "") else None
+    if rating is not None and not 1 <= rating <= 5:
+        raise ValueError("rating phải nằm trong khoảng 1-5")
+    feedback = _text_field(record, "feedback") or None
+    # Đánh giá không rõ thời điểm thì coi như được đánh giá cùng lúc với lượt chat
+    rated_at = None
+    if rating is not None or feedback:
+        rated_at = _parse_timestamp(_text_field(record, "rated_at")) or timestamp
+
+    return {
+        "session_id": session_id,
+        "user_id": user_id,
+        "user_message": user_message,
+        "bot_response": bot_response,
+        "timestamp": timestamp,
+        "rating": rating,
+        "feedback": feedback,
+        "model": _text_field(record, "model") or None,
+        "rated_at": rated_at,
+    }
+
+def batched(records: Iterable, size: int = IMPORT_BATCH_SIZE) -> Iterator[List]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,260 @@
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, Deque, Set
+import asyncio
+import math
+import time
+import os
+import uuid
+
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "2"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "32"))
+SCHEDULER_MAX_PER_USER = int(os.getenv("SCHEDULER_MAX_PER_USER", "1"))
+SCHEDULER_MAX_QUEUED_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUED_PER_USER", "2"))
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "30"))
+# Khi chạy nhiều worker với shared state, lượt chạy được giữ bằng lease; lease của worker
+# chết giữa chừng tự hết hạn sau khoảng này (giây), nên phải dài hơn một lượt sinh
+SCHEDULER_LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", "600"))
+
+# Hệ số làm mượt cho trung bình động của thời gian chờ và thời gian xử lý
+EMA_ALPHA = 0.2
+
+class SchedulerFull(Exception):
+    """
+    Scheduler từ chối request: 429 khi user vượt giới hạn riêng, 503 khi hàng đợi chung đầy
+    """
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class Ticket:
+    """
+    Quyền chạy một lượt suy luận, trả lại bằng InferenceScheduler.release()
+    """
+    def __init__(self, model: str, user_id: int):
+        self.model = model
+        self.user_id = user_id
+        self.started_at = time.monotonic()
+        self.released = False
+        self.lease_owner = uuid.uuid4().hex
+
+class _ModelState:
+    def __init__(self):
+        self.active = 0
+        self.active_by_user: Dict[int, int] = {}
+        # user_id -> các request đang chờ; thứ tự key là thứ tự round-robin giữa các user
+        self.waiters: "OrderedDict[int, Deque[asyncio.Future]]" = OrderedDict()
+        self.queued = 0
+        self.avg_wait = 0.0
+        self.avg_service = 0.0
+        self.completed = 0
+        self.rejected = 0
+
+class InferenceScheduler:
+    """
+    Giới hạn số request đồng thời tới Ollama theo từng model, xếp hàng có giới hạn
+    và chia lượt công bằng giữa các user (round-robin). Với shared state dùng chung
+    (nhiều worker), giới hạn theo model và theo user được áp dụng trên toàn bộ worker
+    bằng lease, hàng đợi công bằng vẫn nằm trong từng worker
+    """
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        max_per_user: int = SCHEDULER_MAX_PER_USER,
+        max_queued_per_user: int = SCHEDULER_MAX_QUEUED_PER_USER,
+        max_wait: float = SCHEDULER_MAX_WAIT,
+        shared=None,
+        lease_ttl: float = SCHEDULER_LEASE_TTL
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait = max_wait
+        self._models: Dict[str, _ModelState] = {}
+        # Backend local chỉ thấy process hiện tại, giới hạn cục bộ ở trên đã đủ
+        self.shared = shared if shared is not None and shared.distributed else None
+        self.lease_ttl = lease_ttl
+        self._release_tasks: Set[asyncio.Task] = set()
+
+    def _state(self, model: str) -> _ModelState:
+        if model not in self._models:
+            self._models[model] = _ModelState()
+        return self._models[model]
+
+    async def acquire(self, model: str, user_id: int) -> Ticket:
+        """
+        Chờ tới lượt chạy, raise SchedulerFull nếu hàng đợi đầy hoặc chờ quá lâu
+        """
+        state = self._state(model)
+        enqueued_at = time.monotonic()
+
+        # Sau mỗi lần _dispatch, nếu còn slot trống thì không còn ai trong hàng đợi chạy được,
+        # nên request mới có thể chạy ngay mà không vượt lượt người khác
+        if state.active < self.max_concurrency and self._user_can_run(state, user_id):
+            self._grant(state, user_id)
+            return await self._acquire_shared(Ticket(model, user_id), enqueued_at)
+
+        if state.queued >= self.max_queue:
+            state.rejected += 1
+            raise SchedulerFull(503, "Hệ thống đang quá tải, vui lòng thử lại sau", self._retry_after(state))
+        user_queue = state.waiters.get(user_id)
+        if user_queue is not None and len(user_queue) >= self.max_queued_per_user:
+            state.rejected += 1
+            raise SchedulerFull(429, "Bạn đang gửi quá nhiều tin nhắn cùng lúc", self._retry_after(state))
+
+        future = asyncio.get_running_loop().create_future()
+        state.waiters.setdefault(user_id, deque()).append(future)
+        state.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Đã được cấp lượt đúng lúc request bị hủy: trả lại ngay
+                self.release(Ticket(model, user_id))
+            else:
+                future.cancel()
+                self._remove_waiter(state, user_id, future)
+            if isinstance(e, asyncio.TimeoutError):
+                state.rejected += 1
+                raise SchedulerFull(503, "Hệ thống đang quá tải, vui lòng thử lại sau", self._retry_after(state))
+            raise
+
+        ticket = await self._acquire_shared(Ticket(model, user_id), enqueued_at)
+        wait = time.monotonic() - enqueued_at
+        state.avg_wait = (1 - EMA_ALPHA) * state.avg_wait + EMA_ALPHA * wait
+        return ticket
+
+    async def _acquire_shared(self, ticket: Ticket, enqueued_at: float) -> Ticket:
+        """
+        Sau khi có lượt trong worker, giữ thêm lease dùng chung theo model và theo user.
+        Hết thời gian chờ thì trả lại lượt cục bộ và báo quá tải
+        """
+        if self.shared is None:
+            return ticket
+        deadline = enqueued_at + self.max_wait
+        delay = 0.02
+        try:
+            while True:
+                if await self.shared.acquire_lease(self._lease_name(ticket.model), ticket.lease_owner, self.max_concurrency, self.lease_ttl):
+                    if await self.shared.acquire_lease(self._lease_name(ticket.model, ticket.user_id), ticket.lease_owner, self.max_per_user, self.lease_ttl):
+                        return ticket
+                    # User đang chạy ở worker khác: nhường slot của model trong lúc chờ
+                    await self.shared.release_lease(self._lease_name(ticket.model), ticket.lease_owner)
+                if time.monotonic() + delay > deadline:
+                    break
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.25)
+        except BaseException:
+            self.release(ticket)
+            raise
+        self.release(ticket)
+        state = self._state(ticket.model)
+        state.rejected += 1
+        raise SchedulerFull(503, "Hệ thống đang quá tải, vui lòng thử lại sau", self._retry_after(state))
+
+    @staticmethod
+    def _lease_name(model: str, user_id: int = None) -> str:
+        return f"scheduler:{model}" if user_id is None else f"scheduler:{model}:user:{user_id}"
+
+    async def _release_shared(self, ticket: Ticket):
+        try:
+            await self.shared.release_lease(self._lease_name(ticket.model, ticket.user_id), ticket.lease_owner)
+            await self.shared.release_lease(self._lease_name(ticket.model), ticket.lease_owner)
+        except Exception as e:
+            # Lease sẽ tự hết hạn sau lease_ttl
+            print(f"Error releasing scheduler lease: {e}")
+
+    def release(self, ticket: Ticket):
+        """
+        Trả lại lượt chạy và chuyển lượt cho request tiếp theo trong hàng đợi
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        state = self._state(ticket.model)
+        state.active -= 1
+        remaining = state.active_by_user.get(ticket.user_id, 0) - 1
+        if remaining > 0:
+            state.active_by_user[ticket.user_id] = remaining
+        else:
+            state.active_by_user.pop(ticket.user_id, None)
+
+        service = time.monotonic() - ticket.started_at
+        state.avg_service = (1 - EMA_ALPHA) * state.avg_service + EMA_ALPHA * service
+        state.completed += 1
+        self._dispatch(state)
+        if self.shared is not None:
+            task = asyncio.get_running_loop().create_task(self._release_shared(ticket))
+            self._release_tasks.add(task)
+            task.add_done_callback(self._release_tasks.discard)
+
+    @asynccontextmanager
+    async def slot(self, model: str, user_id: int):
+        ticket = await self.acquire(model, user_id)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict:
+        """
+        Độ sâu hàng đợi, số request đang chạy và thời gian chờ trung bình theo model
+        """
+        return {
+            model: {
+                "active": state.active,
+                "queued": state.queued,
+                "waiting_users": len(state.waiters),
+                "avg_wait_seconds": round(state.avg_wait, 3),
+                "avg_service_seconds": round(state.avg_service, 3),
+                "completed": state.completed,
+                "rejected": state.rejected
+            }
+            for model, state in self._models.items()
+        }
+
+    def _user_can_run(self, state: _ModelState, user_id: int) -> bool:
+        return state.active_by_user.get(user_id, 0) < self.max_per_user
+
+    def _grant(self, state: _ModelState, user_id: int):
+        state.active += 1
+        state.active_by_user[user_id] = state.active_by_user.get(user_id, 0) + 1
+
+    def _dispatch(self, state: _ModelState):
+        """
+        Cấp lượt cho các user đang chờ theo vòng, bỏ qua user đã dùng hết lượt riêng
+        """
+        while state.active < self.max_concurrency:
+            user_id = next((uid for uid in state.waiters if self._user_can_run(state, uid)), None)
+            if user_id is None:
+                return
+            user_queue = state.waiters.pop(user_id)
+            future = user_queue.popleft()
+            state.queued -= 1
+            if user_queue:
+                # Đưa user xuống cuối vòng để user khác được phục vụ trước
+                state.waiters[user_id] = user_queue
+            if future.done():
+                continue
+            self._grant(state, user_id)
+            future.set_result(None)
+
+    def _remove_waiter(self, state: _ModelState, user_id: int, future: asyncio.Future):
+        user_queue = state.waiters.get(user_id)
+        if user_queue is None or future not in user_queue:
+            return
+        user_queue.remove(future)
+        state.queued -= 1
+        if not user_queue:
+            del state.waiters[user_id]
+
+    def _retry_after(self, state: _ModelState) -> int:
+        """
+        Ước lượng số giây nên chờ trước khi thử lại dựa trên thời gian xử lý trung bình
+        """
+        per_slot = state.avg_service or 1.0
+        return max(1, math.ceil(per_slot * (state.queued + 1) / self.max_concurrency))
@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import Conversation, ConversationEmbedding
+from typing import Callable, Dict, List, Optional, Tuple
+from array import array
+import asyncio
+import math
+import operator
+import os
+
+try:
+    import numpy as np
+except ImportError:  # numpy là tùy chọn, không có thì tính bằng Python thuần
+    np = None
+
+# Bật trí nhớ dài hạn: nhúng các lượt chat cũ và đưa lượt liên quan nhất vào prompt
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "0") == "1"
+MEMORY_EMBED_MODEL = os.getenv("MEMORY_EMBED_MODEL", "nomic-embed-text")
+# Phạm vi tìm kiếm: session (chỉ session hiện tại) hoặc user (mọi session của user)
+MEMORY_SCOPE = os.getenv("MEMORY_SCOPE", "session")
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+# Độ tương đồng cosine tối thiểu để một lượt cũ được coi là liên quan
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.35"))
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "16"))
+MEMORY_MAX_DELAY_MS = float(os.getenv("MEMORY_MAX_DELAY_MS", "500"))
+# Thời gian tối đa chờ nhúng câu hỏi trên đường request, quá thì bỏ qua trí nhớ
+MEMORY_QUERY_TIMEOUT = float(os.getenv("MEMORY_QUERY_TIMEOUT", "2"))
+# Số tập vector (theo session hoặc user) giữ trong bộ nhớ
+MEMORY_CACHE_KEYS = int(os.getenv("MEMORY_CACHE_KEYS", "1000"))
+# Độ dài tối đa của đoạn văn bản đem đi nhúng
+MEMORY_MAX_TEXT_CHARS = 2000
+
+def _normalize(vector: List[float]) -> array:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array("f", (x / norm for x in vector))
+
+class VectorSet:
+    """
+    Các vector đã chuẩn hóa của một session/user, tìm top-k bằng tích vô hướng
+    (vector hóa bằng numpy nếu có)
+    """
+    def __init__(self):
+        self.ids: List[int] = []
+        self.last_id = 0
+        self._rows: List[array] = []
+        self._matrix = None
+
+    def add(self, conversation_id: int, vector: array):
+        self.ids.append(conversation_id)
+        self._rows.append(vector)
+        self._matrix = None
+        self.last_id = max(self.last_id, conversation_id)
+
+    def top_k(self, query: array, k: int, exclude: set = frozenset(), min_score: float = -1.0) -> List[Tuple[int, float]]:
+        if not self.ids:
+            return []
+        if np is not None:
+            if self._matrix is None or len(self._matrix) != len(self._rows):
+                self._matrix = np.vstack([np.frombuffer(row, dtype=np.float32) for row in self._rows])
+            scores = self._matrix @ np.frombuffer(query, dtype=np.float32)
+            order = np.argsort(-scores)
+            ranked = ((self.ids[i], float(scores[i])) for i in order)
+        else:
+            scores = [sum(map(operator.mul, row, query)) for row in self._rows]
+            ranked = sorted(zip(self.ids, scores), key=lambda item: -item[1])
+        results = []
+        for conversation_id, score in ranked:
+            if score < min_score or len(results) >= k:
+                break
+            if conversation_id not in exclude:
+                results.append((conversation_id, score))
+        return results
+
+class MemoryIndex:
+    """
+    Trí nhớ dài hạn: nhúng các lượt chat ở nền (gom batch) qua Ollama, lưu vector vào
+    bảng conversation_embeddings và tìm các lượt cũ liên quan tới tin nhắn hiện tại
+    """
+    def __init__(self, ollama_service, session_factory: Callable[[], AsyncSession], model: str = MEMORY_EMBED_MODEL, scope: str = MEMORY_SCOPE):
+        self.service = ollama_service
+        self.session_factory = session_factory
+        self.model = model
+        self.scope = scope
+        self.top_k = MEMORY_TOP_K
+        self.min_score = MEMORY_MIN_SCORE
+        self.batch_size = MEMORY_BATCH_SIZE
+        self.max_delay = MEMORY_MAX_DELAY_MS / 1000
+        self._sets: "OrderedDict[Tuple, VectorSet]" = OrderedDict()
+        self._queue: "asyncio.Queue[Optional[Tuple]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Nhúng nốt các lượt còn trong hàng đợi rồi dừng
+        """
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit(self, conversation: Conversation):
+        """
+        Đưa lượt chat vừa lưu vào hàng đợi nhúng, không chờ kết quả
+        """
+        text = f"Người dùng: {conversation.user_message}\nAI: {conversation.bot_response}"
+        self._queue.put_nowait((conversation.id, conversation.user_id, conversation.session_id, text[:MEMORY_MAX_TEXT_CHARS]))
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        response = await self.service._post("/api/embed", {"model": self.model, "input": texts})
+        if response.status_code == 404:
+            # Bản Ollama cũ chỉ có /api/embeddings, mỗi lần một đoạn
+            results = []
+            for text in texts:
+                single = await self.service._post("/api/embeddings", {"model": self.model, "prompt": text})
+                single.raise_for_status()
+                results.append(single.json()["embedding"])
+            return results
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            stopping = False
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            try:
+                await self._store(batch)
+            except Exception as e:
+                print(f"Error embedding conversations: {e}")
+            if stopping:
+                return
+
+    async def _store(self, batch: List[Tuple]):
+        vectors = await self.embed([text for _, _, _, text in batch])
+        async with self.session_factory() as db:
+            for (conversation_id, user_id, session_id, _), vector in zip(batch, vectors):
+                db.add(ConversationEmbedding(
+                    conversation_id=conversation_id,
+                    user_id=user_id,
+                    session_id=session_id,
+                    model=self.model,
+                    vector=_normalize(vector).tobytes()
+                ))
+            await db.commit()
+
+    def _key(self, user_id: int, session_id: str) -> Tuple:
+        return (user_id,) if self.scope == "user" else (user_id, session_id)
+
+    async def _vector_set(self, db: AsyncSession, user_id: int, session_id: str) -> VectorSet:
+        """
+        Lấy tập vector từ cache, bổ sung các vector mới hơn từ database (có thể do worker khác ghi)
+        """
+        key = self._key(user_id, session_id)
+        vector_set = self._sets.get(key)
+        if vector_set is None:
+            vector_set = VectorSet()
+            self._sets[key] = vector_set
+            while len(self._sets) > MEMORY_CACHE_KEYS:
+                self._sets.popitem(last=False)
+        self._sets.move_to_end(key)
+
+        query = select(ConversationEmbedding.conversation_id, ConversationEmbedding.vector).where(
+            ConversationEmbedding.user_id == user_id,
+            ConversationEmbedding.model == self.model,
+            ConversationEmbedding.conversation_id > vector_set.last_id
+        )
+        if self.scope != "user":
+            query = query.where(ConversationEmbedding.session_id == session_id)
+        result = await db.execute(query.order_by(ConversationEmbedding.conversation_id))
+        for conversation_id, blob in result.all():
+            vector = array("f")
+            vector.frombytes(blob)
+            vector_set.add(conversation_id, vector)
+        return vector_set
+
+    async def recall(self, db: AsyncSession, user_id: int, session_id: str, message: str, exclude_ids: List[int] = ()) -> List[Dict]:
+        """
+        Các lượt cũ liên quan nhất tới tin nhắn (theo thứ tự thời gian), bỏ qua các lượt
+        đã có trong lịch sử gần đây. Lỗi hoặc quá thời gian thì trả về danh sách rỗng
+        """
+        try:
+            vector_set = await self._vector_set(db, user_id, session_id)
+            if not vector_set.ids:
+                return []
+            embeddings = await asyncio.wait_for(self.embed([message]), MEMORY_QUERY_TIMEOUT)
+            hits = vector_set.top_k(_normalize(embeddings[0]), self.top_k, set(exclude_ids), self.min_score)
+            if not hits:
+                return []
+            result = await db.execute(
+                select(Conversation).where(
+                    Conversation.id.in_([conversation_id for conversation_id, _ in hits]),
+                    Conversation.user_id == user_id
+                ).order_by(Conversation.timestamp, Conversation.id)
+            )
+            return [
+                {
+                    "id": conv.id,
+                    "user_message": conv.user_message,
+                    "bot_response": conv.bot_response,
+                    "timestamp": conv.timestamp
+                }
+                for conv in result.scalars().all()
+            ]
+        except Exception as e:
+            print(f"Error recalling memory: {e}")
+            return []
+
+    def invalidate(self, user_id: int, session_id: str = None):
+        """
+        Bỏ tập vector trong cache (vd. sau khi xóa session) để lần sau nạp lại từ database
+        """
+        self._sets.pop(self._key(user_id, session_id), None)
+
+    def stats(self) -> Dict:
+        return {
+            "model": self.model,
+            "scope": self.scope,
+            "cached_sets": len(self._sets),
+            "pending": self._queue.qsize(),
+            "numpy": np is not None,
+        }
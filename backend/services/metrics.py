@@ -0,0 +1,132 @@
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from contextlib import contextmanager
+import time
+import os
+
+# Khi chạy nhiều worker, mỗi worker ghi metrics vào thư mục này và /metrics gộp lại từ mọi worker
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Bucket cho các thao tác nhanh (DB, dựng prompt) và các thao tác chậm (chờ model)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Thời gian xử lý request HTTP (tới khi gửi header)",
+    ["method", "route", "status"],
+    buckets=SLOW_BUCKETS
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "Số request HTTP đang được xử lý",
+    ["method"],
+    multiprocess_mode="livesum"
+)
+
+CHAT_PHASE_DURATION = Histogram(
+    "chat_phase_duration_seconds",
+    "Thời gian từng giai đoạn của một lượt chat",
+    ["phase"],  # history_load, memory_recall, queue_wait, prompt_build, ollama_wait, persist
+    buckets=FAST_BUCKETS + SLOW_BUCKETS[6:]
+)
+CHAT_TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Thời gian từ lúc gửi request tới Ollama tới khi nhận token đầu tiên",
+    ["mode"],  # stream: đo tới chunk đầu tiên, blocking: load_duration + prompt_eval_duration của Ollama
+    buckets=SLOW_BUCKETS
+)
+CHAT_GENERATIONS_IN_PROGRESS = Gauge(
+    "chat_generations_in_progress",
+    "Số lượt sinh câu trả lời đang chờ Ollama",
+    multiprocess_mode="livesum"
+)
+
+OLLAMA_TOKENS_PER_SECOND = Histogram(
+    "ollama_tokens_per_second",
+    "Tốc độ sinh token theo eval_count/eval_duration của Ollama",
+    ["model"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+)
+OLLAMA_PROMPT_TOKENS = Histogram(
+    "ollama_prompt_tokens",
+    "Số token prompt (ước lượng khi dựng prompt)",
+    ["model"],
+    buckets=(64, 128, 256, 512, 768, 1024, 1536, 2048, 4096)
+)
+OLLAMA_REQUESTS = Counter(
+    "ollama_requests_total",
+    "Số request gửi tới Ollama theo kết quả",
+    ["model", "outcome"]  # ok, error, cache_hit
+)
+
+@contextmanager
+def track_phase(phase: str):
+    """
+    Đo thời gian một giai đoạn của lượt chat
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        CHAT_PHASE_DURATION.labels(phase=phase).observe(time.perf_counter() - start)
+
+def observe_ollama_result(model: str, result: dict):
+    """
+    Ghi tốc độ sinh token từ các trường thống kê trong kết quả cuối của Ollama
+    """
+    eval_count = result.get("eval_count")
+    eval_duration = result.get("eval_duration")  # nano giây
+    if eval_count and eval_duration:
+        OLLAMA_TOKENS_PER_SECOND.labels(model=model).observe(eval_count / (eval_duration / 1e9))
+
+def observe_blocking_first_token(result: dict):
+    """
+    Lượt sinh không stream không có chunk đầu tiên để đo: ước lượng TTFT bằng thời gian
+    nạp model và xử lý prompt mà Ollama báo trong kết quả (không gồm thời gian mạng)
+    """
+    load_duration = result.get("load_duration")  # nano giây
+    prompt_eval_duration = result.get("prompt_eval_duration")
+    if load_duration is None and prompt_eval_duration is None:
+        return
+    CHAT_TIME_TO_FIRST_TOKEN.labels(mode="blocking").observe(((load_duration or 0) + (prompt_eval_duration or 0)) / 1e9)
+
+class SchedulerCollector:
+    """
+    Xuất trạng thái hàng đợi của InferenceScheduler tại thời điểm scrape
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def collect(self):
+        active = GaugeMetricFamily("scheduler_active", "Số request đang chạy theo model", labels=["model"])
+        queued = GaugeMetricFamily("scheduler_queue_depth", "Số request đang chờ theo model", labels=["model"])
+        wait = GaugeMetricFamily("scheduler_avg_wait_seconds", "Thời gian chờ trung bình theo model", labels=["model"])
+        for model, stats in self.scheduler.stats().items():
+            active.add_metric([model], stats["active"])
+            queued.add_metric([model], stats["queued"])
+            wait.add_metric([model], stats["avg_wait_seconds"])
+        yield active
+        yield queued
+        yield wait
+
+def register_scheduler(scheduler):
+    REGISTRY.register(SchedulerCollector(scheduler))
+
+def render_metrics():
+    """
+    Trả về (nội dung, content type) theo định dạng text của Prometheus
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Gộp metrics của mọi worker; trạng thái scheduler chỉ có trong từng worker nên không xuất ở chế độ này
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+def mark_process_dead():
+    """
+    Gọi khi worker dừng để gauge "livesum" không còn tính worker này
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
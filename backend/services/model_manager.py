@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional, Set
+import asyncio
+import os
+import time
+
+# Các model luôn được giữ nóng: nạp sẵn khi khởi động và không bị unload khi rảnh
+OLLAMA_PRELOAD_MODELS = [m.strip() for m in os.getenv("OLLAMA_PRELOAD_MODELS", "").split(",") if m.strip()]
+# Model không được dùng trong khoảng này (giây) sẽ bị unload để nhường bộ nhớ
+OLLAMA_MODEL_IDLE_TIMEOUT = float(os.getenv("OLLAMA_MODEL_IDLE_TIMEOUT", "900"))
+# Số model tối đa cùng nằm trong bộ nhớ của một node
+OLLAMA_MAX_LOADED_MODELS = int(os.getenv("OLLAMA_MAX_LOADED_MODELS", "2"))
+# Danh sách model người dùng được chọn. Để trống thì cho phép mọi model mà các node đã pull
+OLLAMA_ALLOWED_MODELS = [m.strip() for m in os.getenv("OLLAMA_ALLOWED_MODELS", "").split(",") if m.strip()]
+
+class ModelManager:
+    """
+    Theo dõi model nào đang nạp trên từng node (qua /api/ps), nạp sẵn và giữ nóng
+    các model hay dùng, unload các model rảnh để tránh swap model giữa chừng
+    """
+    def __init__(self, ollama_service, preload_models: List[str] = None, shared=None):
+        self.service = ollama_service
+        # Shared state để đồng bộ thời điểm dùng model giữa các worker; backend local thì không cần
+        self.shared = shared if shared is not None and shared.distributed else None
+        self.pinned = list(preload_models if preload_models is not None else OLLAMA_PRELOAD_MODELS or [ollama_service.model])
+        self.idle_timeout = OLLAMA_MODEL_IDLE_TIMEOUT
+        self.max_loaded = OLLAMA_MAX_LOADED_MODELS
+        self.allowed = set(OLLAMA_ALLOWED_MODELS)
+        self.last_used: Dict[str, float] = {}
+        # Model do chính ứng dụng nạp (qua request hoặc preload); chỉ những model này mới bị unload,
+        # model do client khác nạp lên cùng node Ollama được để nguyên
+        self.owned: Set[str] = set()
+        self.cold_starts = 0
+
+    def touch(self, model: str):
+        self.last_used[model] = time.time()
+        self.owned.add(model)
+
+    def keep_alive_for(self, model: str):
+        """
+        Giá trị keep_alive gửi kèm request: model được ghim thì giữ vô thời hạn
+        """
+        return -1 if model in self.pinned else self.service.keep_alive
+
+    def is_allowed(self, model: str) -> bool:
+        if model == self.service.model or model in self.pinned:
+            return True
+        if self.allowed:
+            return model in self.allowed
+        backends = self.service.pool.backends
+        # Chưa có thông tin model từ health check thì để Ollama tự báo lỗi
+        if not any(backend.available_models for backend in backends):
+            return True
+        return any(model in backend.available_models for backend in backends)
+
+    def is_loaded(self, model: str) -> bool:
+        return any(model in backend.loaded_models for backend in self.service.pool.backends if backend.healthy)
+
+    def record_request(self, model: str):
+        """
+        Gọi trước mỗi lượt sinh: ghi nhận lần dùng và đếm các lượt phải nạp model từ đầu
+        """
+        if not self.is_loaded(model):
+            self.cold_starts += 1
+        self.touch(model)
+
+    async def refresh(self):
+        """
+        Cập nhật danh sách model đang nạp của từng node từ /api/ps
+        """
+        async def refresh_backend(backend):
+            try:
+                response = await self.service.client.get(backend.url("/api/ps"), timeout=5.0)
+                if response.status_code == 200:
+                    backend.loaded_models = {m["name"] for m in response.json().get("models", [])}
+            except Exception as e:
+                print(f"Error listing loaded models on {backend.base_url}: {e}")
+
+        await asyncio.gather(*(refresh_backend(b) for b in self.service.pool.backends if b.healthy))
+
+    async def preload(self, model: str) -> bool:
+        """
+        Nạp model vào bộ nhớ (request không có prompt) trên node phù hợp nhất
+        """
+        try:
+            response = await self.service._post("/api/generate", {
+                "model": model,
+                "keep_alive": self.keep_alive_for(model)
+            })
+            if response.status_code == 200:
+                self.touch(model)
+                return True
+            return False
+        except Exception as e:
+            print(f"Error preloading model {model}: {e}")
+            return False
+
+    async def unload(self, model: str, backend) -> bool:
+        try:
+            response = await self.service.client.post(
+                backend.url("/api/generate"), json={"model": model, "keep_alive": 0}, timeout=10.0
+            )
+            if response.status_code == 200:
+                backend.loaded_models.discard(model)
+                return True
+        except Exception as e:
+            print(f"Error unloading model {model} on {backend.base_url}: {e}")
+        return False
+
+    async def maintain(self):
+        """
+        Một vòng quản lý: unload model rảnh hoặc vượt giới hạn, rồi nạp lại model được ghim
+        """
+        await self.refresh()
+        await self._sync_last_used()
+        now = time.time()
+        for backend in self.service.pool.backends:
+            # Model mới thấy lần đầu được tính thời gian rảnh từ bây giờ, không bị coi là rảnh từ lâu
+            for model in backend.loaded_models:
+                self.last_used.setdefault(model, now)
+        for backend in self.service.pool.backends:
+            if not backend.healthy:
+                continue
+            # Model dùng lâu nhất trước đứng đầu danh sách ứng viên unload
+            candidates = sorted(
+                (m for m in backend.loaded_models if m in self.owned and m not in self.pinned),
+                key=lambda m: self.last_used.get(m, 0)
+            )
+            excess = len(backend.loaded_models) - self.max_loaded
+            for model in candidates:
+                idle = now - self.last_used.get(model, 0) > self.idle_timeout
+                if idle or excess > 0:
+                    if await self.unload(model, backend):
+                        excess -= 1
+
+        for model in self.pinned:
+            if not self.is_loaded(model) and self.is_allowed(model):
+                await self.preload(model)
+
+    async def _sync_last_used(self):
+        """
+        Gộp thời điểm dùng gần nhất của từng model giữa các worker, để một worker không
+        unload model mà worker khác vẫn đang dùng
+        """
+        if self.shared is None:
+            return
+        models = set(self.owned)
+        for backend in self.service.pool.backends:
+            models |= backend.loaded_models
+        for model in models:
+            key = f"model:last_used:{model}"
+            try:
+                remote = float(await self.shared.get(key) or 0)
+                # Chỉ chia sẻ lần dùng thật, không chia sẻ thời điểm mới thấy model trên node
+                local = self.last_used.get(model, 0) if model in self.owned else 0
+                if local > remote:
+                    await self.shared.set(key, str(local))
+                elif remote > 0:
+                    # Worker khác của ứng dụng đã dùng model này
+                    self.last_used[model] = remote
+                    self.owned.add(model)
+            except Exception as e:
+                print(f"Error syncing model usage: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "pinned": self.pinned,
+            "loaded": {backend.base_url: sorted(backend.loaded_models) for backend in self.service.pool.backends},
+            "last_used": dict(self.last_used),
+            "owned": sorted(self.owned),
+            "cold_starts": self.cold_starts,
+        }
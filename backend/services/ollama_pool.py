@@ -0,0 +1,85 @@
+from typing import Dict, Iterable, List, Optional, Set
+import time
+
+# Sau số lần lỗi liên tiếp này backend bị coi là không khỏe cho tới lần health check kế tiếp
+MAX_CONSECUTIVE_FAILURES = 2
+
+class OllamaBackend:
+    """
+    Một máy chủ Ollama trong pool cùng trạng thái định tuyến của nó
+    """
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.healthy = True
+        self.outstanding = 0  # Số request đang chạy trên backend này
+        self.consecutive_failures = 0
+        self.available_models: Set[str] = set()  # Model đã pull (theo /api/tags)
+        self.loaded_models: Set[str] = set()  # Model vừa phục vụ thành công, nhiều khả năng đang nằm trong RAM/VRAM
+        self.last_checked: Optional[float] = None
+
+    def url(self, endpoint: str) -> str:
+        return f"{self.base_url}{endpoint}"
+
+    def status(self) -> Dict:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "available_models": sorted(self.available_models),
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+class OllamaBackendPool:
+    """
+    Chọn backend cho mỗi request: ưu tiên node đang nạp sẵn model, sau đó node có model,
+    trong cùng nhóm chọn node có ít request đang chạy nhất
+    """
+    def __init__(self, base_urls: Iterable[str]):
+        self.backends: List[OllamaBackend] = [OllamaBackend(url) for url in base_urls]
+
+    def choose(self, model: str, exclude: Iterable[OllamaBackend] = ()) -> Optional[OllamaBackend]:
+        excluded = set(id(backend) for backend in exclude)
+        candidates = [b for b in self.backends if id(b) not in excluded]
+        if not candidates:
+            return None
+
+        healthy = [b for b in candidates if b.healthy]
+        # Khi mọi node đều bị đánh dấu lỗi vẫn thử lại thay vì từ chối ngay
+        pool = healthy or candidates
+
+        def rank(backend: OllamaBackend):
+            if model in backend.loaded_models:
+                affinity = 0
+            elif model in backend.available_models or not backend.available_models:
+                affinity = 1
+            else:
+                affinity = 2
+            return (affinity, backend.outstanding)
+
+        return min(pool, key=rank)
+
+    def mark_success(self, backend: OllamaBackend, model: str = None):
+        backend.consecutive_failures = 0
+        backend.healthy = True
+        if model:
+            backend.loaded_models.add(model)
+
+    def mark_failure(self, backend: OllamaBackend):
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            backend.healthy = False
+            backend.loaded_models.clear()
+
+    def record_health(self, backend: OllamaBackend, healthy: bool, models: List[str] = None):
+        backend.last_checked = time.time()
+        backend.healthy = healthy
+        if healthy:
+            backend.consecutive_failures = 0
+            if models is not None:
+                backend.available_models = set(models)
+                backend.loaded_models &= backend.available_models
+        else:
+            backend.loaded_models.clear()
+
+    def status(self) -> List[Dict]:
+        return [backend.status() for backend in self.backends]
@@ -1,76 +1,388 @@
 import httpx
+import asyncio
 import json
-from typing import List, Dict
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Dict, AsyncIterator, Optional, Tuple
+from services.context_builder import ContextBuilder, estimate_tokens
+from services.response_cache import ResponseCache, create_response_cache, make_cache_key
+from services.ollama_pool import OllamaBackend, OllamaBackendPool
+from services.model_manager import ModelManager
+from services import metrics
+import time
+
+# Cấu hình connection pool tới Ollama
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "20"))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "10"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "30"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_GENERATE_TIMEOUT = float(os.getenv("OLLAMA_GENERATE_TIMEOUT", "60"))
+
+# Danh sách máy chủ Ollama, phân tách bằng dấu phẩy. Để trống thì dùng base_url truyền vào OllamaService
+OLLAMA_BASE_URLS = [url.strip() for url in os.getenv("OLLAMA_BASE_URLS", "").split(",") if url.strip()]
+# Chu kỳ health check các backend (giây)
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "15"))
+# Số backend tối đa được thử cho một request khi gặp lỗi kết nối hoặc lỗi 5xx
+OLLAMA_MAX_ATTEMPTS = int(os.getenv("OLLAMA_MAX_ATTEMPTS", "3"))
+
+# Ngân sách token cho các lượt cũ được trí nhớ dài hạn đưa vào prompt
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "512"))
+MEMORY_HEADER = "Thông tin liên quan từ các lượt trò chuyện trước:"
+SUMMARY_HEADER = "Tóm tắt phần đầu cuộc hội thoại:"
+
+# Dùng /api/chat với lịch sử chỉ nối thêm để Ollama tái sử dụng KV-cache của prefix
+OLLAMA_USE_CHAT_API = os.getenv("OLLAMA_USE_CHAT_API", "1") == "1"
+# Thời gian Ollama giữ model (và prompt cache) trong bộ nhớ sau request cuối
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Số session tối đa được ghi nhớ điểm bắt đầu cửa sổ lịch sử
+MAX_WINDOW_ANCHORS = 10000
+# Thời gian (giây) điểm bắt đầu cửa sổ được giữ trong shared state khi chạy nhiều worker
+WINDOW_ANCHOR_TTL = float(os.getenv("WINDOW_ANCHOR_TTL", "86400"))
+
+SYSTEM_PROMPT = """Bạn là một trợ lý AI thông minh và hữu ích, chuyên trả lời bằng tiếng Việt. 
+Hãy trả lời một cách tự nhiên, thân thiện và chính xác. 
+Nếu bạn không biết câu trả lời, hãy thành thật nói rằng bạn không biết.
+Hãy duy trì ngữ cảnh của cuộc hội thoại và tham khảo các tin nhắn trước đó khi cần thiết."""
+
+class OllamaError(Exception):
+    """
+    Lượt sinh thất bại (Ollama báo lỗi hoặc ngắt giữa chừng); message là câu báo lỗi cho người dùng.
+    Câu trả lời lỗi không được lưu, cache hay đưa vào chỉ mục như một lượt chat bình thường
+    """
+
+class OllamaUnavailable(OllamaError):
+    """
+    Không backend Ollama nào phục vụ được request
+    """
 
 class OllamaService:
-    def __init__(self, base_url: str = "http://localhost:11434"):
+    def __init__(self, base_url: str = "http://localhost:11434", limits: httpx.Limits = None, timeout: httpx.Timeout = None, response_cache: ResponseCache = None, base_urls: List[str] = None, shared=None):
         self.base_url = base_url
+        # Pool các máy chủ Ollama, định tuyến theo model đã nạp và số request đang chạy
+        self.pool = OllamaBackendPool(base_urls or OLLAMA_BASE_URLS or [base_url])
+        self.max_attempts = OLLAMA_MAX_ATTEMPTS
+        self.health_interval = OLLAMA_HEALTH_INTERVAL
+        self._health_task: Optional[asyncio.Task] = None
         self.model = "llama3.2:1b"  # Model mặc định, có thể thay đổi
+        self.context_turns = 20  # Số lượt gần nhất tối đa được tải để xếp vào ngân sách token
+        self.context_builder = ContextBuilder()
+        self.use_chat_api = OLLAMA_USE_CHAT_API
+        self.keep_alive = OLLAMA_KEEP_ALIVE
+        # (model, session_id) -> id của lượt đầu tiên trong cửa sổ lịch sử đang dùng
+        self._window_anchors: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        # Shared state dùng chung giữa các worker, để lượt kế tiếp của session rơi vào worker
+        # khác vẫn dựng đúng cửa sổ (và prefix) đang dùng. Backend local thì bản trong process là đủ
+        self.shared = shared if shared is not None and shared.distributed else None
+        # Cache câu trả lời (tùy chọn), None khi bị tắt
+        self.response_cache = response_cache if response_cache is not None else create_response_cache()
+        self.limits = limits or httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY
+        )
+        self.timeout = timeout or httpx.Timeout(OLLAMA_GENERATE_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+        self._client: Optional[httpx.AsyncClient] = None
+        # Quản lý model đang nạp trên các node: giữ nóng model hay dùng, unload model rảnh
+        self.model_manager = ModelManager(self, shared=self.shared)
+    
+    async def startup(self):
+        """
+        Mở HTTP client dùng chung và bắt đầu health check định kỳ (gọi trong lifespan của FastAPI)
+        """
+        self._ensure_client()
+        await self.refresh_backends()
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+    
+    async def shutdown(self):
+        """
+        Dừng health check, đóng HTTP client và giải phóng các kết nối keep-alive
+        """
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        HTTP client dùng chung, tự khởi tạo nếu service được dùng ngoài lifespan
+        """
+        return self._ensure_client()
+    
+    def _ensure_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self._client
     
-    async def generate_response(self, message: str, conversation_history: List[Dict] = None) -> str:
+    async def generate_response(self, message: str, conversation_history: List[Dict] = None, session_id: str = None, model: str = None, memories: List[Dict] = None, summary: str = None) -> str:
         """
-        Tạo phản hồi từ Ollama model với context từ lịch sử cuộc hội thoại
+        Tạo phản hồi từ Ollama model với context từ lịch sử cuộc hội thoại.
+        `model` để trống thì dùng model mặc định, `memories` là các lượt cũ liên quan
+        do trí nhớ dài hạn tìm được, `summary` là bản tóm tắt các lượt đã rời khỏi lịch sử
         """
+        model = model or self.model
         try:
-            # Tạo context từ lịch sử cuộc hội thoại
-            context = self._build_context(conversation_history)
+            # Tạo request với context từ lịch sử cuộc hội thoại
+            remote_anchor = await self._load_window_anchor(model, session_id)
+            with metrics.track_phase("prompt_build"):
+                endpoint, payload, prompt_tokens, context = self._prepare_request(message, conversation_history, session_id, model, stream=False, memories=memories, summary=summary)
+            await self._store_window_anchor(model, session_id, remote_anchor)
+            metrics.OLLAMA_PROMPT_TOKENS.labels(model=model).observe(prompt_tokens)
             
-            # Tạo prompt với context
-            prompt = self._build_prompt(context, message)
+            cache_key = None
+            if self.response_cache:
+                cache_key = make_cache_key(model, message, context)
+                cached = await self.response_cache.get(cache_key)
+                if cached is not None:
+                    metrics.OLLAMA_REQUESTS.labels(model=model, outcome="cache_hit").inc()
+                    return cached
             
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/generate",
-                    json={
-                        "model": self.model,
-                        "prompt": prompt,
-                        "stream": False,
-                        "options": {
-                            "temperature": 0.7,
-                            "top_p": 0.9,
-                            "num_predict": 1000
-                        }
-                    }
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return result.get("response", "Xin lỗi, tôi không thể tạo phản hồi lúc này.")
-                else:
-                    return "Xin lỗi, có lỗi xảy ra khi kết nối với AI model."
+            self.model_manager.record_request(model)
+            with metrics.CHAT_GENERATIONS_IN_PROGRESS.track_inprogress(), metrics.track_phase("ollama_wait"):
+                response = await self._post(endpoint, payload)
+            
+            if response.status_code != 200:
+                raise OllamaError("Xin lỗi, có lỗi xảy ra khi kết nối với AI model.")
+            data = response.json()
+            result = self._extract_text(data)
+            if not result:
+                raise OllamaError("Xin lỗi, tôi không thể tạo phản hồi lúc này.")
+            metrics.observe_ollama_result(model, data)
+            metrics.observe_blocking_first_token(data)
+            metrics.OLLAMA_REQUESTS.labels(model=model, outcome="ok").inc()
+            if cache_key:
+                await self.response_cache.set(cache_key, result)
+            return result
                     
+        except OllamaError:
+            metrics.OLLAMA_REQUESTS.labels(model=model, outcome="error").inc()
+            raise
         except Exception as e:
+            metrics.OLLAMA_REQUESTS.labels(model=model, outcome="error").inc()
             print(f"Error calling Ollama: {e}")
-            return "Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn."
+            raise OllamaError("Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn.") from e
     
-    def _build_context(self, conversation_history: List[Dict]) -> str:
+    async def generate_response_stream(self, message: str, conversation_history: List[Dict] = None, session_id: str = None, model: str = None, memories: List[Dict] = None, summary: str = None) -> AsyncIterator[str]:
         """
-        Xây dựng context từ lịch sử cuộc hội thoại
+        Tạo phản hồi dạng stream, trả về từng token ngay khi Ollama sinh ra.
+        Lỗi (kể cả khi đã phát một phần câu trả lời) được báo bằng OllamaError
         """
-        if not conversation_history:
-            return ""
+        model = model or self.model
+        try:
+            remote_anchor = await self._load_window_anchor(model, session_id)
+            with metrics.track_phase("prompt_build"):
+                endpoint, payload, prompt_tokens, context = self._prepare_request(message, conversation_history, session_id, model, stream=True, memories=memories, summary=summary)
+            await self._store_window_anchor(model, session_id, remote_anchor)
+            metrics.OLLAMA_PROMPT_TOKENS.labels(model=model).observe(prompt_tokens)
+            
+            cache_key = None
+            if self.response_cache:
+                cache_key = make_cache_key(model, message, context)
+                cached = await self.response_cache.get(cache_key)
+                if cached is not None:
+                    metrics.OLLAMA_REQUESTS.labels(model=model, outcome="cache_hit").inc()
+                    yield cached
+                    return
+            
+            self.model_manager.record_request(model)
+            started = time.perf_counter()
+            with metrics.CHAT_GENERATIONS_IN_PROGRESS.track_inprogress():
+                async with self._open_stream(endpoint, payload) as response:
+                    if response.status_code != 200:
+                        raise OllamaError("Xin lỗi, có lỗi xảy ra khi kết nối với AI model.")
+                    
+                    # Ollama trả về NDJSON, mỗi dòng là một phần của câu trả lời
+                    parts = []
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            print(f"Ollama stream error: {chunk['error']}")
+                            raise OllamaError("Xin lỗi, có lỗi xảy ra khi kết nối với AI model.")
+                        token = self._extract_text(chunk)
+                        if token:
+                            if not parts:
+                                metrics.CHAT_TIME_TO_FIRST_TOKEN.labels(mode="stream").observe(time.perf_counter() - started)
+                            parts.append(token)
+                            yield token
+                        if chunk.get("done"):
+                            metrics.CHAT_PHASE_DURATION.labels(phase="ollama_wait").observe(time.perf_counter() - started)
+                            metrics.observe_ollama_result(model, chunk)
+                            metrics.OLLAMA_REQUESTS.labels(model=model, outcome="ok").inc()
+                            # Chỉ cache câu trả lời đã sinh trọn vẹn
+                            if cache_key and parts:
+                                await self.response_cache.set(cache_key, "".join(parts))
+                            return
+                    # Stream đóng trước khi Ollama báo done: câu trả lời bị cắt dở
+                    raise OllamaError("Xin lỗi, kết nối tới AI model bị ngắt giữa chừng.")
+                        
+        except OllamaError:
+            metrics.OLLAMA_REQUESTS.labels(model=model, outcome="error").inc()
+            raise
+        except Exception as e:
+            metrics.OLLAMA_REQUESTS.labels(model=model, outcome="error").inc()
+            print(f"Error streaming from Ollama: {e}")
+            raise OllamaError("Xin lỗi, có lỗi xảy ra khi xử lý yêu cầu của bạn.") from e
+    
+    def _prepare_request(self, message: str, conversation_history: List[Dict], session_id: str, model: str, stream: bool, memories: List[Dict] = None, summary: str = None) -> Tuple[str, Dict, int, str]:
+        """
+        Chọn endpoint và tạo body request, trả về (endpoint, payload, số token prompt ước lượng,
+        chuỗi đại diện cho phần context ngoài tin nhắn hiện tại - dùng làm key cache)
+        """
+        if self.use_chat_api:
+            messages, prompt_tokens = self._prepare_messages(message, conversation_history, session_id, model, memories, summary)
+            payload = {"model": model, "messages": messages}
+            endpoint = "/api/chat"
+            context = json.dumps(messages[:-1], ensure_ascii=False)
+        else:
+            prompt, prompt_tokens = self._prepare_prompt(message, conversation_history, model, memories, summary)
+            payload = {"model": model, "prompt": prompt}
+            endpoint = "/api/generate"
+            # Phần prompt đứng trước tin nhắn hiện tại
+            context = prompt.rsplit(message, 1)[0] if message else prompt
+        
+        payload.update({
+            "stream": stream,
+            "keep_alive": self.model_manager.keep_alive_for(model),
+            "options": {
+                "temperature": 0.7,
+                "top_p": 0.9,
+                "num_predict": 1000
+            }
+        })
+        return endpoint, payload, prompt_tokens, context
+    
+    @staticmethod
+    def _extract_text(chunk: Dict) -> str:
+        """
+        Lấy nội dung trả lời từ kết quả của /api/generate hoặc /api/chat
+        """
+        if "message" in chunk:
+            return chunk["message"].get("content", "")
+        return chunk.get("response", "")
+    
+    @staticmethod
+    def _window_anchor_key(model: str, session_id: str) -> str:
+        return f"window_anchor:{model}:{session_id}"
+    
+    async def _load_window_anchor(self, model: str, session_id: str) -> Optional[int]:
+        """
+        Lấy điểm bắt đầu cửa sổ lịch sử mà worker khác vừa dùng cho session, ghi đè bản
+        trong process. Trả về giá trị trong shared state (None nếu chưa có hoặc lỗi)
+        """
+        if self.shared is None or not session_id or not self.use_chat_api:
+            return None
+        try:
+            value = await self.shared.get(self._window_anchor_key(model, session_id))
+        except Exception as e:
+            print(f"Error loading window anchor: {e}")
+            return None
+        if value is None:
+            return None
+        anchor_key = (model, session_id)
+        self._window_anchors[anchor_key] = int(value)
+        self._window_anchors.move_to_end(anchor_key)
+        return int(value)
+    
+    async def _store_window_anchor(self, model: str, session_id: str, remote_anchor: Optional[int]):
+        """
+        Ghi điểm bắt đầu cửa sổ vừa dùng vào shared state nếu khác bản worker khác đã ghi
+        """
+        if self.shared is None or not session_id or not self.use_chat_api:
+            return
+        anchor_id = self._window_anchors.get((model, session_id))
+        if anchor_id is None or anchor_id == remote_anchor:
+            return
+        try:
+            await self.shared.set(self._window_anchor_key(model, session_id), str(anchor_id), WINDOW_ANCHOR_TTL)
+        except Exception as e:
+            print(f"Error storing window anchor: {e}")
+    
+    def _prepare_messages(self, message: str, conversation_history: List[Dict] = None, session_id: str = None, model: str = None, memories: List[Dict] = None, summary: str = None) -> Tuple[List[Dict], int]:
+        """
+        Dựng danh sách messages cho /api/chat với prefix ổn định giữa các lượt
+        của cùng một session, trả về (messages, số token ước lượng)
+        """
+        model = model or self.model
+        memory = self._format_memories(memories, model)
+        # Bản tóm tắt chỉ đổi sau vài lượt nên đặt cùng system prompt ở đầu prefix
+        system_prompt = f"{SYSTEM_PROMPT}\n\n{SUMMARY_HEADER}\n{summary}" if summary else SYSTEM_PROMPT
+        reserved_tokens = estimate_tokens(system_prompt, model) + estimate_tokens(message, model) + estimate_tokens(memory, model)
+        # Cửa sổ (và KV-cache của Ollama) gắn với từng model, đổi model thì dựng lại từ đầu
+        anchor_key = (model, session_id)
+        anchor_id = self._window_anchors.get(anchor_key) if session_id else None
+        
+        turns, anchor_id = self.context_builder.build_window(
+            model, conversation_history, reserved_tokens, anchor_id, max_turns=self.context_turns
+        )
         
-        context_parts = []
-        # Chỉ lấy 5 cuộc hội thoại gần nhất để tránh context quá dài
-        recent_history = conversation_history[-5:] if len(conversation_history) > 5 else conversation_history
+        if session_id and anchor_id is not None:
+            self._window_anchors[anchor_key] = anchor_id
+            self._window_anchors.move_to_end(anchor_key)
+            while len(self._window_anchors) > MAX_WINDOW_ANCHORS:
+                self._window_anchors.popitem(last=False)
         
-        for conv in recent_history:
-            context_parts.append(f"Người dùng: {conv['user_message']}")
-            context_parts.append(f"AI: {conv['bot_response']}")
+        messages = [{"role": "system", "content": system_prompt}]
+        for conv in turns:
+            messages.append({"role": "user", "content": conv["user_message"]})
+            messages.append({"role": "assistant", "content": conv["bot_response"]})
+        if memory:
+            # Đặt sau cửa sổ lịch sử để không làm thay đổi prefix mà Ollama đã cache
+            messages.append({"role": "system", "content": memory})
+        messages.append({"role": "user", "content": message})
         
-        return "\n".join(context_parts)
+        prompt_tokens = sum(estimate_tokens(m["content"], model) for m in messages)
+        return messages, prompt_tokens
     
-    def _build_prompt(self, context: str, current_message: str) -> str:
+    def _prepare_prompt(self, message: str, conversation_history: List[Dict] = None, model: str = None, memories: List[Dict] = None, summary: str = None) -> Tuple[str, int]:
+        """
+        Dựng prompt vừa ngân sách token của model, trả về (prompt, số token ước lượng)
+        """
+        model = model or self.model
+        # Phần cố định của prompt: system prompt, tiêu đề lịch sử và tin nhắn hiện tại
+        memory = self._format_memories(memories, model)
+        if summary:
+            memory = "\n\n".join(part for part in (f"{SUMMARY_HEADER}\n{summary}", memory) if part)
+        reserved_tokens = estimate_tokens(self._build_prompt(" ", message, memory), model)
+        
+        built = self.context_builder.build(model, conversation_history, reserved_tokens)
+        prompt = self._build_prompt(built.context, message, memory)
+        return prompt, estimate_tokens(prompt, model)
+    
+    def _format_memories(self, memories: List[Dict], model: str) -> str:
+        """
+        Ghép các lượt cũ liên quan thành một đoạn văn bản, dừng khi hết MEMORY_MAX_TOKENS
+        """
+        if not memories:
+            return ""
+        parts = [MEMORY_HEADER]
+        used = estimate_tokens(MEMORY_HEADER, model)
+        for conv in memories:
+            turn = self.context_builder._format_turn(self.context_builder._fit_turn(conv, model))
+            tokens = estimate_tokens(turn, model)
+            if used + tokens > MEMORY_MAX_TOKENS:
+                break
+            parts.append(turn)
+            used += tokens
+        return "\n\n".join(parts) if len(parts) > 1 else ""
+    
+    def _build_prompt(self, context: str, current_message: str, memory: str = "") -> str:
         """
         Xây dựng prompt hoàn chỉnh cho model
         """
-        system_prompt = """Bạn là một trợ lý AI thông minh và hữu ích, chuyên trả lời bằng tiếng Việt. 
-Hãy trả lời một cách tự nhiên, thân thiện và chính xác. 
-Nếu bạn không biết câu trả lời, hãy thành thật nói rằng bạn không biết.
-Hãy duy trì ngữ cảnh của cuộc hội thoại và tham khảo các tin nhắn trước đó khi cần thiết."""
-
+        if memory:
+            context = f"{memory}\n\n{context}" if context else memory
         if context:
-            prompt = f"""{system_prompt}
+            prompt = f"""{SYSTEM_PROMPT}
 
 Lịch sử cuộc hội thoại:
 {context}
@@ -79,34 +391,140 @@ Tin nhắn hiện tại:
 Người dùng: {current_message}
 AI:"""
         else:
-            prompt = f"""{system_prompt}
+            prompt = f"""{SYSTEM_PROMPT}
 
 Người dùng: {current_message}
 AI:"""
         
         return prompt
     
-    async def check_connection(self) -> bool:
+    async def _post(self, endpoint: str, payload: Dict) -> httpx.Response:
+        """
+        Gửi request tới backend phù hợp nhất, chuyển sang backend khác khi lỗi kết nối hoặc 5xx
+        """
+        tried: List[OllamaBackend] = []
+        last_response = None
+        last_error = None
+        for _ in range(self.max_attempts):
+            backend = self.pool.choose(payload["model"], exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            
+            backend.outstanding += 1
+            try:
+                response = await self.client.post(backend.url(endpoint), json=payload)
+            except httpx.TransportError as e:
+                print(f"Ollama backend {backend.base_url} failed: {e}")
+                self.pool.mark_failure(backend)
+                last_error = e
+                continue
+            finally:
+                backend.outstanding -= 1
+            
+            if response.status_code >= 500:
+                self.pool.mark_failure(backend)
+                last_response = response
+                continue
+            self.pool.mark_success(backend, payload["model"])
+            return response
+        
+        if last_response is not None:
+            return last_response
+        raise OllamaUnavailable("Không kết nối được tới Ollama") from last_error
+    
+    @asynccontextmanager
+    async def _open_stream(self, endpoint: str, payload: Dict):
+        """
+        Mở response dạng stream với failover; chỉ chuyển backend trước khi nhận được dữ liệu
+        """
+        tried: List[OllamaBackend] = []
+        last_error = None
+        for attempt in range(self.max_attempts):
+            backend = self.pool.choose(payload["model"], exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            
+            backend.outstanding += 1
+            try:
+                request = self.client.build_request("POST", backend.url(endpoint), json=payload)
+                response = await self.client.send(request, stream=True)
+            except httpx.TransportError as e:
+                print(f"Ollama backend {backend.base_url} failed: {e}")
+                backend.outstanding -= 1
+                self.pool.mark_failure(backend)
+                last_error = e
+                continue
+            
+            if response.status_code >= 500 and attempt + 1 < self.max_attempts:
+                await response.aclose()
+                backend.outstanding -= 1
+                self.pool.mark_failure(backend)
+                continue
+            
+            try:
+                yield response
+                if response.status_code < 500:
+                    self.pool.mark_success(backend, payload["model"])
+            finally:
+                await response.aclose()
+                backend.outstanding -= 1
+            return
+        
+        raise OllamaUnavailable("Không kết nối được tới Ollama") from last_error
+    
+    async def _health_loop(self):
+        while True:
+            # Vòng đầu chạy ngay sau startup để nạp sẵn các model được ghim ở nền
+            try:
+                await self.model_manager.maintain()
+            except Exception as e:
+                print(f"Error managing Ollama models: {e}")
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.refresh_backends()
+            except Exception as e:
+                print(f"Error checking Ollama backends: {e}")
+    
+    async def refresh_backends(self):
+        """
+        Health check mọi backend và cập nhật danh sách model của từng node
+        """
+        async def refresh(backend: OllamaBackend):
+            healthy = await self.check_connection(backend)
+            models = await self.list_models(backend) if healthy else None
+            self.pool.record_health(backend, healthy, models)
+        
+        await asyncio.gather(*(refresh(backend) for backend in self.pool.backends))
+    
+    async def check_connection(self, backend: OllamaBackend = None) -> bool:
         """
-        Kiểm tra kết nối với Ollama server
+        Kiểm tra kết nối với Ollama server. Không truyền backend thì kiểm tra
+        toàn bộ pool và trả về True nếu có ít nhất một node hoạt động
         """
+        if backend is None:
+            results = await asyncio.gather(*(self.check_connection(b) for b in self.pool.backends))
+            return any(results)
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                return response.status_code == 200
+            response = await self.client.get(backend.url("/api/tags"), timeout=5.0)
+            return response.status_code == 200
         except:
             return False
     
-    async def list_models(self) -> List[str]:
+    async def list_models(self, backend: OllamaBackend = None) -> List[str]:
         """
-        Lấy danh sách các models có sẵn
+        Lấy danh sách các models có sẵn (gộp từ mọi node khỏe nếu không truyền backend)
         """
+        if backend is None:
+            backends = [b for b in self.pool.backends if b.healthy] or self.pool.backends
+            results = await asyncio.gather(*(self.list_models(b) for b in backends))
+            return sorted(set(model for models in results for model in models))
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                if response.status_code == 200:
-                    data = response.json()
-                    return [model["name"] for model in data.get("models", [])]
-                return []
+            response = await self.client.get(backend.url("/api/tags"), timeout=10.0)
+            if response.status_code == 200:
+                data = response.json()
+                return [model["name"] for model in data.get("models", [])]
+            return []
         except:
-            return []
\ No newline at end of file
+            return []
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+from typing import Optional, Tuple
+import asyncio
+import os
+
+# Cost của bcrypt: mỗi lần tăng 1 thì thời gian hash tăng gấp đôi
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Số thread tối đa cùng hash/verify mật khẩu
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+class PasswordHasher:
+    """
+    Hash và kiểm tra mật khẩu bcrypt trong thread pool riêng để không block event loop.
+    bcrypt nhả GIL khi tính toán nên các thread chạy song song được.
+    """
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, max_workers: int = PASSWORD_HASH_WORKERS):
+        self.rounds = rounds
+        # min/max rounds bằng nhau để hash với cost khác (cũ hơn hoặc mới hơn) đều được hash lại
+        self.context = CryptContext(
+            schemes=["bcrypt"],
+            deprecated="auto",
+            bcrypt__default_rounds=rounds,
+            bcrypt__min_rounds=rounds,
+            bcrypt__max_rounds=rounds
+        )
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def hash(self, password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.context.hash, password)
+
+    async def verify_and_update(self, password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+        """
+        Kiểm tra mật khẩu, trả về (hợp lệ, hash mới nếu cần hash lại với cost hiện tại)
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.context.verify_and_update, password, password_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+password_hasher = PasswordHasher()
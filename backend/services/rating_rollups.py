@@ -0,0 +1,134 @@
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import RatingRollup, User
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+# Các cột đếm của bảng rating_rollups (cộng dồn theo delta)
+COUNTER_COLUMNS = ["turns", "rated", "rating_sum", "rating_1", "rating_2", "rating_3", "rating_4", "rating_5", "feedback_count"]
+GROUP_BY_COLUMNS = {
+    "day": RatingRollup.day,
+    "model": RatingRollup.model,
+    "user": RatingRollup.user_id,
+}
+
+RollupKey = Tuple[str, str, int]
+
+def rating_bucket(rating: float) -> str:
+    # Làm tròn nửa lên (như ROUND của SQL) để khớp với dữ liệu backfill
+    return f"rating_{min(5, max(1, int(rating + 0.5)))}"
+
+def rollup_key(timestamp: datetime, model: Optional[str], user_id: int) -> RollupKey:
+    # Model không rõ lưu là chuỗi rỗng vì là một phần của khóa chính
+    return (timestamp.strftime("%Y-%m-%d"), model or "", user_id)
+
+def rating_delta(rating: Optional[float], feedback: Optional[str], sign: int = 1) -> Dict[str, float]:
+    """
+    Phần đóng góp của một đánh giá/phản hồi: thêm (sign=1) hoặc bỏ (sign=-1)
+    """
+    delta = {}
+    if rating is not None:
+        delta.update({"rated": sign, "rating_sum": sign * rating, rating_bucket(rating): sign})
+    if feedback:
+        delta["feedback_count"] = sign
+    return delta
+
+def rating_change_deltas(conversation, rating: Optional[float], feedback: Optional[str], rated_at: datetime) -> Dict[RollupKey, Dict[str, float]]:
+    """
+    Delta khi một lượt được đánh giá (lại): bỏ đánh giá cũ khỏi ngày nó được ghi nhận,
+    cộng đánh giá mới vào ngày `rated_at`
+    """
+    deltas: Dict[RollupKey, Dict[str, float]] = {}
+    old_day = conversation.rated_at or conversation.timestamp
+    accumulate(deltas, rollup_key(old_day, conversation.model, conversation.user_id), rating_delta(conversation.rating, conversation.feedback, -1))
+    accumulate(deltas, rollup_key(rated_at, conversation.model, conversation.user_id), rating_delta(rating, feedback, 1))
+    return deltas
+
+def accumulate(deltas: Dict[RollupKey, Dict[str, float]], key: RollupKey, delta: Dict[str, float]):
+    target = deltas.setdefault(key, defaultdict(float))
+    for column, amount in delta.items():
+        target[column] += amount
+
+async def apply(db: AsyncSession, deltas: Dict[RollupKey, Dict[str, float]]):
+    """
+    Cộng các delta vào rating_rollups trong transaction hiện tại (chưa commit), mỗi khóa một upsert
+    """
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    for (day, model, user_id), delta in deltas.items():
+        if not any(delta.values()):
+            continue
+        values = {
+            column: delta.get(column, 0) if column == "rating_sum" else int(delta.get(column, 0))
+            for column in COUNTER_COLUMNS
+        }
+        stmt = insert(RatingRollup).values(day=day, model=model, user_id=user_id, **values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["day", "model", "user_id"],
+            set_={
+                column: getattr(RatingRollup, column) + getattr(stmt.excluded, column)
+                for column in COUNTER_COLUMNS if delta.get(column)
+            }
+        )
+        await db.execute(stmt)
+
+async def record_turns(db: AsyncSession, rows: Iterable[Dict], sign: int = 1):
+    """
+    Cập nhật rollup cho các lượt được thêm/xóa (dict có timestamp, model, user_id, rating, feedback, rated_at).
+    Lượt chat được tính vào ngày tạo, đánh giá vào ngày đánh giá (rated_at, không có thì ngày tạo)
+    """
+    deltas: Dict[RollupKey, Dict[str, float]] = {}
+    for row in rows:
+        accumulate(deltas, rollup_key(row["timestamp"], row.get("model"), row["user_id"]), {"turns": sign})
+        rated_day = row.get("rated_at") or row["timestamp"]
+        accumulate(deltas, rollup_key(rated_day, row.get("model"), row["user_id"]), rating_delta(row.get("rating"), row.get("feedback"), sign))
+    await apply(db, deltas)
+
+async def query(db: AsyncSession, group_by: str = "day", since: str = None, until: str = None, model: str = None, user_id: int = None) -> Dict:
+    """
+    Tổng hợp từ bảng rollup (nhỏ: một dòng mỗi ngày/model/user), không quét bảng conversations
+    """
+    sums = [func.coalesce(func.sum(getattr(RatingRollup, column)), 0).label(column) for column in COUNTER_COLUMNS]
+    filters = []
+    if since:
+        filters.append(RatingRollup.day >= since)
+    if until:
+        filters.append(RatingRollup.day <= until)
+    if model is not None:
+        filters.append(RatingRollup.model == model)
+    if user_id is not None:
+        filters.append(RatingRollup.user_id == user_id)
+
+    group_column = GROUP_BY_COLUMNS[group_by]
+    grouped = select(group_column.label("key"), *sums).where(*filters).group_by(group_column).order_by(group_column)
+    if group_by == "user":
+        grouped = grouped.add_columns(User.username).outerjoin(User, User.id == RatingRollup.user_id).group_by(User.username)
+    groups = (await db.execute(grouped)).all()
+    totals = (await db.execute(select(*sums).where(*filters))).one()
+
+    return {
+        "group_by": group_by,
+        "totals": _summarize(totals._asdict()),
+        "groups": [_group_entry(group_by, row._asdict()) for row in groups],
+    }
+
+def _group_entry(group_by: str, row: Dict) -> Dict:
+    key = row.pop("key")
+    username = row.pop("username", None)
+    entry = {group_by: (key or None) if group_by == "model" else key}
+    if group_by == "user":
+        entry["username"] = username
+    entry.update(_summarize(row))
+    return entry
+
+def _summarize(row: Dict) -> Dict:
+    rated = int(row["rated"])
+    return {
+        "turns": int(row["turns"]),
+        "rated": rated,
+        "average_rating": round(row["rating_sum"] / rated, 3) if rated else None,
+        "distribution": {str(value): int(row[f"rating_{value}"]) for value in range(1, 6)},
+        "feedback": int(row["feedback_count"]),
+    }
@@ -0,0 +1,207 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+import asyncio
+import hashlib
+import sqlite3
+import time
+import unicodedata
+import os
+import re
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")  # memory | sqlite
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "./response_cache.db")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_message(message: str) -> str:
+    """
+    Chuẩn hóa tin nhắn để so khớp: bỏ dấu tiếng Việt, chữ thường, bỏ dấu câu và khoảng trắng thừa
+    """
+    text = unicodedata.normalize("NFD", message)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = text.replace("đ", "d").replace("Đ", "D").lower()
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+def make_cache_key(model: str, message: str, context: str) -> str:
+    """
+    Tạo key cache từ model, tin nhắn đã chuẩn hóa và hash của context
+    """
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    raw = f"{model}\x00{normalize_message(message)}\x00{context_hash}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class InMemoryCacheBackend:
+    """
+    Backend LRU + TTL trong bộ nhớ, giới hạn theo tổng số byte
+    """
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, Tuple[float, str, int]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value, size = entry
+        if expires_at < time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float):
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (time.time() + ttl, value, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    async def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+class SQLiteCacheBackend:
+    """
+    Backend lưu trong file SQLite riêng, dùng chung được giữa các lần khởi động lại
+    """
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Một kết nối dùng chung; các thao tác được tuần tự hóa bằng lock nên an toàn giữa các thread.
+        # Kết nối được mở khi dùng lần đầu, không mở lúc import (process cha có thể fork ra các worker)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_last_access ON response_cache (last_access)")
+        return self._conn
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        async with self._lock:
+            await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def clear(self):
+        async with self._lock:
+            await asyncio.to_thread(self._clear)
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def _set(self, key: str, value: str, ttl: float):
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now + ttl, now)
+            )
+            conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+            # Xóa các entry ít được truy cập nhất cho tới khi tổng dung lượng nằm trong giới hạn
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+            if total > self.max_bytes:
+                rows = conn.execute("SELECT key, size FROM response_cache ORDER BY last_access").fetchall()
+                evicted = []
+                for old_key, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= old_size
+                conn.executemany("DELETE FROM response_cache WHERE key = ?", evicted)
+
+    def _clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response_cache")
+
+class ResponseCache:
+    """
+    Cache câu trả lời của model cho các tin nhắn giống nhau (sau khi chuẩn hóa)
+    """
+    def __init__(self, backend, ttl: float = RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            print(f"Error reading response cache: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            print(f"Error writing response cache: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """
+    Tạo response cache theo cấu hình, trả về None nếu cache bị tắt
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        backend = SQLiteCacheBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES)
+    else:
+        backend = InMemoryCacheBackend(RESPONSE_CACHE_MAX_BYTES)
+    return ResponseCache(backend)
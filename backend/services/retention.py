@@ -0,0 +1,468 @@
+from sqlalchemy import delete, select, text, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from database import ArchivedSession, ArchiveTombstone, ChatSession, Conversation
+from services.conversation_service import ConversationService
+from services import rating_rollups
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+import asyncio
+import gzip
+import json
+import os
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Không có trên Windows: bỏ qua khóa giữa các worker
+    fcntl = None
+
+# Bật retention: định kỳ chuyển các session cũ sang file lưu trữ rồi thu hồi dung lượng database
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "0") == "1"
+# Session không hoạt động lâu hơn số ngày này được lưu trữ (0 = tắt chính sách theo tuổi)
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "180"))
+# Khi dữ liệu trong database vượt ngưỡng này (MB), lưu trữ các session cũ nhất cho tới khi về dưới ngưỡng (0 = tắt)
+RETENTION_MAX_DB_MB = float(os.getenv("RETENTION_MAX_DB_MB", "0"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "./archive")
+# Số session lưu trữ trong một transaction
+RETENTION_BATCH_SESSIONS = int(os.getenv("RETENTION_BATCH_SESSIONS", "100"))
+# Số batch tối đa mỗi lần chạy, phần còn lại để lần sau
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", "50"))
+# Số trang tối đa trả lại cho hệ điều hành mỗi lần incremental_vacuum (0 = tất cả trang trống)
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "0"))
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Không serialize được {type(value).__name__}")
+
+def _decode_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+class RetentionManager:
+    """
+    Định kỳ chuyển các session cũ (theo tuổi hoặc khi database quá lớn) sang file
+    NDJSON nén gzip theo tháng, xóa khỏi database rồi chạy incremental vacuum và ANALYZE.
+    Mỗi batch được ghi thành một gzip member riêng; vị trí của member được lưu trong
+    archived_sessions để đọc lại một session mà không phải giải nén cả file.
+    Số liệu thống kê đánh giá (rating_rollups) được giữ nguyên cho tới khi người dùng xóa session;
+    khi đó các file chứa session được ghi lại mà không có nó ở lượt chạy kế tiếp.
+    """
+    def __init__(self, session_factory: Callable[[], AsyncSession], engine: AsyncEngine, archive_dir: str = RETENTION_ARCHIVE_DIR):
+        self.session_factory = session_factory
+        self.engine = engine
+        self.archive_dir = archive_dir
+        self.max_age_days = RETENTION_MAX_AGE_DAYS
+        self.max_db_bytes = int(RETENTION_MAX_DB_MB * 1024 * 1024)
+        self.interval = RETENTION_INTERVAL
+        self._task: Optional[asyncio.Task] = None
+        self.archived_sessions = 0
+        self.archived_turns = 0
+        self.last_run: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def is_sqlite(self) -> bool:
+        return self.engine.dialect.name == "sqlite"
+
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error running retention: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> Dict:
+        """
+        Một lượt retention; chỉ một worker chạy tại một thời điểm (khóa file trong thư mục lưu trữ)
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(os.path.join(self.archive_dir, ".lock"), "w") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return {"skipped": True}
+
+            purged = await self.purge_deleted()
+            archived = 0
+            for _ in range(RETENTION_MAX_BATCHES):
+                cutoff = datetime.utcnow() - timedelta(days=self.max_age_days) if self.max_age_days else None
+                if cutoff is None and not await self._over_size_limit():
+                    break
+                count = await self._archive_batch(cutoff)
+                if count == 0:
+                    # Hết session quá tuổi: tiếp tục theo chính sách dung lượng nếu có
+                    if cutoff is not None and await self._over_size_limit():
+                        count = await self._archive_batch(None)
+                    if count == 0:
+                        break
+                archived += count
+            if archived:
+                await self.compact()
+            self.last_run = datetime.utcnow()
+            self.last_error = None
+            return {"archived_sessions": archived, "purged_files": purged}
+
+    async def database_bytes(self) -> Optional[int]:
+        """
+        Dung lượng thực sự đang dùng (không tính trang trống chờ vacuum), chỉ với SQLite
+        """
+        if not self.is_sqlite:
+            return None
+        async with self.engine.connect() as conn:
+            page_size = (await conn.execute(text("PRAGMA page_size"))).scalar()
+            page_count = (await conn.execute(text("PRAGMA page_count"))).scalar()
+            freelist = (await conn.execute(text("PRAGMA freelist_count"))).scalar()
+        return (page_count - freelist) * page_size
+
+    async def _over_size_limit(self) -> bool:
+        if not self.max_db_bytes:
+            return False
+        used = await self.database_bytes()
+        return used is not None and used > self.max_db_bytes
+
+    async def _archive_batch(self, cutoff: Optional[datetime]) -> int:
+        """
+        Lưu trữ một batch session cũ nhất (không hoạt động từ trước `cutoff` nếu có).
+        File được ghi và fsync trước khi xóa dữ liệu khỏi database; nếu transaction
+        thất bại, phần vừa ghi được cắt khỏi file
+        """
+        async with self.session_factory() as db:
+            query = select(ChatSession)
+            if cutoff is not None:
+                query = query.where(ChatSession.last_activity < cutoff)
+            result = await db.execute(
+                query.order_by(ChatSession.last_activity, ChatSession.id).limit(RETENTION_BATCH_SESSIONS)
+            )
+            sessions = result.scalars().all()
+            if not sessions:
+                return 0
+
+            keys = {(session.user_id, session.session_id) for session in sessions}
+            result = await db.execute(
+                select(Conversation)
+                .where(Conversation.session_id.in_([session_id for _, session_id in keys]))
+                .order_by(Conversation.timestamp, Conversation.id)
+            )
+            turns: Dict[tuple, List[Dict]] = {key: [] for key in keys}
+            for conv in result.scalars().all():
+                if (conv.user_id, conv.session_id) in turns:
+                    # rated_at để trừ đúng ngày trong rating_rollups nếu session bị xóa sau này
+                    turns[(conv.user_id, conv.session_id)].append({**ConversationService._to_dict(conv), "rated_at": conv.rated_at})
+
+            # Mỗi tháng (theo hoạt động cuối của session) một file
+            by_month: Dict[str, List[ChatSession]] = {}
+            for session in sessions:
+                by_month.setdefault(session.last_activity.strftime("%Y-%m"), []).append(session)
+
+            conv_service = ConversationService(db)
+            archived_turns = 0
+            # (file, kích thước trước khi ghi) để cắt bỏ các member đã ghi nếu transaction thất bại
+            written: List[tuple] = []
+            try:
+                for month, month_sessions in by_month.items():
+                    records = [
+                        {
+                            "user_id": session.user_id,
+                            "session_id": session.session_id,
+                            "title": session.title,
+                            "created_at": session.created_at,
+                            "last_activity": session.last_activity,
+                            "model": session.model,
+                            "summary": session.summary,
+                            "conversations": turns[(session.user_id, session.session_id)],
+                        }
+                        for session in month_sessions
+                    ]
+                    filename = f"{month}.ndjson.gz"
+                    offset = await asyncio.to_thread(self._append_member, filename, records)
+                    written.append((filename, offset))
+                    for session, record in zip(month_sessions, records):
+                        db.add(ArchivedSession(
+                            session_id=session.session_id,
+                            user_id=session.user_id,
+                            title=session.title,
+                            created_at=session.created_at,
+                            last_activity=session.last_activity,
+                            turn_count=len(record["conversations"]),
+                            model=session.model,
+                            archive_file=filename,
+                            archive_offset=offset
+                        ))
+                        archived_turns += len(record["conversations"])
+                        # Chỉ xóa các lượt đã nằm trong file; lượt mới đến sau khi chọn vẫn ở lại database
+                        await conv_service.remove_conversation_rows(
+                            session.session_id, session.user_id,
+                            [conv["id"] for conv in record["conversations"]]
+                        )
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                # Không có dòng archived_sessions nào trỏ tới các member này: cắt bỏ để lần chạy sau không ghi trùng
+                await asyncio.to_thread(self._truncate_members, written)
+                raise
+
+        self.archived_sessions += len(sessions)
+        self.archived_turns += archived_turns
+        return len(sessions)
+
+    def _append_member(self, filename: str, records: List[Dict]) -> int:
+        """
+        Ghi các session thành một gzip member ở cuối file, trả về vị trí bắt đầu của member
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, filename)
+        payload = "".join(json.dumps(record, ensure_ascii=False, default=_encode) + "\n" for record in records)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(gzip.compress(payload.encode("utf-8"), compresslevel=9, mtime=0))
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    def _truncate_members(self, written: List[tuple]):
+        for filename, offset in reversed(written):
+            os.truncate(os.path.join(self.archive_dir, filename), offset)
+
+    def _read_members(self, filename: str, offsets: List[int]) -> Dict[int, List[Dict]]:
+        """
+        Đọc toàn bộ các member bắt đầu ở `offsets` (mỗi member kéo dài tới member kế tiếp)
+        """
+        path = os.path.join(self.archive_dir, filename)
+        members: Dict[int, List[Dict]] = {}
+        with open(path, "rb") as f:
+            bounds = sorted(set(offsets)) + [os.fstat(f.fileno()).st_size]
+            for start, end in zip(bounds, bounds[1:]):
+                f.seek(start)
+                payload = gzip.decompress(f.read(end - start)).decode("utf-8")
+                members[start] = [json.loads(line) for line in payload.splitlines() if line]
+        return members
+
+    def _write_file(self, filename: str, members: List[List[Dict]]) -> List[int]:
+        """
+        Ghi một file lưu trữ mới (mỗi phần tử một gzip member) và fsync, trả về vị trí các member
+        """
+        path = os.path.join(self.archive_dir, filename)
+        offsets = []
+        with open(path, "wb") as f:
+            for records in members:
+                offsets.append(f.tell())
+                payload = "".join(json.dumps(record, ensure_ascii=False, default=_encode) + "\n" for record in records)
+                f.write(gzip.compress(payload.encode("utf-8"), compresslevel=9, mtime=0))
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    async def remove_session(self, db: AsyncSession, session_id: str, user_id: int = None):
+        """
+        Xóa phần đã lưu trữ của session (gọi khi người dùng xóa session, chưa commit): trừ các lượt
+        khỏi rating_rollups, bỏ khỏi archived_sessions và ghi tombstone để lượt retention kế tiếp
+        ghi lại file lưu trữ mà không có session này
+        """
+        query = select(ArchivedSession).where(ArchivedSession.session_id == session_id)
+        if user_id:
+            query = query.where(ArchivedSession.user_id == user_id)
+        entries = (await db.execute(query)).scalars().all()
+        if not entries:
+            return
+        turns: Dict[tuple, Dict] = {}
+        for entry in entries:
+            record = await asyncio.to_thread(self._read_member, entry.archive_file, entry.archive_offset, entry.user_id, entry.session_id)
+            for conv in (record or {}).get("conversations", []):
+                turns.setdefault((entry.user_id, conv["id"]), {
+                    "user_id": entry.user_id,
+                    "model": conv.get("model"),
+                    "rating": conv.get("rating"),
+                    "feedback": conv.get("feedback"),
+                    "timestamp": _decode_datetime(conv["timestamp"]),
+                    "rated_at": _decode_datetime(conv.get("rated_at")),
+                })
+            db.add(ArchiveTombstone(
+                session_id=entry.session_id,
+                user_id=entry.user_id,
+                archive_file=entry.archive_file,
+                archive_offset=entry.archive_offset
+            ))
+            await db.delete(entry)
+        await rating_rollups.record_turns(db, (row for row in turns.values() if row["user_id"] is not None), sign=-1)
+
+    async def purge_deleted(self) -> int:
+        """
+        Ghi lại các file lưu trữ có session đã bị xóa, chỉ giữ các session còn trong archived_sessions,
+        rồi xóa file cũ. File mới có tên khác nên database luôn trỏ tới một file hoàn chỉnh:
+        nếu dừng giữa chừng, file cũ hoặc file mới chỉ còn là file thừa và bị dọn ở lần sau
+        """
+        async with self.session_factory() as db:
+            result = await db.execute(select(ArchiveTombstone.archive_file).distinct())
+            filenames = result.scalars().all()
+        for filename in filenames:
+            await self._rewrite_file(filename)
+        await self._remove_unreferenced_files()
+        return len(filenames)
+
+    async def _rewrite_file(self, filename: str):
+        async with self.session_factory() as db:
+            entries = (await db.execute(
+                select(ArchivedSession).where(ArchivedSession.archive_file == filename)
+            )).scalars().all()
+            tombstones = (await db.execute(
+                select(ArchiveTombstone.id, ArchiveTombstone.archive_offset).where(ArchiveTombstone.archive_file == filename)
+            )).all()
+            tombstone_ids = [tombstone.id for tombstone in tombstones]
+
+            new_filename = None
+            new_offsets: Dict[int, int] = {}
+            path = os.path.join(self.archive_dir, filename)
+            if entries and os.path.exists(path):
+                keep = {(entry.archive_offset, entry.user_id, entry.session_id) for entry in entries}
+                members = await asyncio.to_thread(
+                    self._read_members, filename, [entry.archive_offset for entry in entries] + [tombstone.archive_offset for tombstone in tombstones]
+                )
+                kept = {
+                    offset: [record for record in records if (offset, record["user_id"], record["session_id"]) in keep]
+                    for offset, records in members.items()
+                }
+                kept = {offset: records for offset, records in kept.items() if records}
+                new_filename = f"{filename.split('.')[0]}.{uuid.uuid4().hex[:8]}.ndjson.gz"
+                offsets = await asyncio.to_thread(self._write_file, new_filename, list(kept.values()))
+                new_offsets = dict(zip(kept.keys(), offsets))
+
+            for old_offset, new_offset in new_offsets.items():
+                moved = {"archive_file": new_filename, "archive_offset": new_offset}
+                await db.execute(
+                    update(ArchivedSession)
+                    .where(ArchivedSession.archive_file == filename, ArchivedSession.archive_offset == old_offset)
+                    .values(**moved)
+                )
+                # Session bị xóa trong lúc ghi lại đã được chép sang file mới: tombstone chuyển theo để lần sau xóa nốt
+                await db.execute(
+                    update(ArchiveTombstone)
+                    .where(
+                        ArchiveTombstone.archive_file == filename,
+                        ArchiveTombstone.archive_offset == old_offset,
+                        ArchiveTombstone.id.not_in(tombstone_ids)
+                    )
+                    .values(**moved)
+                )
+            await db.execute(delete(ArchiveTombstone).where(ArchiveTombstone.archive_file == filename))
+            await db.commit()
+        if os.path.exists(path):
+            await asyncio.to_thread(os.remove, path)
+
+    async def _remove_unreferenced_files(self):
+        """
+        Xóa các file lưu trữ không còn session nào trỏ tới (bị ghi lại hoặc còn sót khi dừng giữa chừng)
+        """
+        async with self.session_factory() as db:
+            referenced = set((await db.execute(select(ArchivedSession.archive_file).distinct())).scalars().all())
+            referenced |= set((await db.execute(select(ArchiveTombstone.archive_file).distinct())).scalars().all())
+        for name in os.listdir(self.archive_dir):
+            if name.endswith(".ndjson.gz") and name not in referenced:
+                await asyncio.to_thread(os.remove, os.path.join(self.archive_dir, name))
+
+    def _read_member(self, filename: str, offset: int, user_id: int, session_id: str) -> Optional[Dict]:
+        path = os.path.join(self.archive_dir, filename)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            # Đọc từ member của batch; session nằm trong member này nên dừng ngay khi gặp
+            with gzip.GzipFile(fileobj=f) as member:
+                for line in member:
+                    record = json.loads(line)
+                    if record["user_id"] == user_id and record["session_id"] == session_id:
+                        return record
+        return None
+
+    async def read_session(self, db: AsyncSession, user_id: int, session_id: str) -> Optional[List[Dict]]:
+        """
+        Đọc lại lịch sử của một session đã lưu trữ (theo thứ tự thời gian), None nếu không có.
+        Một lượt có mặt trong nhiều member chỉ được trả về một lần
+        """
+        result = await db.execute(
+            select(ArchivedSession).where(
+                ArchivedSession.user_id == user_id,
+                ArchivedSession.session_id == session_id
+            ).order_by(ArchivedSession.id)
+        )
+        entries = result.scalars().all()
+        if not entries:
+            return None
+        conversations: Dict[int, Dict] = {}
+        for entry in entries:
+            record = await asyncio.to_thread(self._read_member, entry.archive_file, entry.archive_offset, user_id, session_id)
+            if record is not None:
+                for conv in record["conversations"]:
+                    conversations.setdefault(conv["id"], conv)
+        return sorted(conversations.values(), key=lambda conv: (conv["timestamp"] or "", conv["id"]))
+
+    async def list_sessions(self, db: AsyncSession, user_id: int, limit: int = 50, cursor: int = None) -> tuple:
+        """
+        Các session đã lưu trữ của user, mới nhất trước, phân trang theo id
+        """
+        query = select(ArchivedSession).where(ArchivedSession.user_id == user_id)
+        if cursor is not None:
+            query = query.where(ArchivedSession.id < cursor)
+        result = await db.execute(query.order_by(ArchivedSession.id.desc()).limit(limit + 1))
+        entries = result.scalars().all()
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = entries[-1].id
+        return [
+            {
+                "session_id": entry.session_id,
+                "first_message": entry.title,
+                "created_at": entry.created_at,
+                "last_activity": entry.last_activity,
+                "turn_count": entry.turn_count,
+                "model": entry.model,
+                "archived_at": entry.archived_at
+            }
+            for entry in entries
+        ], next_cursor
+
+    async def compact(self):
+        """
+        Trả các trang trống cho hệ điều hành (incremental vacuum), thu gọn WAL và cập nhật thống kê cho query planner
+        """
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if not self.is_sqlite:
+                await conn.execute(text("ANALYZE"))
+                return
+            mode = (await conn.execute(text("PRAGMA auto_vacuum"))).scalar()
+            if mode != 2:
+                # Database tạo trước khi bật auto_vacuum: VACUUM đầy đủ sẽ khóa database khi server
+                # đang chạy, nên việc chuyển chế độ chỉ làm ở bước migrate (python migrate.py)
+                print("Database is not in incremental auto_vacuum mode, skipping vacuum (run migrate.py to convert)")
+            else:
+                pages = f"({RETENTION_VACUUM_PAGES})" if RETENTION_VACUUM_PAGES else ""
+                # Mỗi bước của lệnh trả lại một trang, nhưng lệnh không có cột kết quả nên execute()
+                # của sqlite3 chỉ chạy một bước; executescript() chạy lệnh tới hết
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum{pages};")
+            await conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+            await conn.execute(text("ANALYZE"))
+
+    def stats(self) -> Dict:
+        return {
+            "max_age_days": self.max_age_days,
+            "max_db_mb": RETENTION_MAX_DB_MB,
+            "archived_sessions": self.archived_sessions,
+            "archived_turns": self.archived_turns,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
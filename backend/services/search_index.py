@@ -0,0 +1,224 @@
+from functools import lru_cache
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Optional, Tuple
+import os
+import re
+import unicodedata
+
+# Tắt chỉ mục FTS5 (vd. khi bản SQLite không có FTS5); tìm kiếm khi đó quét bằng LIKE
+SEARCH_FTS_ENABLED = os.getenv("SEARCH_FTS_ENABLED", "1") == "1"
+# Độ dài đoạn trích trả về cho mỗi kết quả
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "160"))
+
+FTS_TABLE = "conversations_fts"
+# Trọng số bm25 theo thứ tự cột: khớp ở câu hỏi của user quan trọng hơn ở câu trả lời,
+# cột owner chỉ dùng để lọc nên không tính điểm
+BM25_WEIGHTS = (2.0, 1.0, 0.0)
+BACKFILL_BATCH_SIZE = 1000
+
+_TOKEN_RE = re.compile(r"\w+")
+
+@lru_cache(maxsize=4096)
+def _fold_char(ch: str) -> str:
+    if ch in ("đ", "Đ"):
+        return "d"
+    base = "".join(c for c in unicodedata.normalize("NFD", ch) if unicodedata.category(c) != "Mn").lower()
+    # Giữ nguyên 1 ký tự -> 1 ký tự để vị trí trong chuỗi đã bỏ dấu khớp với chuỗi gốc
+    return base if len(base) == 1 else ch
+
+def fold_text(value: str) -> str:
+    """
+    Bỏ dấu tiếng Việt (kể cả đ -> d) và chuyển chữ thường, giữ nguyên độ dài chuỗi (dạng NFC)
+    """
+    return "".join(_fold_char(ch) for ch in unicodedata.normalize("NFC", value or ""))
+
+def owner_token(user_id: int) -> str:
+    """
+    Token định danh chủ sở hữu, được đánh chỉ mục để MATCH chỉ duyệt các dòng của một user
+    """
+    return f"u{user_id}"
+
+def query_terms(query: str) -> List[str]:
+    return _TOKEN_RE.findall(fold_text(query))
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    Chuyển chuỗi tìm kiếm của user thành biểu thức MATCH: mọi từ đều phải xuất hiện,
+    từ cuối cùng khớp theo tiền tố để tìm được khi người dùng chưa gõ hết
+    """
+    terms = query_terms(query)
+    if not terms:
+        return None
+    parts = [f'"{term}"' for term in terms]
+    parts[-1] += "*"
+    return " ".join(parts)
+
+def make_snippet(original: str, terms: List[str], width: int = SEARCH_SNIPPET_CHARS) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Cắt đoạn trích quanh lần khớp đầu tiên, trả về (đoạn trích, danh sách vị trí [start, end)
+    của các từ khớp trong đoạn trích)
+    """
+    original = unicodedata.normalize("NFC", original or "")
+    folded = fold_text(original)
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*") if terms else None
+    matches = list(pattern.finditer(folded)) if pattern else []
+
+    start = 0
+    if matches and len(original) > width:
+        # Đặt lần khớp đầu tiên ở khoảng 1/3 đoạn trích, lùi về đầu từ
+        start = max(0, matches[0].start() - width // 3)
+        while start > 0 and not original[start - 1].isspace():
+            start -= 1
+    end = min(len(original), start + width)
+    if end < len(original):
+        while end > start + width // 2 and not original[end].isspace():
+            end -= 1
+
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if end < len(original) else ""
+    highlights = [
+        (m.start() - start + len(prefix), min(m.end(), end) - start + len(prefix))
+        for m in matches if m.start() >= start and m.start() < end
+    ]
+    return prefix + original[start:end] + suffix, highlights
+
+def is_enabled(db: AsyncSession) -> bool:
+    return SEARCH_FTS_ENABLED and db.bind.dialect.name == "sqlite"
+
+def create_fts_table(conn) -> bool:
+    """
+    Tạo bảng FTS5 (nếu chưa có) trên kết nối đồng bộ, trả về True nếu bảng vừa được tạo.
+    Bảng theo định dạng cũ (user_id không được đánh chỉ mục) được tạo lại để backfill
+    """
+    exists = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+    ).first() is not None
+    if exists:
+        columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({FTS_TABLE})"))}
+        if "owner" in columns:
+            return False
+        conn.execute(text(f"DROP TABLE {FTS_TABLE}"))
+    # Nội dung được bỏ dấu trước khi ghi, unicode61 chỉ cần tách từ
+    conn.execute(text(f"""
+        CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+            user_message, bot_response, owner,
+            session_id UNINDEXED, rating UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """))
+    return True
+
+def backfill(conn):
+    """
+    Đưa các cuộc hội thoại đã có vào chỉ mục (chạy một lần khi bảng FTS mới được tạo)
+    """
+    last_id = 0
+    while True:
+        rows = conn.execute(text("""
+            SELECT id, user_id, session_id, user_message, bot_response, rating
+            FROM conversations WHERE id > :last_id ORDER BY id LIMIT :limit
+        """), {"last_id": last_id, "limit": BACKFILL_BATCH_SIZE}).all()
+        if not rows:
+            return
+        conn.execute(text(f"""
+            INSERT INTO {FTS_TABLE} (rowid, user_message, bot_response, owner, session_id, rating)
+            VALUES (:id, :user_message, :bot_response, :owner, :session_id, :rating)
+        """), [
+            {
+                "id": row.id,
+                "user_message": fold_text(row.user_message),
+                "bot_response": fold_text(row.bot_response),
+                "owner": owner_token(row.user_id),
+                "session_id": row.session_id,
+                "rating": row.rating,
+            }
+            for row in rows
+        ])
+        last_id = rows[-1].id
+
+async def add(db: AsyncSession, conversation):
+    """
+    Thêm một lượt chat vào chỉ mục trong cùng transaction (conversation đã có id)
+    """
+    await add_many(db, [{
+        "id": conversation.id,
+        "user_message": conversation.user_message,
+        "bot_response": conversation.bot_response,
+        "user_id": conversation.user_id,
+        "session_id": conversation.session_id,
+        "rating": conversation.rating,
+    }])
+
+async def add_many(db: AsyncSession, rows: List[Dict]):
+    """
+    Thêm nhiều lượt chat (dict có id, user_message, bot_response, user_id, session_id, rating)
+    bằng một lệnh executemany
+    """
+    if not rows:
+        return
+    await db.execute(text(f"""
+        INSERT INTO {FTS_TABLE} (rowid, user_message, bot_response, owner, session_id, rating)
+        VALUES (:id, :user_message, :bot_response, :owner, :session_id, :rating)
+    """), [
+        {
+            "id": row["id"],
+            "user_message": fold_text(row["user_message"]),
+            "bot_response": fold_text(row["bot_response"]),
+            "owner": owner_token(row["user_id"]),
+            "session_id": row["session_id"],
+            "rating": row["rating"],
+        }
+        for row in rows
+    ])
+
+async def update_rating(db: AsyncSession, conversation_id: int, rating: float):
+    await db.execute(
+        text(f"UPDATE {FTS_TABLE} SET rating = :rating WHERE rowid = :id"),
+        {"rating": rating, "id": conversation_id}
+    )
+
+async def remove_session(db: AsyncSession, session_id: str, user_id: int = None):
+    """
+    Xóa các lượt của session khỏi chỉ mục, gọi trước khi xóa dòng trong conversations
+    """
+    query = f"DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT id FROM conversations WHERE session_id = :session_id"
+    params = {"session_id": session_id}
+    if user_id:
+        query += " AND user_id = :user_id"
+        params["user_id"] = user_id
+    await db.execute(text(query + ")"), params)
+
+async def remove_conversations(db: AsyncSession, conversation_ids: List[int]):
+    """
+    Xóa các lượt theo id khỏi chỉ mục
+    """
+    if conversation_ids:
+        await db.execute(
+            text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(str(int(i)) for i in conversation_ids)})")
+        )
+
+async def search(db: AsyncSession, user_id: int, query: str, limit: int = 20, offset: int = 0, session_id: str = None, min_rating: float = None) -> List[Tuple[int, float]]:
+    """
+    Tìm trong chỉ mục, trả về [(conversation_id, điểm bm25)] - điểm càng nhỏ càng liên quan.
+    Token của user nằm trong biểu thức MATCH nên FTS5 chỉ duyệt các dòng của user đó
+    """
+    terms = build_match_query(query)
+    if terms is None:
+        return []
+    match = f'owner : "{owner_token(user_id)}" AND {{user_message bot_response}} : ({terms})'
+    weights = ", ".join(str(weight) for weight in BM25_WEIGHTS)
+    sql = f"""
+        SELECT rowid, bm25({FTS_TABLE}, {weights}) AS score
+        FROM {FTS_TABLE}
+        WHERE {FTS_TABLE} MATCH :match
+    """
+    params = {"match": match, "limit": limit, "offset": offset}
+    if session_id:
+        sql += " AND session_id = :session_id"
+        params["session_id"] = session_id
+    if min_rating is not None:
+        sql += " AND rating >= :min_rating"
+        params["min_rating"] = min_rating
+    result = await db.execute(text(sql + " ORDER BY score LIMIT :limit OFFSET :offset"), params)
+    return [(row.rowid, row.score) for row in result]
@@ -0,0 +1,137 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from services.conversation_service import ConversationService
+from services.inference_scheduler import InferenceScheduler, SchedulerFull
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import os
+
+# Bật tóm tắt cuộn: các lượt cũ được gộp dần vào một bản tóm tắt của session
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "0") == "1"
+# Gộp khi có ít nhất chừng này lượt cũ hơn phần lịch sử giữ nguyên
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "4"))
+# Số lượt gần nhất luôn được gửi nguyên văn, không gộp vào tóm tắt
+SUMMARY_KEEP_RECENT_TURNS = int(os.getenv("SUMMARY_KEEP_RECENT_TURNS", "6"))
+# Độ dài tối đa của bản tóm tắt (token sinh ra)
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+# Model dùng để tóm tắt, để trống thì dùng model mặc định
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "")
+# Số lượt tối đa gộp trong một lần gọi model (session dài được gộp qua nhiều lần)
+SUMMARY_FOLD_BATCH = 20
+
+# Tác vụ tóm tắt xếp hàng trong scheduler như một user riêng để không chiếm hết lượt của user thật
+SUMMARY_SCHEDULER_USER = 0
+
+SUMMARY_PROMPT = """Bạn đang duy trì bản tóm tắt của một cuộc hội thoại giữa người dùng và trợ lý AI.
+Hãy cập nhật bản tóm tắt bằng tiếng Việt, ngắn gọn, giữ lại các sự kiện, thông tin cá nhân,
+yêu cầu và kết luận quan trọng. Chỉ trả về bản tóm tắt mới.
+
+Bản tóm tắt hiện tại:
+{summary}
+
+Các lượt hội thoại mới cần gộp vào:
+{turns}
+
+Bản tóm tắt mới:"""
+
+class SessionSummarizer:
+    """
+    Gộp các lượt cũ của session vào bản tóm tắt lưu trong chat_sessions, chạy ở nền
+    sau khi lượt chat đã được lưu để không cộng thêm độ trễ cho người dùng
+    """
+    def __init__(self, ollama_service, scheduler: InferenceScheduler, session_factory: Callable[[], AsyncSession], model: str = None):
+        self.service = ollama_service
+        self.scheduler = scheduler
+        self.session_factory = session_factory
+        self.model = model or SUMMARY_MODEL or ollama_service.model
+        self.every_turns = SUMMARY_EVERY_TURNS
+        self.keep_recent = SUMMARY_KEEP_RECENT_TURNS
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        # Session có lượt mới trong lúc đang tóm tắt, cần kiểm tra lại sau khi xong
+        self._pending: Set[Tuple[int, str]] = set()
+        self.completed = 0
+        self.failed = 0
+
+    def schedule(self, user_id: int, session_id: str):
+        """
+        Yêu cầu kiểm tra và tóm tắt session ở nền; mỗi session chỉ có một tác vụ chạy cùng lúc
+        """
+        key = (user_id, session_id)
+        if key in self._tasks:
+            self._pending.add(key)
+            return
+        self._tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key: Tuple[int, str]):
+        try:
+            while True:
+                self._pending.discard(key)
+                await self._summarize(*key)
+                if key not in self._pending:
+                    return
+        except Exception as e:
+            self.failed += 1
+            print(f"Error summarizing session {key[1]}: {e}")
+        finally:
+            self._tasks.pop(key, None)
+
+    async def _summarize(self, user_id: int, session_id: str):
+        async with self.session_factory() as db:
+            conv_service = ConversationService(db)
+            summary, until_id = await conv_service.get_session_summary(session_id, user_id)
+            while True:
+                turns, _ = await conv_service.get_history_page(
+                    session_id, user_id, limit=SUMMARY_FOLD_BATCH + self.keep_recent, cursor=until_id
+                )
+                fold = turns[:max(0, len(turns) - self.keep_recent)]
+                if len(fold) < self.every_turns:
+                    return
+                new_summary = await self._fold(summary, fold)
+                if not new_summary:
+                    return
+                # Chỉ ghi nếu bản tóm tắt chưa bị tác vụ khác (worker khác) cập nhật
+                if not await conv_service.save_session_summary(session_id, user_id, new_summary, fold[-1]["id"], until_id):
+                    return
+                self.completed += 1
+                summary, until_id = new_summary, fold[-1]["id"]
+
+    async def _fold(self, summary: Optional[str], turns: List[Dict]) -> Optional[str]:
+        prompt = SUMMARY_PROMPT.format(
+            summary=summary or "(chưa có)",
+            turns="\n\n".join(f"Người dùng: {conv['user_message']}\nAI: {conv['bot_response']}" for conv in turns)
+        )
+        try:
+            ticket = await self.scheduler.acquire(self.model, SUMMARY_SCHEDULER_USER)
+        except SchedulerFull:
+            # Hệ thống đang bận: bỏ qua, lượt chat tiếp theo sẽ thử lại
+            return None
+        try:
+            response = await self.service._post("/api/generate", {
+                "model": self.model,
+                "prompt": prompt,
+                "stream": False,
+                "keep_alive": self.service.model_manager.keep_alive_for(self.model),
+                "options": {"temperature": 0.2, "num_predict": SUMMARY_MAX_TOKENS}
+            })
+        finally:
+            self.scheduler.release(ticket)
+        if response.status_code != 200:
+            self.failed += 1
+            return None
+        return response.json().get("response", "").strip() or None
+
+    async def stop(self):
+        """
+        Hủy các tác vụ tóm tắt còn dang dở (sẽ được làm lại ở lượt chat sau)
+        """
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "model": self.model,
+            "running": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,186 @@
+from typing import Dict, Optional
+import asyncio
+import importlib
+import os
+import sqlite3
+import threading
+import time
+
+# Nơi lưu trạng thái dùng chung giữa các worker:
+#   local  - trong bộ nhớ của từng process (mặc định, đủ khi chạy một worker)
+#   sqlite - file SQLite dùng chung cho các worker trên cùng máy
+#   module:Class - backend tự viết (vd. Redis), khởi tạo không tham số
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "local")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "./shared_state.db")
+
+class LocalStateBackend:
+    """
+    Trạng thái trong bộ nhớ của process: key-value có TTL và các lease giới hạn số lượng
+    """
+    distributed = False
+
+    def __init__(self):
+        self._values: Dict[str, tuple] = {}
+        self._leases: Dict[str, Dict[str, float]] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            del self._values[key]
+            return None
+        return entry[0]
+
+    async def set(self, key: str, value: str, ttl: float = None):
+        self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+
+    async def acquire_lease(self, name: str, owner: str, limit: int, ttl: float) -> bool:
+        """
+        Giữ một trong `limit` chỗ của `name`; lease tự hết hạn sau `ttl` giây nếu không được trả
+        """
+        now = time.time()
+        leases = {o: expires for o, expires in self._leases.get(name, {}).items() if expires > now}
+        if owner not in leases and len(leases) >= limit:
+            self._leases[name] = leases
+            return False
+        leases[owner] = now + ttl
+        self._leases[name] = leases
+        return True
+
+    async def release_lease(self, name: str, owner: str):
+        self._leases.get(name, {}).pop(owner, None)
+
+    async def count_leases(self, name: str) -> int:
+        now = time.time()
+        return sum(1 for expires in self._leases.get(name, {}).values() if expires > now)
+
+    async def close(self):
+        pass
+
+class SQLiteStateBackend:
+    """
+    Trạng thái trong một file SQLite (WAL) dùng chung giữa các worker trên cùng máy.
+    Mỗi thao tác là một transaction ngắn (BEGIN IMMEDIATE) nên các worker không giẫm lên nhau
+    """
+    distributed = True
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        # Mở kết nối khi dùng lần đầu, không mở lúc import (process cha có thể fork ra các worker)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        with self._conn_lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS shared_values (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL,
+                        expires_at REAL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS shared_leases (
+                        name TEXT NOT NULL,
+                        owner TEXT NOT NULL,
+                        expires_at REAL NOT NULL,
+                        PRIMARY KEY (name, owner)
+                    )
+                """)
+                self._conn = conn
+            return self._conn
+
+    def _run(self, func, *args):
+        conn = self._connect()
+        with self._conn_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn, *args)
+                conn.execute("COMMIT")
+                return result
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._run, self._get, key)
+
+    async def set(self, key: str, value: str, ttl: float = None):
+        await asyncio.to_thread(self._run, self._set, key, value, ttl)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._run, lambda conn: conn.execute("DELETE FROM shared_values WHERE key = ?", (key,)))
+
+    async def acquire_lease(self, name: str, owner: str, limit: int, ttl: float) -> bool:
+        return await asyncio.to_thread(self._run, self._acquire_lease, name, owner, limit, ttl)
+
+    async def release_lease(self, name: str, owner: str):
+        await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "DELETE FROM shared_leases WHERE name = ? AND owner = ?", (name, owner)
+        ))
+
+    async def count_leases(self, name: str) -> int:
+        return await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "SELECT COUNT(*) FROM shared_leases WHERE name = ? AND expires_at > ?", (name, time.time())
+        ).fetchone()[0])
+
+    async def close(self):
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value, expires_at FROM shared_values WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < time.time():
+            conn.execute("DELETE FROM shared_values WHERE key = ?", (key,))
+            return None
+        return row[0]
+
+    @staticmethod
+    def _set(conn: sqlite3.Connection, key: str, value: str, ttl: float = None):
+        conn.execute(
+            "INSERT OR REPLACE INTO shared_values (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None)
+        )
+
+    @staticmethod
+    def _acquire_lease(conn: sqlite3.Connection, name: str, owner: str, limit: int, ttl: float) -> bool:
+        now = time.time()
+        # Dọn lease của worker đã chết (hết hạn mà không được trả)
+        conn.execute("DELETE FROM shared_leases WHERE name = ? AND expires_at <= ?", (name, now))
+        held = conn.execute(
+            "SELECT 1 FROM shared_leases WHERE name = ? AND owner = ?", (name, owner)
+        ).fetchone() is not None
+        if not held:
+            count = conn.execute("SELECT COUNT(*) FROM shared_leases WHERE name = ?", (name,)).fetchone()[0]
+            if count >= limit:
+                return False
+        conn.execute(
+            "INSERT OR REPLACE INTO shared_leases (name, owner, expires_at) VALUES (?, ?, ?)",
+            (name, owner, now + ttl)
+        )
+        return True
+
+def create_shared_state(backend: str = SHARED_STATE_BACKEND):
+    if backend == "local":
+        return LocalStateBackend()
+    if backend == "sqlite":
+        return SQLiteStateBackend(SHARED_STATE_PATH)
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(f"SHARED_STATE_BACKEND không hợp lệ: {backend}")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+shared_state = create_shared_state()
@@ -0,0 +1,278 @@
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Set, Tuple, Type
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+
+# Giữ kết quả của một lượt đã xong (chỉ với request có Idempotency-Key) trong vài giây để
+# request gửi lại ngay sau đó nhận chung kết quả
+SINGLE_FLIGHT_TTL = float(os.getenv("SINGLE_FLIGHT_TTL", "5"))
+# Khi chạy nhiều worker, worker đang sinh giữ lease của key; lease của worker chết giữa chừng
+# tự hết hạn sau khoảng này (giây), nên phải dài hơn một lượt sinh
+SINGLE_FLIGHT_LEASE_TTL = float(os.getenv("SINGLE_FLIGHT_LEASE_TTL", "600"))
+# Chu kỳ (giây) request ở worker khác kiểm tra kết quả trong shared state
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", "0.2"))
+
+class Flight:
+    """
+    Một lượt sinh đang chạy: lưu các token đã sinh để request gắn vào sau vẫn nhận đủ từ đầu
+    """
+    def __init__(self, key: str):
+        self.key = key
+        self.parts: List[str] = []
+        self.result: Optional[Dict] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.followers = 0
+        # Worker này giữ lease của key trong shared state (nhiều worker)
+        self.leased = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        # Đánh thức mọi subscriber đang chờ rồi tạo event mới cho lần chờ tiếp theo
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, token: str):
+        self.parts.append(token)
+        self._notify()
+
+    def finish(self, result: Dict):
+        if not self.settled:
+            self.result = result
+            self._settle()
+
+    def fail(self, error: BaseException):
+        if not self.settled:
+            self.error = error
+            self._settle()
+
+    @property
+    def settled(self) -> bool:
+        return self.done or self.result is not None or self.error is not None
+
+    def _settle(self):
+        # Flight giữ lease chỉ kết thúc sau khi kết quả đã được ghi vào shared state và lease
+        # được trả, để request gửi tiếp sau khi nhận kết quả không gắn nhầm vào lượt cũ
+        if not self.leased:
+            self.done = True
+            self._notify()
+
+    async def stream(self) -> AsyncIterator[str]:
+        """
+        Phát lại các token đã có rồi tiếp tục nhận token mới cho tới khi lượt sinh kết thúc
+        """
+        index = 0
+        while True:
+            while index < len(self.parts):
+                yield self.parts[index]
+                index += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+    async def wait(self) -> Dict:
+        while not self.done:
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    """
+    Gộp các request trùng nhau (cùng idempotency key hoặc cùng user/session/nội dung) đang
+    chạy đồng thời vào một lượt sinh duy nhất. Lượt sinh chạy trong task nền, không phụ
+    thuộc vào kết nối của request đầu tiên, nên request gửi lại sau khi tải lại trang vẫn
+    gắn vào được và lượt chat chỉ được lưu một lần.
+    Request không có idempotency key chỉ được gộp khi lượt sinh còn đang chạy: cùng một
+    tin nhắn gửi lần lượt hai lần là hai lượt chat khác nhau.
+    Với shared state dùng chung (nhiều worker), chỉ worker giữ lease của key được sinh;
+    request trùng ở worker khác chờ kết quả (hoặc lỗi thuộc `shared_errors`) được ghi vào
+    shared state rồi phát lại các token một lần khi lượt sinh xong.
+    """
+    def __init__(self, ttl: float = SINGLE_FLIGHT_TTL, shared=None, shared_errors: Tuple[Type[Exception], ...] = (),
+                 lease_ttl: float = SINGLE_FLIGHT_LEASE_TTL, poll_interval: float = SINGLE_FLIGHT_POLL_INTERVAL):
+        self.ttl = ttl
+        self._flights: Dict[str, Flight] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.deduplicated = 0
+        # Backend local chỉ thấy process hiện tại, gộp trong process là đủ
+        self.shared = shared if shared is not None and shared.distributed else None
+        # Lỗi được dựng lại ở worker khác theo tên lớp, các lỗi khác chỉ báo chung chung
+        self.shared_errors = {error.__name__: error for error in shared_errors}
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.lease_owner = uuid.uuid4().hex
+
+    @staticmethod
+    def make_key(user_id: int, session_id: str, message: str, model: str = None, idempotency_key: str = None) -> str:
+        if idempotency_key:
+            return f"{user_id}:key:{idempotency_key}"
+        raw = f"{user_id}\x00{session_id}\x00{model or ''}\x00{message}"
+        return f"{user_id}:hash:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+    @staticmethod
+    def _replayable(key: str) -> bool:
+        """
+        Chỉ key từ Idempotency-Key được nhận lại kết quả sau khi lượt sinh đã xong
+        """
+        return key.split(":", 2)[1] == "key"
+
+    async def join(self, key: str) -> Tuple[Flight, bool]:
+        """
+        Trả về (flight, True nếu là request đầu tiên và phải tự khởi chạy lượt sinh)
+        """
+        flight = self._flights.get(key)
+        if flight is not None and flight.error is None and (not flight.done or self._replayable(key)):
+            flight.followers += 1
+            self.deduplicated += 1
+            return flight, False
+        flight = Flight(key)
+        # Đăng ký trước khi chờ shared state để request trùng trong worker này gắn vào ngay
+        self._flights[key] = flight
+        if self.shared is None:
+            return flight, True
+        try:
+            if await self._claim(flight):
+                return flight, True
+        except BaseException as e:
+            flight.fail(e)
+            self._forget(flight)
+            raise
+        # Worker khác đang sinh (hoặc vừa sinh xong): chờ kết quả của nó
+        self.deduplicated += 1
+        self.run(flight, self._follow_remote(flight))
+        return flight, False
+
+    @staticmethod
+    def _lease_name(key: str) -> str:
+        return f"single_flight:{key}"
+
+    @staticmethod
+    def _outcome_key(key: str) -> str:
+        return f"single_flight:outcome:{key}"
+
+    async def _read_outcome(self, key: str) -> Optional[Dict]:
+        value = await self.shared.get(self._outcome_key(key))
+        return json.loads(value) if value is not None else None
+
+    async def _claim(self, flight: Flight) -> bool:
+        """
+        Giữ lease của key nếu chưa worker nào đang sinh (hay, với idempotency key, vừa sinh xong)
+        cho key này. Lượt trước lỗi thì sinh lại như khi chạy một worker
+        """
+        replayable = self._replayable(flight.key)
+        if replayable and self._succeeded(await self._read_outcome(flight.key)):
+            return False
+        if not await self.shared.acquire_lease(self._lease_name(flight.key), self.lease_owner, 1, self.lease_ttl):
+            return False
+        # Lượt ở worker khác có thể vừa xong giữa hai bước trên
+        outcome = await self._read_outcome(flight.key)
+        if replayable and self._succeeded(outcome):
+            await self.shared.release_lease(self._lease_name(flight.key), self.lease_owner)
+            return False
+        if outcome is not None:
+            # Kết quả hoặc lỗi của lượt trước, không để request trùng với lượt mới đọc nhầm
+            await self.shared.delete(self._outcome_key(flight.key))
+        flight.leased = True
+        return True
+
+    @staticmethod
+    def _succeeded(outcome: Optional[Dict]) -> bool:
+        return outcome is not None and "error" not in outcome
+
+    async def _follow_remote(self, flight: Flight):
+        """
+        Chờ lượt sinh ở worker khác: đọc kết quả trong shared state cho tới khi có, hoặc cho tới
+        khi lease được trả mà không có kết quả (lượt sinh lỗi hoặc worker chết)
+        """
+        while True:
+            outcome = await self._read_outcome(flight.key)
+            if outcome is None and await self.shared.count_leases(self._lease_name(flight.key)) == 0:
+                # Kết quả được ghi trước khi trả lease: đọc lại lần cuối
+                outcome = await self._read_outcome(flight.key)
+                if outcome is None:
+                    raise RuntimeError("Lượt sinh ở worker khác kết thúc mà không có kết quả")
+            if outcome is not None:
+                break
+            await asyncio.sleep(self.poll_interval)
+        if "error" in outcome:
+            error = self.shared_errors.get(outcome["error"], RuntimeError)
+            raise error(outcome["detail"])
+        for part in outcome["parts"]:
+            flight.publish(part)
+        flight.finish(outcome["result"])
+
+    async def _publish_outcome(self, flight: Flight):
+        """
+        Ghi kết quả (hoặc lỗi dựng lại được) của lượt sinh cho worker khác rồi trả lease.
+        Không có idempotency key thì kết quả chỉ giữ đủ lâu cho các request đang chờ đọc
+        """
+        ttl = self.ttl if self._replayable(flight.key) else self.poll_interval * 10
+        try:
+            if flight.error is None:
+                outcome = {"parts": flight.parts, "result": flight.result}
+                await self.shared.set(self._outcome_key(flight.key), json.dumps(outcome, ensure_ascii=False, default=str), ttl)
+            elif type(flight.error).__name__ in self.shared_errors:
+                outcome = {"error": type(flight.error).__name__, "detail": str(flight.error)}
+                await self.shared.set(self._outcome_key(flight.key), json.dumps(outcome, ensure_ascii=False), ttl)
+        finally:
+            try:
+                await self.shared.release_lease(self._lease_name(flight.key), self.lease_owner)
+            finally:
+                flight.leased = False
+                flight._settle()
+
+    def run(self, flight: Flight, work: Awaitable):
+        """
+        Chạy lượt sinh ở nền; `work` tự gọi flight.publish()/finish()
+        """
+        task = asyncio.create_task(self._run(flight, work))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, flight: Flight, work: Awaitable):
+        try:
+            await work
+        except BaseException as e:
+            flight.fail(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if not flight.settled:
+                flight.fail(RuntimeError("Lượt sinh kết thúc mà không có kết quả"))
+            if flight.leased:
+                try:
+                    await self._publish_outcome(flight)
+                except Exception as e:
+                    print(f"Error publishing single-flight result: {e}")
+            if flight.error is not None or not self._replayable(flight.key):
+                self._forget(flight)
+            else:
+                asyncio.get_running_loop().call_later(self.ttl, self._forget, flight)
+
+    async def abandon(self, flight: Flight, error: BaseException):
+        """
+        Request đầu tiên lỗi trước khi kịp khởi chạy lượt sinh (vd. scheduler đầy)
+        """
+        flight.fail(error)
+        self._forget(flight)
+        if flight.leased:
+            await self._publish_outcome(flight)
+
+    def _forget(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def shutdown(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": sum(1 for flight in self._flights.values() if not flight.done),
+            "deduplicated": self.deduplicated,
+        }
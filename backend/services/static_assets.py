@@ -0,0 +1,144 @@
+from fastapi import Request, Response
+from services.compression import COMPRESSIBLE_TYPES, compress, negotiate, supported_encodings
+from typing import Dict, Optional
+import hashlib
+import mimetypes
+import os
+import re
+
+# Nén sẵn và gắn hash vào tên asset khi khởi động; tắt (0) khi đang sửa frontend để đọc file trực tiếp
+STATIC_PRECOMPRESS = os.getenv("STATIC_PRECOMPRESS", "1") == "1"
+# Asset có hash trong tên không bao giờ đổi nội dung nên được cache một năm
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# HTML và asset gọi bằng tên gốc phải hỏi lại server (rẻ nhờ ETag/304) để luôn thấy bản mới
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+STATIC_PREFIX = "/static/"
+HASH_LENGTH = 10
+_REFERENCE_RE = re.compile(r'((?:src|href)=["\'])' + re.escape(STATIC_PREFIX) + r'([^"\'?#]+)')
+
+class Asset:
+    """
+    Một file frontend với các bản đã nén sẵn theo từng encoding
+    """
+    def __init__(self, name: str, content: bytes, hashed_name: str = None, immutable: bool = False):
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        self.name = name
+        self.content_type = content_type
+        self.digest = hashlib.sha256(content).hexdigest()
+        self.hashed_name = hashed_name or name
+        self.immutable = immutable
+        self.variants: Dict[Optional[str], bytes] = {None: content}
+        if content_type.startswith(COMPRESSIBLE_TYPES):
+            for encoding in supported_encodings():
+                compressed = compress(content, encoding, best=True)
+                if len(compressed) < len(content):
+                    self.variants[encoding] = compressed
+
+    def etag(self, encoding: Optional[str]) -> str:
+        # Mỗi encoding là một biểu diễn khác nhau nên cần ETag riêng
+        suffix = f"-{encoding}" if encoding else ""
+        return f'"{self.digest[:16]}{suffix}"'
+
+    def with_cache_policy(self, immutable: bool) -> "Asset":
+        asset = object.__new__(Asset)
+        asset.__dict__.update(self.__dict__)
+        asset.immutable = immutable
+        return asset
+
+class StaticAssets:
+    """
+    Pipeline asset cho frontend: đọc các file một lần, đặt tên theo hash nội dung
+    (vd. script.3f2a9c1d0e.js), nén sẵn gzip/brotli và sửa đường dẫn trong HTML
+    sang tên có hash để trình duyệt cache vĩnh viễn
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._assets: Dict[str, Asset] = {}
+
+    @staticmethod
+    def _hashed_name(name: str, content: bytes) -> str:
+        root, ext = os.path.splitext(name)
+        return f"{root}.{hashlib.sha256(content).hexdigest()[:HASH_LENGTH]}{ext}"
+
+    def build(self) -> "StaticAssets":
+        files = {}
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    files[name] = f.read()
+
+        assets: Dict[str, Asset] = {}
+        # Asset thường trước, HTML sau vì HTML cần biết tên có hash của chúng
+        for name, content in sorted(files.items(), key=lambda item: item[0].endswith(".html")):
+            if name.endswith(".html"):
+                content = self._rewrite_references(content.decode("utf-8"), assets).encode("utf-8")
+                assets[name] = Asset(name, content)
+                continue
+            hashed_name = self._hashed_name(name, content)
+            asset = Asset(name, content, hashed_name, immutable=True)
+            assets[hashed_name] = asset
+            # Tên gốc vẫn dùng được (vd. link cũ) nhưng phải hỏi lại server
+            assets[name] = asset.with_cache_policy(immutable=False)
+        self._assets = assets
+        return self
+
+    @staticmethod
+    def _rewrite_references(html: str, assets: Dict[str, Asset]) -> str:
+        def replace(match):
+            asset = assets.get(match.group(2))
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}{STATIC_PREFIX}{asset.hashed_name}"
+        return _REFERENCE_RE.sub(replace, html)
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self._assets.get(name)
+
+    def url_for(self, name: str) -> str:
+        asset = self._assets.get(name)
+        return STATIC_PREFIX + (asset.hashed_name if asset else name)
+
+    def response(self, request: Request, name: str) -> Optional[Response]:
+        """
+        Response cho asset: chọn bản nén theo Accept-Encoding, trả 304 nếu client đã có
+        bản này (If-None-Match). None nếu không có asset
+        """
+        asset = self._assets.get(name)
+        if asset is None:
+            return None
+        available = [encoding for encoding in asset.variants if encoding is not None]
+        encoding = negotiate(request.headers.get("accept-encoding", ""), available)
+        etag = asset.etag(encoding)
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if asset.immutable else REVALIDATE_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        body = asset.variants[encoding]
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(content=body, media_type=asset.content_type, headers=headers)
+
+    def stats(self) -> Dict:
+        unique = {id(asset.variants[None]): asset for asset in self._assets.values()}.values()
+        return {
+            "assets": len(unique),
+            "bytes": sum(len(asset.variants[None]) for asset in unique),
+            "compressed_bytes": {
+                encoding: sum(len(asset.variants.get(encoding, asset.variants[None])) for asset in unique)
+                for encoding in supported_encodings()
+            },
+        }
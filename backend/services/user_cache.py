@@ -0,0 +1,145 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from collections import OrderedDict
+from database import User
+from models.schemas import UserResponse
+from services.shared_state import shared_state
+from typing import Dict, Optional, Set
+import asyncio
+import threading
+import time
+import uuid
+import os
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "1024"))
+# Khi chạy nhiều worker: khoảng thời gian (giây) tối đa một worker còn dùng thông tin user
+# đã bị worker khác sửa, mỗi khoảng này đọc shared state một lần
+USER_CACHE_SYNC_INTERVAL = float(os.getenv("USER_CACHE_SYNC_INTERVAL", "1"))
+
+GENERATION_KEY = "user_cache:generation"
+
+class UserCache:
+    """
+    Cache LRU + TTL cho thông tin user đã xác thực, key là subject (username) của token.
+    Với shared state dùng chung (nhiều worker), mỗi lần user bị sửa hoặc xóa thì một
+    "generation" trong shared state được đổi; worker thấy generation khác thì xóa cache của mình
+    """
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_MAX_SIZE, shared=None, sync_interval: float = USER_CACHE_SYNC_INTERVAL):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Backend local chỉ thấy process hiện tại, xóa entry cục bộ là đủ
+        self.shared = shared if shared is not None and shared.distributed else None
+        self.sync_interval = sync_interval
+        self._generation: Optional[str] = None
+        self._next_sync = 0.0
+        self._publish_tasks: Set[asyncio.Task] = set()
+
+    async def sync(self):
+        """
+        Xóa cache nếu worker khác đã báo có user bị sửa, đọc shared state tối đa một lần mỗi `sync_interval`
+        """
+        if self.shared is None or time.monotonic() < self._next_sync:
+            return
+        self._next_sync = time.monotonic() + self.sync_interval
+        generation = await self.shared.get(GENERATION_KEY)
+        if generation != self._generation:
+            self._generation = generation
+            self.clear()
+
+    async def publish_invalidation(self):
+        """
+        Báo cho các worker khác xóa cache (gọi sau khi thay đổi của user đã được commit)
+        """
+        if self.shared is not None:
+            await self.shared.set(GENERATION_KEY, uuid.uuid4().hex)
+
+    def _schedule_publish(self):
+        if self.shared is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Gọi từ code đồng bộ (script, migration): không có event loop đang chạy
+            asyncio.run(self.publish_invalidation())
+            return
+        task = loop.create_task(self.publish_invalidation())
+        self._publish_tasks.add(task)
+        task.add_done_callback(self._publish_tasks.discard)
+
+    def get(self, username: str) -> Optional[UserResponse]:
+        """
+        Lấy user từ cache, trả về None nếu chưa có hoặc đã hết hạn
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, username: str, principal: UserResponse):
+        """
+        Lưu user vào cache, loại bỏ entry ít dùng nhất khi vượt kích thước
+        """
+        with self._lock:
+            self._entries[username] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """
+        Thống kê hit/miss của cache
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+user_cache = UserCache(shared=shared_state)
+
+# Xóa cache khi user bị sửa (đổi thông tin, vô hiệu hóa) hoặc bị xóa qua ORM.
+# Các câu lệnh update()/delete() hàng loạt không kích hoạt event này,
+# khi dùng chúng cần gọi user_cache.invalidate() hoặc user_cache.clear()
+# và await user_cache.publish_invalidation() sau khi commit.
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user(mapper, connection, target):
+    user_cache.invalidate(target.username)
+    # Nếu username bị đổi thì xóa cả entry theo username cũ
+    for old_username in inspect(target).attrs.username.history.deleted:
+        user_cache.invalidate(old_username)
+    session = object_session(target)
+    if session is not None:
+        session.info["user_cache_invalidated"] = True
+
+# Các worker khác chỉ được báo sau khi commit, để chúng không đọc lại dữ liệu cũ vào cache
+@event.listens_for(Session, "after_commit")
+def _publish_invalidation(session):
+    if session.info.pop("user_cache_invalidated", False):
+        user_cache._schedule_publish()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidation(session):
+    session.info.pop("user_cache_invalidated", None)
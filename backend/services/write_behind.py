@@ -0,0 +1,92 @@
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+
+class WriteBehindQueue:
+    """
+    Gom nhiều thao tác ghi vào một transaction (group commit) để giảm số lần
+    fsync và tranh chấp khóa ghi của SQLite. Mỗi lời gọi submit() vẫn chờ tới
+    khi dữ liệu của nó đã được commit và nhận lại kết quả của riêng mình.
+    """
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        apply: Callable[[AsyncSession, Any], Awaitable[Any]],
+        batch_size: int = 50,
+        max_delay: float = 0.02
+    ):
+        self.session_factory = session_factory
+        self.apply = apply
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._queue: "asyncio.Queue[Optional[Tuple[Any, asyncio.Future]]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Ghi nốt các thao tác còn trong hàng đợi rồi dừng
+        """
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, item: Any) -> Any:
+        if self._task is None or self._task.done():
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            stopping = False
+            deadline = loop.time() + self.max_delay
+            # Chờ thêm tối đa max_delay để gom các thao tác tới cùng lúc
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            async with self.session_factory() as db:
+                results = [await self.apply(db, item) for item, _ in batch]
+                await db.commit()
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            print(f"Error in batched write, retrying one by one: {e}")
+            # Ghi lại từng thao tác riêng để một dòng lỗi không làm hỏng cả batch
+            for item, future in batch:
+                if future.done():
+                    continue
+                try:
+                    async with self.session_factory() as db:
+                        result = await self.apply(db, item)
+                        await db.commit()
+                    future.set_result(result)
+                except Exception as item_error:
+                    future.set_exception(item_error)
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# Test chạy với database và file trạng thái tạm, không đụng tới dữ liệu thật.
+# Biến môi trường phải được đặt trước khi import các module đọc cấu hình lúc import
+_tmp_dir = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'chatbot.db')}")
+os.environ.setdefault("SHARED_STATE_PATH", os.path.join(_tmp_dir, "shared_state.db"))
+os.environ.setdefault("RETENTION_ARCHIVE_DIR", os.path.join(_tmp_dir, "archive"))
+os.environ.setdefault("OLLAMA_PRELOAD_MODELS", "")
+# Cost thấp cho nhanh; tính đúng sai của hash không phụ thuộc cost
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+# Các module backend import phẳng (from database import ...), giống khi chạy từ thư mục backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def client():
+    """
+    TestClient chạy cả lifespan (tạo bảng, mở pool tới Ollama...) như khi server khởi động
+    """
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app) as test_client:
+        yield test_client
@@ -0,0 +1,21 @@
+import uuid
+
+def test_register_and_login(client):
+    """
+    Đăng ký và đăng nhập đi qua bcrypt thật: phiên bản bcrypt không tương thích với passlib làm cả hai trả về 500
+    """
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    response = client.post("/api/auth/register", json={
+        "username": username,
+        "email": f"{username}@example.com",
+        "password": "mat-khau-123"
+    })
+    assert response.status_code == 200, response.text
+
+    response = client.post("/api/auth/login", json={"username": username, "password": "mat-khau-123"})
+    assert response.status_code == 200, response.text
+    token = response.json()["access_token"]
+    assert client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"}).json()["username"] == username
+
+    response = client.post("/api/auth/login", json={"username": username, "password": "sai-mat-khau"})
+    assert response.status_code == 401
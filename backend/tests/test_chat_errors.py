@@ -0,0 +1,52 @@
+import json
+import uuid
+import httpx
+import pytest
+from routers import chat
+
+def failing_ollama(request: httpx.Request) -> httpx.Response:
+    """
+    Ollama giả: trả về một token rồi báo lỗi giữa stream; request không stream lỗi 500
+    """
+    if request.url.path in ("/api/tags", "/api/ps"):
+        return httpx.Response(200, json={"models": []})
+    payload = json.loads(request.content or b"{}")
+    if not payload.get("stream"):
+        return httpx.Response(500, json={"error": "model crashed"})
+    lines = [
+        {"message": {"role": "assistant", "content": "Một nửa "}, "response": "Một nửa ", "done": False},
+        {"error": "model runner has unexpectedly stopped"},
+    ]
+    return httpx.Response(200, content="".join(json.dumps(line) + "\n" for line in lines).encode())
+
+@pytest.fixture
+def auth_headers(client):
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    client.post("/api/auth/register", json={"username": username, "email": f"{username}@example.com", "password": "mat-khau-123"})
+    token = client.post("/api/auth/login", json={"username": username, "password": "mat-khau-123"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+@pytest.fixture
+def broken_ollama(client):
+    original = chat.ollama_service._client
+    chat.ollama_service._client = httpx.AsyncClient(transport=httpx.MockTransport(failing_ollama))
+    yield
+    chat.ollama_service._client = original
+
+def test_stream_error_is_not_persisted(client, auth_headers, broken_ollama):
+    session_id = str(uuid.uuid4())
+    response = client.post("/api/chat/stream", json={"message": "Xin chào", "session_id": session_id}, headers=auth_headers)
+    events = [json.loads(line) for line in response.text.splitlines() if line]
+    assert events[0] == {"type": "token", "content": "Một nửa "}
+    assert events[-1]["type"] == "error"
+    assert not any(event["type"] == "done" for event in events)
+
+    history = client.get(f"/api/history/{session_id}", headers=auth_headers).json()
+    assert history["history"] == []
+    assert client.get("/api/search", params={"q": "nua"}, headers=auth_headers).json()["results"] == []
+
+def test_chat_error_returns_http_error(client, auth_headers, broken_ollama):
+    session_id = str(uuid.uuid4())
+    response = client.post("/api/chat", json={"message": "Xin chào", "session_id": session_id}, headers=auth_headers)
+    assert response.status_code == 502
+    assert client.get(f"/api/history/{session_id}", headers=auth_headers).json()["history"] == []
@@ -0,0 +1,47 @@
+import json
+import uuid
+import pytest
+from services.data_export import to_conversation_row
+
+VALID = {"session_id": "s1", "user_message": "Xin chào", "bot_response": "Chào bạn", "rating": 4}
+
+@pytest.mark.parametrize("field, value", [
+    ("session_id", 123),
+    ("session_id", {"id": "s1"}),
+    ("user_message", ["Xin chào"]),
+    ("bot_response", 42),
+    ("timestamp", 1700000000),
+    ("rating", {"value": 4}),
+    ("rating", True),
+    ("feedback", {"text": "tốt"}),
+    ("model", 3),
+])
+def test_wrong_types_raise_value_error(field, value):
+    with pytest.raises(ValueError):
+        to_conversation_row({**VALID, field: value}, user_id=1)
+
+def test_valid_record():
+    row = to_conversation_row({**VALID, "rating": "4.5", "timestamp": "2024-05-01T10:00:00+07:00"}, user_id=7)
+    assert row["user_id"] == 7
+    assert row["rating"] == 4.5
+    assert row["timestamp"].isoformat() == "2024-05-01T03:00:00"
+
+def test_import_reports_bad_rows_per_line(client):
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    client.post("/api/auth/register", json={"username": username, "email": f"{username}@example.com", "password": "mat-khau-123"})
+    token = client.post("/api/auth/login", json={"username": username, "password": "mat-khau-123"}).json()["access_token"]
+    lines = [
+        json.dumps(VALID),
+        json.dumps({**VALID, "session_id": 123}),
+        json.dumps({**VALID, "feedback": {"text": "tốt"}}),
+    ]
+    response = client.post(
+        "/api/import",
+        files={"file": ("conversations.ndjson", "\n".join(lines).encode("utf-8"), "application/x-ndjson")},
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["imported"] == 1
+    assert result["skipped"] == 2
+    assert [error["line"] for error in result["errors"]] == [2, 3]
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+import httpx
+from services.model_manager import ModelManager
+from services.ollama_service import OllamaService
+from services.shared_state import LocalStateBackend, SQLiteStateBackend
+
+NODE = "http://ollama:11434"
+
+class FakeNode:
+    """
+    Một node Ollama giả: /api/ps trả về các model trong `loaded`, request keep_alive=0 unload model
+    """
+    def __init__(self, loaded):
+        self.loaded = set(loaded)
+        self.unloaded = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/ps":
+            return httpx.Response(200, json={"models": [{"name": name} for name in sorted(self.loaded)]})
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": [{"name": name} for name in sorted(self.loaded)]})
+        payload = json.loads(request.content or b"{}")
+        if payload.get("keep_alive") == 0:
+            self.loaded.discard(payload["model"])
+            self.unloaded.append(payload["model"])
+        else:
+            self.loaded.add(payload["model"])
+        return httpx.Response(200, json={"response": "", "done": True})
+
+def make_manager(node: FakeNode) -> ModelManager:
+    service = OllamaService(base_urls=[NODE])
+    service._client = httpx.AsyncClient(transport=httpx.MockTransport(node))
+    manager = ModelManager(service, preload_models=["pinned:1b"])
+    manager.idle_timeout = 60
+    manager.max_loaded = 2
+    return manager
+
+def test_first_pass_keeps_models_loaded_by_others():
+    node = FakeNode({"pinned:1b", "other-client:7b", "other-client:13b"})
+
+    async def scenario():
+        manager = make_manager(node)
+        try:
+            # Vượt giới hạn số model nhưng không model nào do ứng dụng nạp: không unload gì
+            await manager.maintain()
+            assert node.unloaded == []
+            assert manager.last_used["other-client:7b"] > 0
+        finally:
+            await manager.service.shutdown()
+
+    asyncio.run(scenario())
+
+def test_unloads_only_idle_models_it_loaded():
+    node = FakeNode({"pinned:1b", "other-client:7b"})
+
+    async def scenario():
+        manager = make_manager(node)
+        try:
+            manager.record_request("mine:3b")
+            node.loaded.add("mine:3b")
+            await manager.maintain()
+            # Vượt giới hạn số model: chỉ model do ứng dụng nạp nhường chỗ, model của client khác được giữ
+            assert node.unloaded == ["mine:3b"]
+
+            node.unloaded.clear()
+            manager.max_loaded = 3
+            manager.record_request("mine:3b")
+            node.loaded.add("mine:3b")
+            await manager.maintain()
+            assert node.unloaded == []
+
+            # Rảnh quá idle_timeout thì bị unload; model của client khác vẫn được giữ
+            manager.last_used["mine:3b"] = time.time() - 120
+            manager.last_used["other-client:7b"] = time.time() - 120
+            await manager.maintain()
+            assert node.unloaded == ["mine:3b"]
+            assert "other-client:7b" in node.loaded
+            assert "pinned:1b" in node.loaded
+        finally:
+            await manager.service.shutdown()
+
+    asyncio.run(scenario())
+
+def test_last_used_is_shared_through_injected_state(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    # OllamaService truyền shared state của nó cho ModelManager của mình
+    worker_a = OllamaService(base_urls=[NODE], shared=SQLiteStateBackend(path)).model_manager
+    worker_b = ModelManager(OllamaService(base_urls=[NODE]), preload_models=[], shared=SQLiteStateBackend(path))
+    assert ModelManager(OllamaService(base_urls=[NODE]), shared=LocalStateBackend()).shared is None
+
+    async def scenario():
+        worker_a.record_request("mine:3b")
+        await worker_a._sync_last_used()
+        # Worker khác thấy model trên node: nhận thời điểm dùng từ shared state, không coi là rảnh
+        worker_b.service.pool.backends[0].loaded_models.add("mine:3b")
+        await worker_b._sync_last_used()
+        assert worker_b.last_used["mine:3b"] == worker_a.last_used["mine:3b"]
+        assert "mine:3b" in worker_b.owned
+
+    asyncio.run(scenario())
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import httpx
+import pytest
+from services.ollama_pool import MAX_CONSECUTIVE_FAILURES, OllamaBackendPool
+from services.ollama_service import OllamaService, OllamaUnavailable
+
+NODE_A = "http://ollama-a:11434"
+NODE_B = "http://ollama-b:11434"
+MODEL = "llama3.2:1b"
+
+class FakeBackends:
+    """
+    Các node Ollama giả qua httpx.MockTransport: node trong `down` lỗi kết nối,
+    node trong `failing` trả về 500, node còn lại trả lời như Ollama
+    """
+    def __init__(self):
+        self.down = set()
+        self.failing = set()
+        self.calls = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        node = f"{request.url.scheme}://{request.url.host}:{request.url.port}"
+        self.calls.append((node, request.url.path))
+        if node in self.down:
+            raise httpx.ConnectError("connection refused", request=request)
+        if node in self.failing:
+            return httpx.Response(500, json={"error": "internal error"})
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": [{"name": MODEL}]})
+        if request.url.path == "/api/ps":
+            return httpx.Response(200, json={"models": []})
+        payload = json.loads(request.content or b"{}")
+        if payload.get("stream"):
+            lines = [{"response": "xin ", "done": False}, {"response": "chào", "done": True}]
+            return httpx.Response(200, content="".join(json.dumps(line) + "\n" for line in lines).encode())
+        return httpx.Response(200, json={"response": f"trả lời từ {node}", "done": True})
+
+    def nodes_called(self, path: str):
+        return [node for node, called_path in self.calls if called_path == path]
+
+def make_service(fake: FakeBackends) -> OllamaService:
+    service = OllamaService(base_urls=[NODE_A, NODE_B])
+    service._client = httpx.AsyncClient(transport=httpx.MockTransport(fake))
+    return service
+
+def backend(service: OllamaService, base_url: str):
+    return next(b for b in service.pool.backends if b.base_url == base_url)
+
+def test_choose_least_loaded_backend():
+    pool = OllamaBackendPool([NODE_A, NODE_B])
+    a, b = pool.backends
+    a.outstanding = 3
+    b.outstanding = 1
+    assert pool.choose(MODEL) is b
+
+    # Node đang nạp sẵn model được ưu tiên hơn node rảnh hơn
+    a.loaded_models.add(MODEL)
+    assert pool.choose(MODEL) is a
+
+    # Node không khỏe bị bỏ qua khi còn node khỏe
+    pool.mark_failure(a)
+    pool.mark_failure(a)
+    assert not a.healthy
+    assert pool.choose(MODEL) is b
+
+def test_post_fails_over_and_marks_backend_down():
+    fake = FakeBackends()
+    fake.down.add(NODE_A)
+
+    async def scenario():
+        service = make_service(fake)
+        try:
+            for _ in range(MAX_CONSECUTIVE_FAILURES):
+                # Hai node ngang nhau (B chưa được coi là đang nạp model): node A đứng trước
+                # nên được thử trước rồi chuyển sang B
+                backend(service, NODE_B).loaded_models.clear()
+                response = await service._post("/api/generate", {"model": MODEL, "prompt": "hi", "stream": False})
+                assert response.status_code == 200
+                assert response.json()["response"] == f"trả lời từ {NODE_B}"
+            assert not backend(service, NODE_A).healthy
+            assert backend(service, NODE_B).healthy
+
+            # Node A đã bị đánh dấu lỗi nên không còn được thử nữa
+            fake.calls.clear()
+            await service._post("/api/generate", {"model": MODEL, "prompt": "hi", "stream": False})
+            assert fake.nodes_called("/api/generate") == [NODE_B]
+            assert all(b.outstanding == 0 for b in service.pool.backends)
+        finally:
+            await service.shutdown()
+
+    asyncio.run(scenario())
+
+def test_open_stream_fails_over_on_server_error():
+    fake = FakeBackends()
+    fake.failing.add(NODE_A)
+
+    async def scenario():
+        service = make_service(fake)
+        try:
+            async with service._open_stream("/api/generate", {"model": MODEL, "prompt": "hi", "stream": True}) as response:
+                assert response.status_code == 200
+                lines = [json.loads(line) async for line in response.aiter_lines() if line]
+            assert "".join(line["response"] for line in lines) == "xin chào"
+            assert fake.nodes_called("/api/generate") == [NODE_A, NODE_B]
+            assert backend(service, NODE_A).consecutive_failures == 1
+            assert MODEL in backend(service, NODE_B).loaded_models
+            assert all(b.outstanding == 0 for b in service.pool.backends)
+        finally:
+            await service.shutdown()
+
+    asyncio.run(scenario())
+
+def test_all_backends_down_raises():
+    fake = FakeBackends()
+    fake.down.update({NODE_A, NODE_B})
+
+    async def scenario():
+        service = make_service(fake)
+        try:
+            with pytest.raises(OllamaUnavailable):
+                await service._post("/api/generate", {"model": MODEL, "prompt": "hi", "stream": False})
+        finally:
+            await service.shutdown()
+
+    asyncio.run(scenario())
+
+def test_health_loop_recovers_backend():
+    fake = FakeBackends()
+    fake.down.add(NODE_A)
+
+    async def scenario():
+        service = make_service(fake)
+        service.health_interval = 0.01
+        try:
+            await service.refresh_backends()
+            assert not backend(service, NODE_A).healthy
+
+            # Node A hoạt động lại: health check kế tiếp đưa nó trở lại pool
+            fake.down.clear()
+            task = asyncio.create_task(service._health_loop())
+            try:
+                for _ in range(200):
+                    if backend(service, NODE_A).healthy:
+                        break
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+            node_a = backend(service, NODE_A)
+            assert node_a.healthy
+            assert node_a.available_models == {MODEL}
+            assert service.pool.choose(MODEL, exclude=[backend(service, NODE_B)]) is node_a
+        finally:
+            await service.shutdown()
+
+    asyncio.run(scenario())
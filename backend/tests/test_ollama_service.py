@@ -0,0 +1,48 @@
+import asyncio
+import json
+import httpx
+from prometheus_client import REGISTRY
+from services.ollama_service import OllamaService
+from services.shared_state import SQLiteStateBackend
+
+NODE = "http://ollama:11434"
+
+def make_worker(path: str, requests: list, **stats) -> OllamaService:
+    def node(request: httpx.Request) -> httpx.Response:
+        if request.url.path in ("/api/tags", "/api/ps"):
+            return httpx.Response(200, json={"models": []})
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"message": {"role": "assistant", "content": "Vâng"}, "done": True, **stats})
+
+    service = OllamaService(base_urls=[NODE], shared=SQLiteStateBackend(path) if path else None)
+    service._client = httpx.AsyncClient(transport=httpx.MockTransport(node))
+    service.context_turns = 4
+    return service
+
+def turns(first: int, last: int):
+    return [{"id": i, "user_message": f"Câu {i}", "bot_response": f"Trả lời {i}"} for i in range(first, last + 1)]
+
+def test_window_anchor_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    requests = []
+    worker_a, worker_b = make_worker(path, requests), make_worker(path, requests)
+
+    async def scenario():
+        await worker_a.generate_response("Câu 5", turns(1, 4), session_id="s1")
+        # Lượt kế tiếp rơi vào worker khác: cửa sổ vẫn bắt đầu từ lượt worker trước đã chọn
+        await worker_b.generate_response("Câu 6", turns(2, 5), session_id="s1")
+
+    asyncio.run(scenario())
+    first, second = ([m["content"] for m in request["messages"][1:-1]] for request in requests)
+    assert first == ["Câu 3", "Trả lời 3", "Câu 4", "Trả lời 4"]
+    assert second[:len(first)] == first
+
+def test_blocking_call_records_time_to_first_token():
+    def ttft_sum():
+        return REGISTRY.get_sample_value("chat_time_to_first_token_seconds_sum", {"mode": "blocking"}) or 0
+
+    before = ttft_sum()
+    service = make_worker(None, [], load_duration=200_000_000, prompt_eval_duration=300_000_000)
+    asyncio.run(service.generate_response("Xin chào"))
+    # Không stream: lấy thời gian nạp model và xử lý prompt do Ollama báo
+    assert abs(ttft_sum() - before - 0.5) < 1e-9
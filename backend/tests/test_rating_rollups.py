@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+from datetime import datetime
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import database
+from database import RatingRollup, User
+from services.conversation_service import ConversationService
+from services.data_export import to_conversation_row
+
+OLD_DAY = "2024-01-15"
+
+def run(scenario):
+    async def wrapper():
+        engine = create_async_engine(database.to_async_url(database.DATABASE_URL))
+        try:
+            return await scenario(async_sessionmaker(engine, expire_on_commit=False))
+        finally:
+            await engine.dispose()
+    database.create_tables()
+    return asyncio.run(wrapper())
+
+async def create_user(session_factory) -> int:
+    async with session_factory() as db:
+        name = f"user_{uuid.uuid4().hex[:8]}"
+        user = User(username=name, email=f"{name}@example.com", password_hash="x")
+        db.add(user)
+        await db.commit()
+        return user.id
+
+async def rollups(session_factory, user_id: int) -> dict:
+    async with session_factory() as db:
+        rows = (await db.execute(select(RatingRollup).where(RatingRollup.user_id == user_id))).scalars().all()
+        return {
+            row.day: (row.turns, row.rated, row.rating_sum, row.feedback_count)
+            for row in rows if any((row.turns, row.rated, row.rating_sum, row.feedback_count))
+        }
+
+async def all_rollups(session_factory) -> dict:
+    async with session_factory() as db:
+        rows = (await db.execute(select(RatingRollup))).scalars().all()
+        return {
+            (row.day, row.model, row.user_id): tuple(getattr(row, column) for column in (
+                "turns", "rated", "rating_sum", "rating_1", "rating_2", "rating_3", "rating_4", "rating_5", "feedback_count"
+            ))
+            for row in rows if any((row.turns, row.rated, row.rating_sum, row.feedback_count))
+        }
+
+def test_rating_counts_on_the_day_it_was_given():
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+
+    async def scenario(session_factory):
+        user_id = await create_user(session_factory)
+        session_id = str(uuid.uuid4())
+        async with session_factory() as db:
+            row = to_conversation_row({
+                "session_id": session_id, "user_message": "Xin chào", "bot_response": "Chào bạn",
+                "timestamp": f"{OLD_DAY}T10:00:00"
+            }, user_id)
+            await ConversationService(db).import_conversations([row])
+            conversation_id = (await ConversationService(db).get_conversation_history(session_id, user_id))[0]["id"]
+        assert await rollups(session_factory, user_id) == {OLD_DAY: (1, 0, 0, 0)}
+
+        async with session_factory() as db:
+            assert await ConversationService(db).rate_conversation(conversation_id, 4, "tốt", user_id)
+        assert await rollups(session_factory, user_id) == {OLD_DAY: (1, 0, 0, 0), today: (0, 1, 4, 1)}
+
+        # Đánh giá lại: đánh giá cũ được bỏ khỏi ngày nó được ghi nhận
+        async with session_factory() as db:
+            assert await ConversationService(db).rate_conversation(conversation_id, 2, None, user_id)
+        assert await rollups(session_factory, user_id) == {OLD_DAY: (1, 0, 0, 0), today: (0, 1, 2, 0)}
+
+        async with session_factory() as db:
+            assert await ConversationService(db).delete_session(session_id, user_id)
+        assert await rollups(session_factory, user_id) == {}
+
+    run(scenario)
+
+def test_imported_rating_uses_rated_at():
+    async def scenario(session_factory):
+        user_id = await create_user(session_factory)
+        async with session_factory() as db:
+            row = to_conversation_row({
+                "session_id": str(uuid.uuid4()), "user_message": "Xin chào", "bot_response": "Chào bạn",
+                "timestamp": f"{OLD_DAY}T10:00:00", "rating": 5, "rated_at": "2024-02-01T08:00:00"
+            }, user_id)
+            await ConversationService(db).import_conversations([row])
+        assert await rollups(session_factory, user_id) == {OLD_DAY: (1, 0, 0, 0), "2024-02-01": (0, 1, 5, 0)}
+
+    run(scenario)
+
+def test_backfill_matches_incremental_rollups():
+    async def scenario(session_factory):
+        user_id = await create_user(session_factory)
+        session_id = str(uuid.uuid4())
+        async with session_factory() as db:
+            rows = [
+                to_conversation_row({
+                    "session_id": session_id, "user_message": f"Câu {i}", "bot_response": "Trả lời",
+                    "timestamp": f"2024-03-0{i}T10:00:00"
+                }, user_id)
+                for i in range(1, 4)
+            ]
+            await ConversationService(db).import_conversations(rows)
+            history = await ConversationService(db).get_conversation_history(session_id, user_id)
+        async with session_factory() as db:
+            await ConversationService(db).rate_conversation(history[0]["id"], 3, "ổn", user_id)
+        incremental = await all_rollups(session_factory)
+
+        async with session_factory() as db:
+            await db.execute(delete(RatingRollup))
+            await db.commit()
+        database._backfill_rating_rollups()
+        assert await all_rollups(session_factory) == incremental
+
+    run(scenario)
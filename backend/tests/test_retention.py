@@ -0,0 +1,161 @@
+import asyncio
+import gzip
+import json
+import os
+import uuid
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+import database
+from database import RatingRollup
+from migrate import enable_incremental_vacuum
+from routers import chat
+from services.conversation_service import ConversationService
+from services.retention import RetentionManager
+
+# Chỉ các session hoạt động trước mốc này bị lưu trữ, không đụng tới dữ liệu của test khác
+CUTOFF = datetime(2002, 1, 1)
+
+@pytest.fixture
+def auth_headers(client):
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    client.post("/api/auth/register", json={"username": username, "email": f"{username}@example.com", "password": "mat-khau-123"})
+    token = client.post("/api/auth/login", json={"username": username, "password": "mat-khau-123"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+def import_turns(client, headers, session_id: str, timestamps, prefix: str = "Câu", **fields):
+    lines = [
+        json.dumps({"session_id": session_id, "user_message": f"{prefix} {i}", "bot_response": "Trả lời", "timestamp": timestamp, **fields})
+        for i, timestamp in enumerate(timestamps)
+    ]
+    response = client.post(
+        "/api/import",
+        files={"file": ("conversations.ndjson", "\n".join(lines).encode("utf-8"), "application/x-ndjson")},
+        headers=headers
+    )
+    assert response.json()["imported"] == len(timestamps)
+
+def history(client, headers, session_id: str, limit: int):
+    pages, cursor = [], None
+    while True:
+        params = {"limit": limit}
+        if cursor is not None:
+            params["cursor"] = cursor
+        page = client.get(f"/api/history/{session_id}", params=params, headers=headers).json()
+        pages.append([conv["user_message"] for conv in page["history"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+def archive_sizes():
+    directory = chat.retention.archive_dir
+    if not os.path.isdir(directory):
+        return {}
+    return {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(".gz")}
+
+def test_turns_added_during_archive_stay_in_database(client, auth_headers, monkeypatch):
+    session_id = str(uuid.uuid4())
+    import_turns(client, auth_headers, session_id, ["2001-01-01T10:00:00", "2001-01-02T10:00:00"])
+
+    append_member = chat.retention._append_member
+    def append_then_write(filename, records):
+        offset = append_member(filename, records)
+        # Một lượt mới tới session trong lúc batch đang lưu trữ
+        import_turns(client, auth_headers, session_id, ["2001-01-03T10:00:00"])
+        return offset
+    monkeypatch.setattr(chat.retention, "_append_member", append_then_write)
+    assert client.portal.call(chat.retention._archive_batch, CUTOFF) >= 1
+    monkeypatch.undo()
+
+    # Phần lưu trữ được nối trước các lượt còn trong database, phân trang xuyên qua cả hai
+    assert history(client, auth_headers, session_id, 100) == [["Câu 0", "Câu 1", "Câu 0"]]
+    assert history(client, auth_headers, session_id, 2) == [["Câu 0", "Câu 1"], ["Câu 0"]]
+    assert history(client, auth_headers, session_id, 1) == [["Câu 0"], ["Câu 1"], ["Câu 0"]]
+    sessions = client.get("/api/sessions", headers=auth_headers).json()["sessions"]
+    assert session_id in [session["session_id"] for session in sessions]
+
+def test_failed_commit_does_not_duplicate_archive(client, auth_headers, monkeypatch):
+    session_id = str(uuid.uuid4())
+    import_turns(client, auth_headers, session_id, ["2001-02-01T10:00:00", "2001-02-02T10:00:00"])
+    sizes_before = archive_sizes()
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(ConversationService, "remove_conversation_rows", fail)
+    with pytest.raises(RuntimeError):
+        client.portal.call(chat.retention._archive_batch, CUTOFF)
+    monkeypatch.undo()
+    assert archive_sizes() == sizes_before
+    assert history(client, auth_headers, session_id, 100) == [["Câu 0", "Câu 1"]]
+
+    assert client.portal.call(chat.retention._archive_batch, CUTOFF) >= 1
+    page = client.get(f"/api/history/{session_id}", headers=auth_headers).json()
+    assert page["archived"] is True
+    assert [conv["user_message"] for conv in page["history"]] == ["Câu 0", "Câu 1"]
+
+def test_compact_never_runs_full_vacuum(tmp_path):
+    path = str(tmp_path / "old.db")
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE t (x TEXT)"))
+        conn.execute(text("INSERT INTO t VALUES (:x)"), [{"x": "a" * 1000} for _ in range(100)])
+
+    def auto_vacuum():
+        with engine.connect() as conn:
+            return conn.execute(text("PRAGMA auto_vacuum")).scalar()
+
+    async def compact():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            await RetentionManager(None, async_engine, archive_dir=str(tmp_path)).compact()
+        finally:
+            await async_engine.dispose()
+
+    # Database cũ: server chỉ bỏ qua vacuum, việc chuyển chế độ để cho migrate.py
+    asyncio.run(compact())
+    assert auto_vacuum() == 0
+    enable_incremental_vacuum(engine)
+    assert auto_vacuum() == 2
+    asyncio.run(compact())
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM t"))
+    asyncio.run(compact())
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA freelist_count")).scalar() == 0
+    engine.dispose()
+
+def archived_text() -> str:
+    directory = chat.retention.archive_dir
+    return "".join(
+        gzip.open(os.path.join(directory, name), "rt", encoding="utf-8").read()
+        for name in os.listdir(directory) if name.endswith(".gz")
+    )
+
+def test_delete_covers_archived_turns(client, auth_headers):
+    user_id = client.get("/api/auth/me", headers=auth_headers).json()["id"]
+
+    async def rollups():
+        async with database.AsyncSessionLocal() as db:
+            rows = (await db.execute(select(RatingRollup).where(RatingRollup.user_id == user_id))).scalars().all()
+            return {row.day: (row.turns, row.rated) for row in rows if row.turns or row.rated}
+
+    deleted, kept = str(uuid.uuid4()), str(uuid.uuid4())
+    secret = f"bí mật {uuid.uuid4().hex}"
+    import_turns(client, auth_headers, deleted, ["2001-03-01T10:00:00"], prefix=secret, rating=4, rated_at="2001-03-05T10:00:00")
+    import_turns(client, auth_headers, kept, ["2001-03-02T10:00:00"], prefix="Giữ lại")
+    assert client.portal.call(chat.retention._archive_batch, CUTOFF) >= 2
+    assert secret in archived_text()
+    assert client.portal.call(rollups) == {"2001-03-01": (1, 0), "2001-03-02": (1, 0), "2001-03-05": (0, 1)}
+
+    assert client.delete(f"/api/session/{deleted}", headers=auth_headers).status_code == 200
+    # Lượt đã lưu trữ cũng bị trừ khỏi số liệu thống kê, kể cả đánh giá ở ngày được đánh giá
+    assert client.portal.call(rollups) == {"2001-03-02": (1, 0)}
+    assert client.get(f"/api/history/{deleted}", headers=auth_headers).json()["history"] == []
+    archived = client.get("/api/sessions/archived", headers=auth_headers).json()["sessions"]
+    assert [session["session_id"] for session in archived] == [kept]
+
+    # Lượt retention kế tiếp ghi lại file lưu trữ mà không có session đã xóa
+    assert client.portal.call(chat.retention.purge_deleted) >= 1
+    assert secret not in archived_text()
+    assert history(client, auth_headers, kept, 100) == [["Giữ lại 0"]]
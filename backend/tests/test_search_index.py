@@ -0,0 +1,67 @@
+import asyncio
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from services import search_index
+
+ROWS = [
+    # (id, user_id, session_id, user_message, bot_response)
+    (1, 1, "s1", "Xin chào bạn", "Chào bạn, tôi giúp gì được?"),
+    (2, 2, "s2", "Xin chào", "Chào, u1 là gì?"),
+    (3, 1, "s3", "Thủ đô Việt Nam", "Hà Nội"),
+    (4, 2, "s2", "Hà Nội có gì đẹp", "Hồ Gươm"),
+]
+
+def create_database(path: str, old_format: bool = False):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE conversations (
+                id INTEGER PRIMARY KEY, user_id INTEGER, session_id TEXT,
+                user_message TEXT, bot_response TEXT, rating FLOAT
+            )
+        """))
+        conn.execute(text("""
+            INSERT INTO conversations (id, user_id, session_id, user_message, bot_response)
+            VALUES (:id, :user_id, :session_id, :user_message, :bot_response)
+        """), [dict(zip(("id", "user_id", "session_id", "user_message", "bot_response"), row)) for row in ROWS])
+        if old_format:
+            # Định dạng trước đây: user_id không được đánh chỉ mục, chỉ lọc sau MATCH
+            conn.execute(text(f"""
+                CREATE VIRTUAL TABLE {search_index.FTS_TABLE} USING fts5(
+                    user_message, bot_response,
+                    user_id UNINDEXED, session_id UNINDEXED, rating UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """))
+    with engine.begin() as conn:
+        if search_index.create_fts_table(conn):
+            search_index.backfill(conn)
+    engine.dispose()
+
+def run_search(path: str, user_id: int, query: str, **kwargs):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            async with AsyncSession(engine) as db:
+                return await search_index.search(db, user_id, query, **kwargs)
+        finally:
+            await engine.dispose()
+    return [conversation_id for conversation_id, _ in asyncio.run(scenario())]
+
+def test_search_only_returns_own_rows(tmp_path):
+    path = str(tmp_path / "search.db")
+    create_database(path)
+    assert run_search(path, 1, "xin chao") == [1]
+    assert run_search(path, 2, "xin chao") == [2]
+    assert sorted(run_search(path, 2, "ha noi")) == [4]
+    assert run_search(path, 1, "ha noi") == [3]
+    # Token chủ sở hữu không khớp với nội dung tin nhắn
+    assert run_search(path, 1, "u1") == []
+    assert run_search(path, 2, "u1") == [2]
+    assert run_search(path, 2, "ha", session_id="s2") == [4]
+
+def test_old_index_is_rebuilt_with_owner_column(tmp_path):
+    path = str(tmp_path / "search.db")
+    create_database(path, old_format=True)
+    assert run_search(path, 1, "xin") == [1]
+    assert run_search(path, 3, "xin") == []
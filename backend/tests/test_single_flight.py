@@ -0,0 +1,136 @@
+import asyncio
+import json
+import uuid
+import httpx
+import pytest
+from routers import chat
+from services.shared_state import LocalStateBackend, SQLiteStateBackend
+from services.single_flight import SingleFlight
+
+class GenerationError(Exception):
+    pass
+
+def make_workers(tmp_path, count: int = 2):
+    """
+    Các SingleFlight dùng chung một file shared state, giống các worker trên cùng máy
+    """
+    path = str(tmp_path / "shared_state.db")
+    return [
+        SingleFlight(ttl=5, shared=SQLiteStateBackend(path), shared_errors=(GenerationError,), poll_interval=0.01)
+        for _ in range(count)
+    ]
+
+async def generate(flight, tokens, error: Exception = None):
+    for token in tokens:
+        flight.publish(token)
+        await asyncio.sleep(0.02)
+    if error is not None:
+        raise error
+    flight.finish({"response": "".join(tokens)})
+
+def test_duplicate_on_other_worker_waits_for_result(tmp_path):
+    worker_a, worker_b = make_workers(tmp_path)
+
+    async def scenario():
+        flight_a, leader_a = await worker_a.join("1:key:abc")
+        flight_b, leader_b = await worker_b.join("1:key:abc")
+        assert leader_a and not leader_b
+        worker_a.run(flight_a, generate(flight_a, ["Xin ", "chào"]))
+        assert await flight_b.wait() == {"response": "Xin chào"}
+        assert [token async for token in flight_b.stream()] == ["Xin ", "chào"]
+
+        # Gửi lại ngay sau khi xong, ở worker thứ ba: nhận kết quả cũ thay vì sinh lại
+        worker_c = make_workers(tmp_path, 1)[0]
+        flight_c, leader_c = await worker_c.join("1:key:abc")
+        assert not leader_c
+        assert await flight_c.wait() == {"response": "Xin chào"}
+
+    asyncio.run(scenario())
+
+def test_failure_reaches_other_worker_and_retry_regenerates(tmp_path):
+    worker_a, worker_b = make_workers(tmp_path)
+
+    async def scenario():
+        flight_a, _ = await worker_a.join("1:key:abc")
+        flight_b, leader_b = await worker_b.join("1:key:abc")
+        assert not leader_b
+        worker_a.run(flight_a, generate(flight_a, ["Một nửa"], GenerationError("model crashed")))
+        with pytest.raises(GenerationError, match="model crashed"):
+            await flight_b.wait()
+
+        # Lượt lỗi không được dùng lại: request gửi lại tự sinh
+        flight, leader = await worker_b.join("1:key:abc")
+        assert leader
+        await worker_b.abandon(flight, RuntimeError("scheduler đầy"))
+        flight, leader = await worker_a.join("1:key:abc")
+        assert leader
+
+    asyncio.run(scenario())
+
+def test_local_backend_coalesces_in_process_only():
+    single_flight = SingleFlight(shared=LocalStateBackend())
+    assert single_flight.shared is None
+
+    async def scenario():
+        flight, leader = await single_flight.join("1:key:abc")
+        duplicate, duplicate_leader = await single_flight.join("1:key:abc")
+        assert leader and not duplicate_leader and duplicate is flight
+
+    asyncio.run(scenario())
+
+def test_same_message_twice_in_a_row_is_two_turns(tmp_path):
+    key = SingleFlight.make_key(1, "s1", "ok")
+    worker_a, worker_b = make_workers(tmp_path)
+    local = SingleFlight(ttl=5)
+
+    async def scenario():
+        for first, second in ((local, local), (worker_a, worker_a), (worker_a, worker_b)):
+            flight, leader = await first.join(key)
+            assert leader
+            first.run(flight, generate(flight, ["ok"]))
+            await flight.wait()
+            # Lượt trước đã xong: không có Idempotency-Key thì đây là một lượt chat mới
+            flight, leader = await second.join(key)
+            assert leader
+            await second.abandon(flight, RuntimeError("kết thúc test"))
+
+    asyncio.run(scenario())
+
+def test_idempotency_key_replays_finished_turn():
+    single_flight = SingleFlight(ttl=5)
+
+    async def scenario():
+        key = SingleFlight.make_key(1, "s1", "ok", idempotency_key="abc")
+        flight, _ = await single_flight.join(key)
+        single_flight.run(flight, generate(flight, ["ok"]))
+        await flight.wait()
+        await asyncio.sleep(0)
+        replay, leader = await single_flight.join(key)
+        assert not leader and replay is flight
+
+    asyncio.run(scenario())
+
+def test_api_sends_same_message_twice(client):
+    calls = []
+
+    def ollama(request: httpx.Request) -> httpx.Response:
+        if request.url.path in ("/api/tags", "/api/ps"):
+            return httpx.Response(200, json={"models": []})
+        calls.append(json.loads(request.content))
+        return httpx.Response(200, json={"message": {"role": "assistant", "content": "Vâng"}, "response": "Vâng", "done": True})
+
+    username = f"user_{uuid.uuid4().hex[:8]}"
+    client.post("/api/auth/register", json={"username": username, "email": f"{username}@example.com", "password": "mat-khau-123"})
+    token = client.post("/api/auth/login", json={"username": username, "password": "mat-khau-123"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    original = chat.ollama_service._client
+    chat.ollama_service._client = httpx.AsyncClient(transport=httpx.MockTransport(ollama))
+    try:
+        session_id = str(uuid.uuid4())
+        first = client.post("/api/chat", json={"message": "ok", "session_id": session_id}, headers=headers).json()
+        second = client.post("/api/chat", json={"message": "ok", "session_id": session_id}, headers=headers).json()
+    finally:
+        chat.ollama_service._client = original
+    assert first["conversation_id"] != second["conversation_id"]
+    assert len(calls) == 2
+    assert len(client.get(f"/api/history/{session_id}", headers=headers).json()["history"]) == 2
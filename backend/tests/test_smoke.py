@@ -0,0 +1,12 @@
+def test_import_main():
+    """
+    Import app phải thành công: lỗi lúc import (vd. cấu hình metrics sai) làm server không khởi động được
+    """
+    import main
+    assert main.app is not None
+
+def test_startup_and_health(client):
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["status"] == "healthy"
+    assert client.get("/metrics").status_code == 200
@@ -0,0 +1,64 @@
+import asyncio
+import uuid
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import database
+from database import User
+from models.schemas import UserResponse
+from services import user_cache as user_cache_module
+from services.shared_state import SQLiteStateBackend
+from services.user_cache import UserCache
+
+def principal(username: str) -> UserResponse:
+    return UserResponse(id=1, username=username, email=f"{username}@example.com", created_at=datetime.utcnow(), is_active=True)
+
+def test_invalidation_reaches_other_workers(tmp_path):
+    path = str(tmp_path / "shared_state.db")
+    worker_a = UserCache(shared=SQLiteStateBackend(path), sync_interval=0)
+    worker_b = UserCache(shared=SQLiteStateBackend(path), sync_interval=0)
+
+    async def scenario():
+        for cache in (worker_a, worker_b):
+            await cache.sync()
+            cache.set("an", principal("an"))
+        worker_a.invalidate("an")
+        await worker_a.publish_invalidation()
+
+        await worker_b.sync()
+        assert worker_b.get("an") is None
+        # Không có thay đổi mới: entry lưu lại sau đó vẫn được dùng
+        worker_b.set("an", principal("an"))
+        await worker_b.sync()
+        assert worker_b.get("an") is not None
+
+    asyncio.run(scenario())
+
+def test_orm_update_publishes_after_commit(tmp_path, monkeypatch):
+    shared = SQLiteStateBackend(str(tmp_path / "shared_state.db"))
+    monkeypatch.setattr(user_cache_module.user_cache, "shared", shared)
+    other_worker = UserCache(shared=shared, sync_interval=0)
+
+    async def scenario():
+        engine = create_async_engine(database.to_async_url(database.DATABASE_URL))
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        try:
+            name = f"user_{uuid.uuid4().hex[:8]}"
+            async with session_factory() as db:
+                db.add(User(username=name, email=f"{name}@example.com", password_hash="x"))
+                await db.commit()
+            await other_worker.sync()
+            other_worker.set(name, principal(name))
+
+            async with session_factory() as db:
+                user = (await db.execute(select(User).where(User.username == name))).scalars().one()
+                user.is_active = False
+                await db.commit()
+            await asyncio.gather(*user_cache_module.user_cache._publish_tasks)
+            await other_worker.sync()
+            assert other_worker.get(name) is None
+        finally:
+            await engine.dispose()
+
+    database.create_tables()
+    asyncio.run(scenario())
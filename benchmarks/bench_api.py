@@ -0,0 +1,350 @@
+"""
+Benchmark toàn bộ API: khởi động app FastAPI trong main.py (uvicorn, database SQLite tạm)
+trỏ tới server Ollama giả lập có độ trễ và tốc độ sinh token cố định, rồi chạy hỗn hợp
+register/login/chat/history/sessions với số người dùng đồng thời tăng dần.
+
+Mỗi mức tải ghi lại throughput, p50/p95/p99 latency theo loại request, time-to-first-token
+của /api/chat/stream và mức tăng dung lượng database. Kết quả in ra dạng JSON; có thể so
+với một lần chạy trước để phát hiện hồi quy:
+
+    python benchmarks/bench_api.py --levels 1,4,16 --duration 20 --output results.json
+    python benchmarks/bench_api.py --levels 1,4,16 --duration 20 --baseline results.json
+
+Nếu server không khởi động được, thoát giữa chừng hoặc không request nào thành công ở một
+mức tải, script dừng với mã lỗi 2 và không in kết quả.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BACKEND_DIR = os.path.join(ROOT, "backend")
+FAKE_OLLAMA = os.path.join(ROOT, "benchmarks", "fake_ollama.py")
+
+PASSWORD = "mat-khau-thu-nghiem"
+MESSAGES = [
+    "Xin chào, bạn có khỏe không?",
+    "Giải thích giúp tôi thuật toán sắp xếp nhanh.",
+    "Thủ đô của Việt Nam là gì?",
+    "Viết một bài thơ ngắn về mùa thu Hà Nội.",
+    "Làm sao để học lập trình Python hiệu quả?",
+]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(latencies: list) -> dict:
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+
+def db_size(path: str) -> int:
+    # Với WAL, dữ liệu mới nằm trong file -wal cho tới lần checkpoint
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+class BenchmarkAborted(Exception):
+    """
+    Server không chạy được: dừng benchmark thay vì báo số đo vô nghĩa
+    """
+
+async def wait_ready(url: str, process: subprocess.Popen = None, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise BenchmarkAborted(f"Server thoát với mã {process.returncode} trước khi sẵn sàng: {url}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise BenchmarkAborted(f"Server không khởi động được sau {timeout:g} giây: {url}")
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.ttft = []
+
+    def record(self, op: str, elapsed: float, status: int):
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        if 200 <= status < 300:
+            self.latencies.setdefault(op, []).append(elapsed)
+        else:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    async def timed(self, op: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, 0
+        self.record(op, time.perf_counter() - start, status)
+        return response
+
+class VirtualUser:
+    """
+    Một người dùng: đăng ký, đăng nhập rồi lặp lại các thao tác theo tỉ lệ trong mix
+    """
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, weights: dict, turns_per_session: int, rng: random.Random):
+        self.client = client
+        self.recorder = recorder
+        self.ops = list(weights)
+        self.weights = list(weights.values())
+        self.turns_per_session = turns_per_session
+        self.rng = rng
+        self.headers = {}
+        self.session_id = str(uuid.uuid4())
+        self.turns = 0
+
+    async def sign_in(self) -> bool:
+        username = f"bench_{uuid.uuid4().hex[:12]}"
+        await self.recorder.timed("register", self.client.post("/api/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": PASSWORD
+        }))
+        response = await self.recorder.timed("login", self.client.post("/api/auth/login", json={
+            "username": username,
+            "password": PASSWORD
+        }))
+        if response is None or response.status_code != 200:
+            return False
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        return True
+
+    async def chat(self):
+        if self.turns and self.turns % self.turns_per_session == 0:
+            self.session_id = str(uuid.uuid4())
+        self.turns += 1
+        payload = {"message": self.rng.choice(MESSAGES), "session_id": self.session_id}
+        start = time.perf_counter()
+        status = 0
+        try:
+            async with self.client.stream("POST", "/api/chat/stream", json=payload, headers=self.headers) as response:
+                status = response.status_code
+                first = True
+                async for line in response.aiter_lines():
+                    if not line or status != 200:
+                        continue
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        status = 500
+                        continue
+                    if first and event.get("type") == "token":
+                        self.recorder.ttft.append(time.perf_counter() - start)
+                        first = False
+                    if event.get("type") == "error":
+                        status = 500
+        except httpx.HTTPError:
+            status = 0
+        self.recorder.record("chat", time.perf_counter() - start, status)
+
+    async def history(self):
+        await self.recorder.timed("history", self.client.get(
+            f"/api/history/{self.session_id}", params={"limit": 100}, headers=self.headers
+        ))
+
+    async def sessions(self):
+        await self.recorder.timed("sessions", self.client.get(
+            "/api/sessions", params={"limit": 50}, headers=self.headers
+        ))
+
+    async def run(self, deadline: float):
+        if not await self.sign_in():
+            return
+        while time.monotonic() < deadline:
+            op = self.rng.choices(self.ops, self.weights)[0]
+            await getattr(self, op)()
+
+async def run_level(base_url: str, concurrency: int, duration: float, weights: dict, turns_per_session: int, db_path: str, seed: int) -> dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    size_before = db_size(db_path)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120.0) as client:
+        deadline = time.monotonic() + duration
+        users = [
+            VirtualUser(client, recorder, weights, turns_per_session, random.Random(seed + i))
+            for i in range(concurrency)
+        ]
+        start = time.perf_counter()
+        await asyncio.gather(*(user.run(deadline) for user in users))
+        elapsed = time.perf_counter() - start
+
+    total = sum(len(v) for v in recorder.latencies.values())
+    errors = sum(recorder.errors.values())
+    size_after = db_size(db_path)
+    return {
+        "concurrency": concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": total + errors,
+        "errors": errors,
+        "throughput_rps": round((total + errors) / elapsed, 2),
+        "status_counts": recorder.statuses,
+        "operations": {
+            op: {"count": len(values), "errors": recorder.errors.get(op, 0), **summarize(values)}
+            for op, values in sorted(recorder.latencies.items())
+        },
+        "time_to_first_token": {"count": len(recorder.ttft), **summarize(recorder.ttft)},
+        "db_size_before_bytes": size_before,
+        "db_size_after_bytes": size_after,
+        "db_growth_bytes": size_after - size_before,
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    So với kết quả cũ ở cùng mức tải: throughput giảm hoặc p95 tăng quá `tolerance` là hồi quy
+    """
+    regressions = []
+    old_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    for level in results["levels"]:
+        old = old_levels.get(level["concurrency"])
+        if old is None:
+            continue
+        if old["throughput_rps"] and level["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"c={level['concurrency']} throughput {old['throughput_rps']} -> {level['throughput_rps']} rps")
+        for op, stats in level["operations"].items():
+            old_p95 = old.get("operations", {}).get(op, {}).get("p95_ms")
+            if old_p95 and stats["p95_ms"] and stats["p95_ms"] > old_p95 * (1 + tolerance):
+                regressions.append(f"c={level['concurrency']} {op} p95 {old_p95} -> {stats['p95_ms']} ms")
+        old_ttft = old.get("time_to_first_token", {}).get("p95_ms")
+        new_ttft = level["time_to_first_token"]["p95_ms"]
+        if old_ttft and new_ttft and new_ttft > old_ttft * (1 + tolerance):
+            regressions.append(f"c={level['concurrency']} ttft p95 {old_ttft} -> {new_ttft} ms")
+    return regressions
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="1,4,16,32", help="Các mức người dùng đồng thời")
+    parser.add_argument("--duration", type=float, default=15.0, help="Thời gian chạy mỗi mức (giây)")
+    parser.add_argument("--mix", default="chat=5,history=3,sessions=2", help="Tỉ lệ các thao tác sau khi đăng nhập")
+    parser.add_argument("--turns-per-session", type=int, default=5)
+    parser.add_argument("--ttft", type=float, default=0.1, help="Độ trễ token đầu của Ollama giả lập (giây)")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=32)
+    parser.add_argument("--bcrypt-rounds", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="Số worker của server (>1 chạy qua serve.py)")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    parser.add_argument("--baseline", help="File kết quả cũ để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Mức chênh lệch cho phép khi so sánh")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(",")]
+    weights = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    db_path = os.path.join(workdir, "bench.db")
+    ollama_port, app_port = free_port(), free_port()
+
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "OLLAMA_BASE_URLS": f"http://127.0.0.1:{ollama_port}",
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+        # Mỗi câu hỏi lặp lại sẽ trúng cache nếu bật, làm sai lệch số đo của Ollama
+        "RESPONSE_CACHE_ENABLED": env.get("RESPONSE_CACHE_ENABLED", "0"),
+        "RESPONSE_CACHE_PATH": os.path.join(workdir, "response_cache.db"),
+        "SHARED_STATE_PATH": os.path.join(workdir, "shared_state.db"),
+    })
+    if args.workers > 1:
+        # serve.py migrate một lần rồi khởi động các worker dùng chung trạng thái
+        server_command = [sys.executable, "serve.py", "--workers", str(args.workers)]
+    else:
+        server_command = [sys.executable, "-m", "uvicorn", "main:app", "--log-level", "warning"]
+
+    fake_ollama = subprocess.Popen([
+        sys.executable, FAKE_OLLAMA,
+        "--port", str(ollama_port),
+        "--ttft", str(args.ttft),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--reply-tokens", str(args.reply_tokens),
+    ], stdout=subprocess.DEVNULL)
+    server = subprocess.Popen(server_command + [
+        "--host", "127.0.0.1", "--port", str(app_port),
+    ], cwd=BACKEND_DIR, env=env)
+    processes = [fake_ollama, server]
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        await wait_ready(f"http://127.0.0.1:{ollama_port}/api/tags", fake_ollama)
+        await wait_ready(f"{base_url}/health", server)
+        results = {
+            "config": {
+                "levels": levels,
+                "duration_seconds": args.duration,
+                "mix": weights,
+                "turns_per_session": args.turns_per_session,
+                "ollama_ttft_seconds": args.ttft,
+                "ollama_tokens_per_second": args.tokens_per_second,
+                "ollama_reply_tokens": args.reply_tokens,
+                "bcrypt_rounds": args.bcrypt_rounds,
+                "seed": args.seed,
+                "workers": args.workers,
+            },
+            "levels": [],
+        }
+        for concurrency in levels:
+            level = await run_level(base_url, concurrency, args.duration, weights, args.turns_per_session, db_path, args.seed)
+            print(f"c={concurrency}: {level['throughput_rps']} rps, {level['errors']} errors", file=sys.stderr)
+            if server.poll() is not None:
+                raise BenchmarkAborted(f"Server thoát với mã {server.returncode} trong lúc chạy mức c={concurrency}")
+            if level["requests"] == level["errors"]:
+                raise BenchmarkAborted(f"Không có request nào thành công ở mức c={concurrency}")
+            results["levels"].append(level)
+    except BenchmarkAborted as e:
+        print(f"ABORTED: {e}", file=sys.stderr)
+        sys.exit(2)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
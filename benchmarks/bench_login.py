@@ -0,0 +1,85 @@
+"""
+Benchmark throughput đăng nhập (verify bcrypt) khi chạy trực tiếp trên event loop
+so với khi chạy trong thread pool của PasswordHasher.
+
+Song song với các lượt đăng nhập có một tác vụ "heartbeat" ngủ 10ms mỗi vòng để đo
+event loop bị block bao lâu - đây là độ trễ mà các stream chat khác phải chịu.
+
+    python benchmarks/bench_login.py --logins 64 --concurrency 16 --rounds 12 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from services.password_hasher import PasswordHasher  # noqa: E402
+
+PASSWORD = "mat-khau-thu-nghiem"
+HEARTBEAT_INTERVAL = 0.01
+
+async def heartbeat(stop: asyncio.Event, lags: list):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lags.append(loop.time() - start - HEARTBEAT_INTERVAL)
+
+async def run(mode: str, hasher: PasswordHasher, password_hash: str, logins: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            if mode == "pool":
+                valid, _ = await hasher.verify_and_update(PASSWORD, password_hash)
+            else:
+                # Cách cũ: verify đồng bộ ngay trong handler async
+                valid = hasher.context.verify(PASSWORD, password_hash)
+                await asyncio.sleep(0)
+            assert valid
+
+    stop = asyncio.Event()
+    lags = []
+    monitor = asyncio.create_task(heartbeat(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+
+    lags.sort()
+    return {
+        "mode": mode,
+        "logins": logins,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "logins_per_second": round(logins / elapsed, 2),
+        "loop_lag_p50_ms": round(statistics.median(lags) * 1000, 2) if lags else None,
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2) if lags else None,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(rounds=args.rounds, max_workers=args.workers)
+    password_hash = hasher.context.hash(PASSWORD)
+    try:
+        results = [
+            await run("inline", hasher, password_hash, args.logins, args.concurrency),
+            await run("pool", hasher, password_hash, args.logins, args.concurrency),
+        ]
+    finally:
+        hasher.shutdown()
+    print(json.dumps({"rounds": args.rounds, "workers": args.workers, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,186 @@
+"""
+Server Ollama giả lập (chỉ dùng thư viện chuẩn) để thử nghiệm và benchmark không cần GPU.
+
+Hỗ trợ /api/tags, /api/ps, /api/generate, /api/chat (stream và không stream),
+/api/embed và /api/embeddings. Độ trễ token đầu và tốc độ sinh token điều chỉnh được.
+
+    python benchmarks/fake_ollama.py --port 11500 --models llama3.2:1b --ttft 0.2 --tokens-per-second 40
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = "Đây là câu trả lời giả lập từ server Ollama dùng cho thử nghiệm."
+EMBEDDING_DIM = 64
+
+class FakeOllama:
+    def __init__(self, models, ttft: float = 0.05, tokens_per_second: float = 50.0, reply_tokens: int = 32, fail_rate: float = 0.0):
+        self.models = list(models)
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.fail_rate = fail_rate
+        self.loaded = {}  # model -> thời điểm dùng gần nhất
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            if self.fail_rate <= 0:
+                return False
+            # Lỗi theo chu kỳ để kết quả lặp lại được giữa các lần chạy
+            return self.requests % max(1, round(1 / self.fail_rate)) == 0
+
+    def tokens(self):
+        words = REPLY.split()
+        return [words[i % len(words)] + " " for i in range(self.reply_tokens)]
+
+    def final_stats(self, prompt: str) -> dict:
+        return {
+            "done": True,
+            "prompt_eval_count": max(1, len(prompt) // 4),
+            "eval_count": self.reply_tokens,
+            "eval_duration": int(self.reply_tokens / self.tokens_per_second * 1e9),
+        }
+
+    def embedding(self, text: str) -> list:
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [(digest[i % len(digest)] - 128) / 128 for i in range(EMBEDDING_DIM)]
+
+def make_handler(fake: FakeOllama):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data: dict, status: int = 200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                self.send_json({"models": [{"name": name, "model": name} for name in fake.models]})
+            elif self.path == "/api/ps":
+                with fake.lock:
+                    loaded = list(fake.loaded)
+                self.send_json({"models": [{"name": name, "model": name} for name in loaded]})
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            payload = self.read_json()
+            model = payload.get("model")
+            if self.path in ("/api/embed", "/api/embeddings"):
+                if self.path == "/api/embed":
+                    inputs = payload.get("input", [])
+                    inputs = [inputs] if isinstance(inputs, str) else inputs
+                    self.send_json({"model": model, "embeddings": [fake.embedding(text) for text in inputs]})
+                else:
+                    self.send_json({"embedding": fake.embedding(payload.get("prompt", ""))})
+                return
+            if self.path not in ("/api/generate", "/api/chat"):
+                self.send_json({"error": "not found"}, 404)
+                return
+            if model not in fake.models:
+                self.send_json({"error": f"model '{model}' not found"}, 404)
+                return
+            if fake.should_fail():
+                self.send_json({"error": "simulated failure"}, 500)
+                return
+
+            # Yêu cầu keep_alive = 0 là lệnh unload model
+            if payload.get("keep_alive") in (0, "0") and not payload.get("prompt") and not payload.get("messages"):
+                with fake.lock:
+                    fake.loaded.pop(model, None)
+                self.send_json({"model": model, "done": True, "done_reason": "unload"})
+                return
+            with fake.lock:
+                fake.loaded[model] = time.time()
+
+            is_chat = self.path == "/api/chat"
+            prompt = json.dumps(payload.get("messages")) if is_chat else payload.get("prompt", "")
+            time.sleep(fake.ttft)
+
+            def chunk(text: str) -> dict:
+                if is_chat:
+                    return {"model": model, "message": {"role": "assistant", "content": text}, "done": False}
+                return {"model": model, "response": text, "done": False}
+
+            if not payload.get("stream", True):
+                time.sleep(fake.reply_tokens / fake.tokens_per_second)
+                result = chunk("".join(fake.tokens()))
+                result.update(fake.final_stats(prompt))
+                self.send_json(result)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def write_line(data: dict):
+                line = (json.dumps(data) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+                self.wfile.flush()
+
+            for token in fake.tokens():
+                write_line(chunk(token))
+                time.sleep(1 / fake.tokens_per_second)
+            final = chunk("")
+            final.update(fake.final_stats(prompt))
+            write_line(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+def serve(port: int, fake: FakeOllama, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Chạy server trong thread nền, trả về server để gọi shutdown() khi xong
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--models", default="llama3.2:1b", help="Danh sách model, phân tách bằng dấu phẩy")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Độ trễ trước token đầu tiên (giây)")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=32)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Tỉ lệ request trả về 500")
+    args = parser.parse_args()
+
+    fake = FakeOllama(
+        models=[m.strip() for m in args.models.split(",") if m.strip()],
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        fail_rate=args.fail_rate
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    server.daemon_threads = True
+    print(f"Fake Ollama listening on http://{args.host}:{args.port} ({', '.join(fake.models)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
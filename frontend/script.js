@@ -51,6 +51,7 @@ class ChatbotApp {
         this.updateUserInfo();
         this.initializeSession();
         this.checkServerStatus();
+        this.loadModels();
     }
 
     initializeElements() {
@@ -72,6 +73,8 @@ class ChatbotApp {
         this.feedbackText = document.getElementById('feedbackText');
         this.logoutBtn = document.getElementById('logoutBtn');
         this.userName = document.getElementById('userName');
+        this.modelSelect = document.getElementById('modelSelect');
+        this.searchInput = document.getElementById('searchInput');
     }
 
     updateUserInfo() {
@@ -108,6 +111,12 @@ class ChatbotApp {
         
         document.querySelector('.rating-stars').addEventListener('mouseleave', () => this.resetRatingHover());
         
+        // Tìm kiếm lịch sử, chờ người dùng ngừng gõ rồi mới gửi request
+        this.searchInput.addEventListener('input', () => {
+            clearTimeout(this.searchTimer);
+            this.searchTimer = setTimeout(() => this.searchHistory(), 300);
+        });
+        
         // Auto-resize textarea
         this.messageInput.addEventListener('input', () => this.autoResizeTextarea());
     }
@@ -143,6 +152,33 @@ class ChatbotApp {
         }
     }
 
+    async loadModels() {
+        try {
+            const response = await fetch(`${this.apiBase}/models`);
+            const data = await response.json();
+            for (const model of data.models) {
+                this.addModelOption(model);
+            }
+            this.modelSelect.options[0].textContent = `Mặc định (${data.default})`;
+        } catch (error) {
+            console.error('Error loading models:', error);
+        }
+    }
+
+    addModelOption(model) {
+        if ([...this.modelSelect.options].some(option => option.value === model)) return;
+        const option = document.createElement('option');
+        option.value = model;
+        option.textContent = model;
+        this.modelSelect.appendChild(option);
+    }
+
+    setSelectedModel(model) {
+        // Hiển thị model của session; để trống thì server tự dùng model của session
+        if (model) this.addModelOption(model);
+        this.modelSelect.value = model || '';
+    }
+
     logout() {
         localStorage.removeItem('access_token');
         localStorage.removeItem('user_info');
@@ -171,24 +207,24 @@ class ChatbotApp {
         this.showTypingIndicator();
 
         try {
-            const response = await fetch(`${this.apiBase}/chat`, {
+            const response = await fetch(`${this.apiBase}/chat/stream`, {
                 method: 'POST',
                 headers: this.getAuthHeaders(),
                 body: JSON.stringify({
                     message: message,
-                    session_id: this.currentSessionId
+                    session_id: this.currentSessionId,
+                    model: this.modelSelect.value || null
                 })
             });
 
-            const data = await response.json();
-            
-            if (response.ok) {
-                this.hideTypingIndicator();
-                this.addMessage(data.response, 'bot', true, data.conversation_id);
-            } else {
+            if (!response.ok) {
+                const data = await response.json();
                 this.hideTypingIndicator();
                 this.showError(data.detail || 'Có lỗi xảy ra');
+                return;
             }
+
+            await this.readChatStream(response);
         } catch (error) {
             this.hideTypingIndicator();
             this.showError('Không thể kết nối với server');
@@ -198,6 +234,64 @@ class ChatbotApp {
         }
     }
 
+    async readChatStream(response) {
+        // Đọc NDJSON từ server và hiển thị từng token ngay khi nhận được
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let botText = '';
+        let messageDiv = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const event = JSON.parse(line);
+
+                if (event.type === 'token') {
+                    if (!messageDiv) {
+                        this.hideTypingIndicator();
+                        messageDiv = this.addMessage('', 'bot');
+                    }
+                    botText += event.content;
+                    messageDiv.querySelector('.message-content p').innerHTML = this.formatMessage(botText);
+                    this.scrollToBottom();
+                } else if (event.type === 'done') {
+                    if (!messageDiv) {
+                        this.hideTypingIndicator();
+                        messageDiv = this.addMessage(botText, 'bot');
+                    }
+                    this.finishBotMessage(messageDiv, event.conversation_id);
+                } else if (event.type === 'error') {
+                    this.hideTypingIndicator();
+                    this.showError(event.detail || 'Có lỗi xảy ra');
+                }
+            }
+        }
+    }
+
+    finishBotMessage(messageDiv, conversationId) {
+        // Gắn conversation_id và nút đánh giá sau khi stream kết thúc
+        if (conversationId) {
+            messageDiv.setAttribute('data-conversation-id', conversationId);
+        }
+
+        const actions = document.createElement('div');
+        actions.className = 'message-actions';
+        actions.innerHTML = `
+            <button class="action-btn rate-btn" onclick="chatApp.openRatingModal(this)">
+                <i class="fas fa-star"></i> Đánh giá
+            </button>
+        `;
+        messageDiv.querySelector('.message-content').appendChild(actions);
+    }
+
     addMessage(content, type, showActions = false, conversationId = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${type}`;
@@ -230,6 +324,7 @@ class ChatbotApp {
 
         this.chatMessages.appendChild(messageDiv);
         this.scrollToBottom();
+        return messageDiv;
     }
 
     formatMessage(message) {
@@ -285,6 +380,7 @@ class ChatbotApp {
             
             this.currentSessionId = data.session_id;
             this.clearChat();
+            this.setSelectedModel(null);
             this.hideLoading();
             this.showSuccess('Đã tạo cuộc hội thoại mới');
         } catch (error) {
@@ -313,69 +409,138 @@ class ChatbotApp {
         }
     }
 
-    async loadSessions() {
+    async loadSessions(cursor = null) {
         try {
-            const response = await fetch(`${this.apiBase}/sessions`, {
+            const params = new URLSearchParams({ limit: 50 });
+            if (cursor !== null) params.set('cursor', cursor);
+
+            const response = await fetch(`${this.apiBase}/sessions?${params}`, {
                 headers: this.getAuthHeaders()
             });
             const data = await response.json();
             
-            this.sessionList.innerHTML = '';
+            if (cursor === null) {
+                this.sessionList.innerHTML = '';
+            } else {
+                const loadMoreBtn = this.sessionList.querySelector('.load-more-sessions');
+                if (loadMoreBtn) loadMoreBtn.remove();
+            }
             
-            if (data.sessions.length === 0) {
+            if (cursor === null && data.sessions.length === 0) {
                 this.sessionList.innerHTML = '<p style="text-align: center; color: #a0aec0; padding: 2rem;">Chưa có cuộc hội thoại nào</p>';
                 return;
             }
 
-            for (const sessionId of data.sessions) {
-                await this.addSessionToList(sessionId);
+            for (const session of data.sessions) {
+                this.addSessionToList(session);
+            }
+
+            // Tải thêm trang tiếp theo khi người dùng yêu cầu
+            if (data.next_cursor !== null && data.next_cursor !== undefined) {
+                const loadMoreBtn = document.createElement('button');
+                loadMoreBtn.className = 'btn btn-secondary load-more-sessions';
+                loadMoreBtn.textContent = 'Xem thêm';
+                loadMoreBtn.addEventListener('click', () => this.loadSessions(data.next_cursor));
+                this.sessionList.appendChild(loadMoreBtn);
             }
         } catch (error) {
             this.showError('Không thể tải lịch sử cuộc hội thoại');
         }
     }
 
-    async addSessionToList(sessionId) {
+    async searchHistory() {
+        const query = this.searchInput.value.trim();
+        if (!query) {
+            this.loadSessions();
+            return;
+        }
+
         try {
-            const response = await fetch(`${this.apiBase}/history/${sessionId}`, {
+            const params = new URLSearchParams({ q: query, limit: 30 });
+            const response = await fetch(`${this.apiBase}/search?${params}`, {
                 headers: this.getAuthHeaders()
             });
             const data = await response.json();
-            
-            if (data.history.length > 0) {
-                const firstMessage = data.history[0].user_message;
-                const preview = firstMessage.length > 50 ? firstMessage.substring(0, 50) + '...' : firstMessage;
-                
-                const sessionDiv = document.createElement('div');
-                sessionDiv.className = `session-item ${sessionId === this.currentSessionId ? 'active' : ''}`;
-                sessionDiv.innerHTML = `
-                    <div class="session-id">Session: ${sessionId.substring(0, 8)}...</div>
-                    <div class="session-preview">${preview}</div>
-                `;
-                
-                sessionDiv.addEventListener('click', () => this.loadSession(sessionId));
-                this.sessionList.appendChild(sessionDiv);
+            // Bỏ qua kết quả cũ nếu người dùng đã gõ tiếp
+            if (query !== this.searchInput.value.trim()) return;
+
+            this.sessionList.innerHTML = '';
+            if (data.results.length === 0) {
+                this.sessionList.innerHTML = '<p style="text-align: center; color: #a0aec0; padding: 2rem;">Không tìm thấy kết quả</p>';
+                return;
+            }
+            for (const result of data.results) {
+                this.addSearchResultToList(result);
             }
         } catch (error) {
-            console.error('Error loading session:', error);
+            this.showError('Không thể tìm kiếm lịch sử');
         }
     }
 
-    async loadSession(sessionId) {
+    addSearchResultToList(result) {
+        const resultDiv = document.createElement('div');
+        resultDiv.className = 'session-item';
+
+        const header = document.createElement('div');
+        header.className = 'session-id';
+        header.textContent = `${result.field === 'user_message' ? 'Bạn' : 'AI'} - ${new Date(result.timestamp).toLocaleString('vi-VN')}`;
+
+        // Dựng đoạn trích bằng text node để không chèn HTML từ nội dung hội thoại
+        const snippet = document.createElement('div');
+        snippet.className = 'search-snippet';
+        let position = 0;
+        for (const [start, end] of result.highlights) {
+            snippet.appendChild(document.createTextNode(result.snippet.slice(position, start)));
+            const mark = document.createElement('mark');
+            mark.textContent = result.snippet.slice(start, end);
+            snippet.appendChild(mark);
+            position = end;
+        }
+        snippet.appendChild(document.createTextNode(result.snippet.slice(position)));
+
+        resultDiv.appendChild(header);
+        resultDiv.appendChild(snippet);
+        resultDiv.addEventListener('click', () => this.loadSession(result.session_id));
+        this.sessionList.appendChild(resultDiv);
+    }
+
+    addSessionToList(session) {
+        const sessionId = session.session_id;
+        const sessionDiv = document.createElement('div');
+        sessionDiv.className = `session-item ${sessionId === this.currentSessionId ? 'active' : ''}`;
+        sessionDiv.innerHTML = `
+            <div class="session-id">Session: ${sessionId.substring(0, 8)}... (${session.turn_count} tin nhắn)</div>
+            <div class="session-preview">${session.first_message}</div>
+        `;
+        
+        sessionDiv.addEventListener('click', () => this.loadSession(sessionId, session.model));
+        this.sessionList.appendChild(sessionDiv);
+    }
+
+    async loadSession(sessionId, model = null) {
         try {
             this.showLoading();
-            const response = await fetch(`${this.apiBase}/history/${sessionId}`, {
-                headers: this.getAuthHeaders()
-            });
-            const data = await response.json();
-            
             this.currentSessionId = sessionId;
             this.clearChat();
-            
-            for (const conv of data.history) {
-                this.addMessage(conv.user_message, 'user');
-                this.addMessage(conv.bot_response, 'bot', true, conv.id);
-            }
+            this.setSelectedModel(model);
+
+            // Tải lịch sử theo từng trang, dùng cursor trả về từ server
+            let cursor = null;
+            do {
+                const params = new URLSearchParams({ limit: 100 });
+                if (cursor !== null) params.set('cursor', cursor);
+
+                const response = await fetch(`${this.apiBase}/history/${sessionId}?${params}`, {
+                    headers: this.getAuthHeaders()
+                });
+                const data = await response.json();
+
+                for (const conv of data.history) {
+                    this.addMessage(conv.user_message, 'user');
+                    this.addMessage(conv.bot_response, 'bot', true, conv.id);
+                }
+                cursor = data.next_cursor;
+            } while (cursor !== null && cursor !== undefined);
             
             this.toggleSidebar();
             this.hideLoading();